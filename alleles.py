@@ -6,6 +6,7 @@ from numpy        import *
 from node         import *
 
 from util2 import *
+from data import cnv_free_suff_stats, cnv_free_log_likelihood, cnv_log_likelihoods, data_columns
 
 
 class alleles(Node):
@@ -14,6 +15,16 @@ class alleles(Node):
 	min_conc = 0.01
 	max_conc = 0.1
 
+	__slots__ = ('pi', 'params', 'params1', 'pi1', 'path', 'ht', '_conc', 'id',
+		'tour_in', 'tour_out', 'params_version', 'free_llh', 'free_llh_key',
+		'cnv_llh', 'cnv_llh_key')
+	# params1 and pi1 are MH scratch, path and ht are rebuilt by
+	# update_tree_annotations(), tour_in and tour_out by TSSB.set_euler_tour(),
+	# params_version by params_changed() and free_llh and cnv_llh by
+	# complete_logprob()
+	_transient = ('params1', 'pi1', 'path', 'ht', 'tour_in', 'tour_out', 'params_version',
+		'free_llh', 'free_llh_key', 'cnv_llh', 'cnv_llh_key')
+
 	def __init__(self, parent=None, tssb=None, conc=0.1, ntps=5):
 		super(alleles, self).__init__(parent=parent, tssb=tssb)
 		
@@ -25,6 +36,7 @@ class alleles(Node):
 		
 		self.path = None # set of nodes from root to this node
 		self.ht = 0
+		self.free_llh_key = self.cnv_llh_key = None # see complete_logprob()
 		
 		if parent is None:
 			self._conc = conc			
@@ -35,7 +47,20 @@ class alleles(Node):
 			self.pi = rand(1)*parent.pi
 			parent.pi = parent.pi - self.pi
 			self.params = self.pi
+		self.params_changed()
 			
+	# a tree loaded from a pickle gets new params versions, as these are only
+	# unique within the process
+	def _reset_transient(self):
+		self.path = None
+		self.ht = 0
+		self.free_llh_key = self.cnv_llh_key = None
+		self.params_changed()
+
+	def __setstate__(self, state):
+		super(alleles, self).__setstate__(state)
+		self.params1 = zeros(len(self.pi)); self.pi1 = zeros(len(self.pi))
+
 	def conc(self):
 		if self.parent() is None:
 			return self._conc
@@ -48,9 +73,60 @@ class alleles(Node):
 		self._parent.pi = self._parent.pi + self.pi
 		self._parent   = None
 		self._children = None
+		self._structure_changed()
+
+	# The datum -> node map of map_datum_to_node() is kept current as data
+	# move, so that it need not be rebuilt from the whole tree.
+	def add_datum(self, id):
+		super(alleles, self).add_datum(id)
+		self.tssb.data[id].node = self
 
 	def logprob(self, x):
 		return x[0]._log_likelihood(self.params)
+
+	# must be called whenever params are changed, to renew params_key()
+	def params_changed(self):
+		self.params_version = new_params_version()
+
+	def params_key(self):
+		return self.params_version
+
+	# data without CNVs, grouped by (mu_r, mu_v), are scored at all nodes with
+	# two products of their counts with log(mu) and log(1-mu). SSMs with CNVs
+	# depend on where they are assigned and are left nan.
+	def logprob_matrix(self, data, nodes):
+		llh = empty((len(data), len(nodes)))
+		llh.fill(nan)
+		rows = array([i for i, dat in enumerate(data) if not dat.cnv], dtype=int)
+		if len(rows) == 0:
+			return llh
+		a, d, mu_r, mu_v, norm = data_columns([data[i] for i in rows])
+		phi = array([node.params for node in nodes]) # nodes x samples
+		for key in set(zip(mu_r, mu_v)):
+			group = (mu_r == key[0]) & (mu_v == key[1])
+			mu = (1 - phi) * key[0] + phi*key[1]
+			llh[rows[group]] = dot(a[group], log(mu).T) + dot((d - a)[group], log(1 - mu).T) + norm[group].sum(axis=1)[:,newaxis]
+		return llh
 		
+	# data without CNVs are scored together from their sufficient statistics,
+	# and those with CNVs together from their copy-number coefficients. both
+	# terms are cached: the first until the node's data or params change, the
+	# second until its data, the tree state of update_most_recent_cnvs() or the
+	# pi of any node change.
 	def complete_logprob(self):
-		return sum([self.logprob([data]) for data in self.get_data()])
+		data = self.get_data()
+		key = (self.data_version, self.tssb.data_version, self.params_version)
+		if self.free_llh_key != key:
+			self.free_llh = cnv_free_log_likelihood(self.params, cnv_free_suff_stats(data))
+			self.free_llh_key = key
+		llh = self.free_llh
+		cnv_data = [dat for dat in data if dat.cnv]
+		if cnv_data:
+			update_most_recent_cnvs(self.tssb)
+			pi = tuple([nd.pi.tostring() for nd in self.tssb.get_nodes()])
+			key = (self.data_version, self.tssb.cnv_table_key, pi)
+			if self.cnv_llh_key != key:
+				self.cnv_llh = sum(cnv_log_likelihoods(cnv_data))
+				self.cnv_llh_key = key
+			llh += self.cnv_llh
+		return llh
@@ -3,29 +3,100 @@ import scipy.stats as stat
 from scipy.special import gammaln
 import util2 as u
 
+# Columnar store of the SSMs and CNVs read by util2.load_data(): a, d and the
+# log binomial normalizing constants as no. of data x no. of samples arrays,
+# mu_r, mu_v and whether each datum is a CNV as vectors, and the SSM -> CNV
+# links in CSR form, those of row i being link_cnv (CNV row), link_cp and
+# link_cm [link_ptr[i]:link_ptr[i+1]]. data holds a Datum view of every row,
+# whose a, d and _log_bin_norm_const are rows of the arrays here.
+class Dataset(object):
+	# links is [(SSM row, CNV row, cp, cm)], each SSM's in the order of its
+	# Datum.cnv list
+	def __init__(self, names, ids, a, d, mu_r, mu_v, is_cnv, links=None):
+		if links is None:
+			links = []
+		self.a = array(a, dtype=int64)
+		self.d = array(d, dtype=int64)
+		self.log_bin_norm_const = u.log_bin_coeff(self.d, self.a)
+		self.mu_r = array(mu_r, dtype=float)
+		self.mu_v = array(mu_v, dtype=float)
+		self.is_cnv = array(is_cnv, dtype=bool)
+
+		n = len(ids)
+		links = array(links, dtype=int64).reshape(-1, 4)
+		order = argsort(links[:,0], kind='mergesort')
+		self.link_ptr = concatenate(([0], cumsum(bincount(links[:,0], minlength=n))))
+		self.link_cnv, self.link_cp, self.link_cm = links[order,1:].T.copy()
+
+		self.data = []
+		for i in range(n):
+			dat = Datum(names[i], ids[i], self.a[i], self.d[i], self.mu_r[i], self.mu_v[i], self.log_bin_norm_const[i])
+			dat.dataset = self
+			dat.row = i
+			self.data.append(dat)
+		for ssm, cnv, cp, cm in links:
+			self.data[ssm].cnv.append((self.data[cnv], int(cp), int(cm)))
+
+	# the datums pickle without their rows (see Datum.__getstate__()), which
+	# are views into the arrays again once these are loaded. data is pickled
+	# as a tuple, as a list may still be partly filled when this is loaded.
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['data'] = tuple(self.data)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.data = list(self.data)
+		for i, dat in enumerate(self.data):
+			dat.a, dat.d, dat.mu_r, dat.mu_v, dat._log_bin_norm_const = self.a[i], self.d[i], self.mu_r[i], self.mu_v[i], self.log_bin_norm_const[i]
+
+ALL_SAMPLES = slice(None) # tp of the Datum likelihoods that scores every sample
+
 class Datum(object):
-	def __init__(self, name, id, a, d, mu_r=0, mu_v=0):
+	__slots__ = ('name', 'id', 'a', 'd', 'mu_r', 'mu_v', '_log_bin_norm_const', 'node', 'cnv', 'tssb',
+		'dataset', 'row', 'mr_cnv', 'cnv_coef', 'cnv_coef_key')
+	_row_fields = ('a', 'd', 'mu_r', 'mu_v', '_log_bin_norm_const') # held by the dataset, if any
+	_transient = ('mr_cnv', 'cnv_coef', 'cnv_coef_key') # caches, left out of pickles
+
+	def __init__(self, name, id, a, d, mu_r=0, mu_v=0, log_bin_norm_const=None):
 		self.name = name # SSM name, blank for CNV
 		self.id = id
 		self.a = a
 		self.d = d
 		self.mu_r = mu_r # 1-p_error
 		self.mu_v = mu_v
-		self._log_bin_norm_const = [u.log_bin_coeff(self.d[tp], self.a[tp]) for tp in arange(len(self.a))]
+		if log_bin_norm_const is None:
+			log_bin_norm_const = [u.log_bin_coeff(self.d[tp], self.a[tp]) for tp in arange(len(self.a))]
+		self._log_bin_norm_const = log_bin_norm_const
 
 		## all variables below are used by cnv related computations
-		self.nr = 0
-		self.nv = 0
 		self.node = None # this is the node where the datum resides
 		self.cnv = [] # for SSM, this is [(cnv,cp,cm)]
 		
 		self.tssb = None # this is just a pointer to tssb (tree object), gets initialized in evolve.py
+
+		self.dataset = None # the Dataset this is a row of, if any
+		self.row = None
+		self.cnv_coef_key = None # see cnv_coefficients()
+	
+	def __getstate__(self):
+		skip = self._transient + (self._row_fields if self.dataset is not None else ())
+		return dict([(name, getattr(self, name)) for name in self.__slots__ if name not in skip and hasattr(self, name)])
+
+	# state is a dict of slots, or the __dict__ of a datum pickled before
+	# slots, whose other entries (the scratch values once kept here) are
+	# dropped. the row fields are set by Dataset.__setstate__().
+	def __setstate__(self, state):
+		self.dataset = self.row = self.cnv_coef_key = None
+		for name, value in state.items():
+			if name in self.__slots__ and name not in self._transient:
+				setattr(self, name, value)
 	
 	
-	# for multiple samples
+	# for multiple samples, all scored at once (tp=ALL_SAMPLES below)
 	def _log_likelihood(self, phi,update_tree=True,new_state=0):
-		ntps = len(phi) # multi sample
-		return sum([self.__log_likelihood__(phi[tp],tp,update_tree,new_state) for tp in arange(ntps)])	
+		return sum(self.__log_likelihood__(asarray(phi),ALL_SAMPLES,update_tree,new_state))
 	
 	# new_state is set to 0 or 1 during Metropolis-Hastings updates, defaults to 0 in all other places	
 	def __log_likelihood__(self, phi, tp, update_tree=True,new_state=0):	
@@ -33,107 +104,122 @@ class Datum(object):
 					##################################################
 					## some useful info about the tree,
 					## used by CNV related computations,
-					u.set_node_height(self.tssb)
-					u.set_path_from_root_to_node(self.tssb)
-					u.map_datum_to_node(self.tssb)
+					u.update_tree_annotations(self.tssb)
 					##################################################
 		return self.__log_complete_likelihood__(phi, self.mu_r, self.mu_v, tp, new_state)
 	
 	
 	# for multiple samples
 	def _log_complete_likelihood(self, phi, mu_r, mu_v):
-		ntps = len(self.a)
-		return sum([self.__log_complete_likelihood__(phi, mu_r, mu_v,tp) for tp in arange(ntps)])
+		return sum(self.__log_complete_likelihood__(asarray(phi), mu_r, mu_v, ALL_SAMPLES))
+	# tp is a sample, or ALL_SAMPLES with phi (and the llh returned) one per sample
 	def __log_complete_likelihood__(self, phi, mu_r, mu_v, tp, new_state=0):	
-		
+		a = asarray(self.a)[tp]
+		d = asarray(self.d)[tp]
+		norm = asarray(self._log_bin_norm_const)[tp]
 		if self.cnv:
-			ll = []
-			poss_n_genomes = self.compute_n_genomes(tp,new_state)
-			poss_n_genomes = [x for x in poss_n_genomes if x[1] > 0]
-			for (nr,nv) in poss_n_genomes:
-				mu = (nr * mu_r + nv*(1-mu_r) ) / (nr+ nv)
-				ll.append(u.log_binomial_likelihood(self.a[tp], self.d[tp], mu) + log(1.0/len(poss_n_genomes)) +  self._log_bin_norm_const[tp])
-			if len(poss_n_genomes) == 0:
-				ll.append(log(1e-99)) # to handle cases with zero likelihood
-			llh = u.logsumexp(ll)
+			n = array([x + zeros(shape(a)) for nr_nv in self.compute_n_genomes(tp,new_state) for x in nr_nv]).reshape(1, 4, -1) # nr1, nv1, nr2, nv2
+			llh = cnv_genome_log_likelihoods(n, a.reshape(1, -1), d.reshape(1, -1), array([[mu_r]]), norm.reshape(1, -1))
+			llh = llh.reshape(shape(a))
 		else: ## CNV datum
 			mu = (1 - phi) * mu_r + phi*mu_v # (mu_r=0.999, mu_v=0.5)
-			llh = u.log_binomial_likelihood(self.a[tp], self.d[tp], mu) +  self._log_bin_norm_const[tp]
+			llh = a*log(mu) + (d-a)*log(1-mu) +  norm
 		return 	llh
 	
-	# computes the binomial parameter
+	# computes the binomial parameter, of sample tp or, for ALL_SAMPLES, of each
+	# sample as arrays
 	def compute_n_genomes(self,tp,new_state=0):
-	
-		def descend(nd,new_state):
-
+		nodes = self.tssb.root['node'].tssb.get_nodes()
+		is_ancestor = self.tssb.is_ancestor
+		u.update_most_recent_cnvs(self.tssb)
+		ssm_node = self.node.path[-1]
+		nr1 = nv1 = nr2 = nv2 = 0
+		for nd in nodes:
 			pi = nd.pi1[tp] if new_state else nd.pi[tp] # this is needed for Metropolis-Hastings likelihood computations
-			ssm_node = self.node.path[-1]
-			mr_cnv = self.find_most_recent_cnv(nd)
-			ancestors = nd.get_ancestors()
-			if (not ssm_node in ancestors) and (not mr_cnv):
-				self.nr1 = self.nr1 + pi * 2
-				self.nr2 = self.nr2 + pi * 2
-			elif ssm_node in ancestors and (not mr_cnv):
-				self.nr1 = self.nr1 + pi
-				self.nv1 = self.nv1 + pi
-				self.nr2 = self.nr2 + pi
-				self.nv2 = self.nv2 + pi
-			elif (not ssm_node in ancestors) and mr_cnv:
-				self.nr1 = self.nr1 + pi * (mr_cnv[1] + mr_cnv[2])
-				self.nr2 = self.nr2 + pi * (mr_cnv[1] + mr_cnv[2])
-			elif ssm_node in ancestors and mr_cnv:
-				if ssm_node in mr_cnv[0].node.get_ancestors():
-					self.nr1 = self.nr1 + pi * mr_cnv[1]
-					self.nv1 = self.nv1 + pi * mr_cnv[2]
-					self.nr2 = self.nr2 + pi * mr_cnv[2]
-					self.nv2 = self.nv2 + pi * mr_cnv[1]
+			mr_cnv = self.mr_cnv[nd.tour_in]
+			ssm_above = is_ancestor(ssm_node, nd)
+			if (not ssm_above) and (not mr_cnv):
+				nr1 = nr1 + pi * 2
+				nr2 = nr2 + pi * 2
+			elif ssm_above and (not mr_cnv):
+				nr1 = nr1 + pi
+				nv1 = nv1 + pi
+				nr2 = nr2 + pi
+				nv2 = nv2 + pi
+			elif (not ssm_above) and mr_cnv:
+				nr1 = nr1 + pi * (mr_cnv[1] + mr_cnv[2])
+				nr2 = nr2 + pi * (mr_cnv[1] + mr_cnv[2])
+			elif ssm_above and mr_cnv:
+				if is_ancestor(ssm_node, mr_cnv[0].node):
+					nr1 = nr1 + pi * mr_cnv[1]
+					nv1 = nv1 + pi * mr_cnv[2]
+					nr2 = nr2 + pi * mr_cnv[2]
+					nv2 = nv2 + pi * mr_cnv[1]
 				else:
-					self.nr1 = self.nr1 + pi * max(0,(mr_cnv[1]+mr_cnv[2] - 1))
-					self.nv1 = self.nv1 + pi * min(1,mr_cnv[1]+mr_cnv[2])
-					self.nr2 = self.nr2 + pi * max(0,(mr_cnv[1] + mr_cnv[2] - 1))
-					self.nv2 = self.nv2 + pi * min(1,mr_cnv[1]+mr_cnv[2])
+					nr1 = nr1 + pi * max(0,(mr_cnv[1]+mr_cnv[2] - 1))
+					nv1 = nv1 + pi * min(1,mr_cnv[1]+mr_cnv[2])
+					nr2 = nr2 + pi * max(0,(mr_cnv[1] + mr_cnv[2] - 1))
+					nv2 = nv2 + pi * min(1,mr_cnv[1]+mr_cnv[2])
 			else:
 				print "PANIC"
-		
-		nodes = self.tssb.root['node'].tssb.get_nodes()
-		self.nr1 = 0
-		self.nv1 = 0
-		self.nr2 = 0 
-		self.nv2 = 0
-		for nd in nodes:
-			descend(nd, new_state)
-		out = [(self.nr1,self.nv1),(self.nr2,self.nv2)]
- 	
-		return out
+		return [(nr1,nv1),(nr2,nv2)]
 	
+	# the CNV on the deepest ancestor of nd (or nd itself), the first one
+	# listed if several share that node. see u.update_most_recent_cnvs()
 	def find_most_recent_cnv(self, nd):
-		out = None
-		for n in nd.get_ancestors()[::-1]:
-			if n in [x[0].node for x in self.cnv]:
-				out = [x for x in self.cnv if x[0].node == n][0]
-				break
-		return out
+		if not self.cnv: return None
+		u.update_most_recent_cnvs(self.tssb)
+		return self.mr_cnv[nd.tour_in]
+	
+	# the (nr,nv) maternal and paternal of compute_n_genomes() as a 4 x no. of
+	# nodes matrix, over the nodes ordered by tour_in: compute_n_genomes() is
+	# its product with their pi. cached until the tree structure, the SSM's
+	# node or the nodes of its CNVs change.
+	def cnv_coefficients(self):
+		u.update_most_recent_cnvs(self.tssb)
+		key = (self.tssb.cnv_table_key, self.node)
+		if self.cnv_coef_key == key:
+			return self.cnv_coef
+		ssm_node = self.node
+		coef = zeros((4, len(self.mr_cnv))) # nr1, nv1, nr2, nv2
+		for j, mr_cnv in enumerate(self.mr_cnv):
+			ssm_above = ssm_node.tour_in <= j < ssm_node.tour_out
+			if (not ssm_above) and (not mr_cnv):
+				coef[:,j] = (2, 0, 2, 0)
+			elif ssm_above and (not mr_cnv):
+				coef[:,j] = (1, 1, 1, 1)
+			elif (not ssm_above) and mr_cnv:
+				coef[:,j] = (mr_cnv[1]+mr_cnv[2], 0, mr_cnv[1]+mr_cnv[2], 0)
+			elif self.tssb.is_ancestor(ssm_node, mr_cnv[0].node):
+				coef[:,j] = (mr_cnv[1], mr_cnv[2], mr_cnv[2], mr_cnv[1])
+			else:
+				nr = max(0,mr_cnv[1]+mr_cnv[2]-1); nv = min(1,mr_cnv[1]+mr_cnv[2])
+				coef[:,j] = (nr, nv, nr, nv)
+		self.cnv_coef = coef
+		self.cnv_coef_key = key
+		return coef
 		
 	
 	########## old code, not in use, but don't delete #####################
 	def __log_complete_likelihood1__(self, phi, mu_r, mu_v, new_state=0):	
 		llh = []
 		if self.cnv: 
-			self.compute_n_genomes(0,new_state) # maternal
-			mu = (self.nr * mu_r + self.nv*(1-mu_r) ) / (self.nr+ self.nv)
+			nr, nv = self.compute_n_genomes1(0,new_state) # maternal
+			mu = (nr * mu_r + nv*(1-mu_r) ) / (nr+ nv)
 			llh.append(u.log_binomial_likelihood(self.a, self.d, mu) + log(0.5) +  self._log_bin_norm_const)
-			self.compute_n_genomes(1,new_state) # paternal
-			mu = (self.nr * mu_r + self.nv*(1-mu_r) ) / (self.nr+ self.nv)
+			nr, nv = self.compute_n_genomes1(1,new_state) # paternal
+			mu = (nr * mu_r + nv*(1-mu_r) ) / (nr+ nv)
 			llh.append(u.log_binomial_likelihood(self.a, self.d, mu) + log(0.5) +  self._log_bin_norm_const)
 			llh = u.logsumexp(ll)
 		else: ## CNV datum or SSM with no CNV
 			mu = (1 - phi) * mu_r + phi*mu_v # (mu_r=0.999, mu_v=0.5)
 			llh = u.log_binomial_likelihood(self.a, self.d, mu) +  self._log_bin_norm_const
 		return 	llh
+	# returns (nr,nv)
 	def compute_n_genomes1(self,maternal,new_state=0):
 		####### TEMPORARY ONLY ###############
 		maternal = True
-		self.nr=self.nv=0
+		n = [0, 0] # nr, nv
 	
 		wts,nodes = self.tssb.get_mixture()
 		ancestors = self.node.get_ancestors() # path from root to ssm node
@@ -147,10 +233,10 @@ class Datum(object):
 			pi = node.pi1 if new_state else node.pi # this is needed for Metropolis-Hastings likelihood computations
 		
 			if node != mr_cnv[0].node and visited_cnv==False: # until CNV is encountered
-				self.nr = self.nr + pi*2
+				n[0] = n[0] + pi*2
 			else:
 				visited_cnv = True
-				self.nr = self.nr + pi*(mr_cnv[1]+mr_cnv[2])
+				n[0] = n[0] + pi*(mr_cnv[1]+mr_cnv[2])
 		
 		# do this after the SSM node, i.e, for all nodes in the subtree below the SSM node
 		def descend(nd):
@@ -158,17 +244,90 @@ class Datum(object):
 		
 			if nd == mr_cnv[0].node:
 				if maternal:
-					self.nr = self.nr + pi*mr_cnv[1]
-					self.nv = self.nv + pi*mr_cnv[2]
+					n[0] = n[0] + pi*mr_cnv[1]
+					n[1] = n[1] + pi*mr_cnv[2]
 				else:
-					self.nr = self.nr + pi*mr_cnv[2]
-					self.nv = self.nv + pi*mr_cnv[1]
+					n[0] = n[0] + pi*mr_cnv[2]
+					n[1] = n[1] + pi*mr_cnv[1]
 			else:
-				self.nr = self.nr + pi * (mr_cnv[1]+mr_cnv[2] - 1)
-				self.nv = self.nv + pi
+				n[0] = n[0] + pi * (mr_cnv[1]+mr_cnv[2] - 1)
+				n[1] = n[1] + pi
 			
 			for child in nd.children():
 				descend(child)
 		
 		# traverse the tree below the ssm node
 		for child in node.children(): descend(child)
+		return n[0], n[1]
+
+# a, d, mu_r, mu_v and the log binomial normalizing constants of data, as
+# len(data) x no. of samples arrays (len(data) for mu_r and mu_v). these are
+# rows of the data's Dataset, or stacked from the datums themselves when they
+# do not share one (trees pickled before Dataset, or data made outside
+# util2.load_data()).
+def data_columns(data):
+	ds = data[0].dataset
+	if ds is not None and all([dat.dataset is ds for dat in data]):
+		rows = array([dat.row for dat in data], dtype=int64)
+		return ds.a[rows], ds.d[rows], ds.mu_r[rows], ds.mu_v[rows], ds.log_bin_norm_const[rows]
+	return (array([dat.a for dat in data]), array([dat.d for dat in data]),
+		array([dat.mu_r for dat in data], dtype=float), array([dat.mu_v for dat in data], dtype=float),
+		array([dat._log_bin_norm_const for dat in data]))
+
+# Data without CNVs depend on phi only through mu = (1-phi)*mu_r + phi*mu_v,
+# so their summed log-likelihood is A*log(mu) + B*log(1-mu) + C, where A, B and
+# C are the sums of a, d-a and the binomial normalizing constants. Returns
+# {(mu_r, mu_v): (A, B, C)} over the CNV-free data, one value per sample.
+def cnv_free_suff_stats(data):
+	stats = {}
+	data = [dat for dat in data if not dat.cnv]
+	if not data:
+		return stats
+	a, d, mu_r, mu_v, norm = data_columns(data)
+	for key in set(zip(mu_r, mu_v)):
+		rows = (mu_r == key[0]) & (mu_v == key[1])
+		stats[key] = array([a[rows].sum(axis=0), (d - a)[rows].sum(axis=0), norm[rows].sum(axis=0)], dtype=float)
+	return stats
+
+# Log-likelihoods of SSMs with CNVs, a len(data) x no. of samples array. Same as
+# __log_complete_likelihood__(), but the (nr,nv) of all data and samples come
+# from one product of their cnv_coefficients() with the nodes' pi.
+def cnv_log_likelihoods(data):
+	tssb = data[0].tssb
+	u.update_tree_annotations(tssb)
+	coef = array([dat.cnv_coefficients() for dat in data]) # data x 4 x nodes
+	# the columns of coef are the nodes' tour_in, which need not follow the
+	# current order of siblings
+	nodes = tssb.get_nodes()
+	pi = empty((len(nodes), len(nodes[0].pi)))
+	for nd in nodes:
+		pi[nd.tour_in] = nd.pi
+	n = dot(coef, pi) # data x 4 x samples
+	a, d, mu_r, mu_v, norm = data_columns(data)
+	return cnv_genome_log_likelihoods(n, a, d, mu_r[:,newaxis], norm)
+
+# Log-likelihoods of SSMs with CNVs given their maternal and paternal (nr,nv),
+# as Datum.__log_complete_likelihood__() scores them, for no. of data x no. of
+# samples a, d and norm, no. of data x 1 mu_r and no. of data x 4 x no. of
+# samples n (nr1, nv1, nr2, nv2).
+def cnv_genome_log_likelihoods(n, a, d, mu_r, norm):
+	valid = n[:,1::2] > 0 # nv > 0, maternal and paternal
+	count = valid.sum(axis=1)
+	with errstate(divide='ignore', invalid='ignore'):
+		ll = []
+		for k in (0, 1):
+			nr, nv = n[:,2*k], n[:,2*k+1]
+			mu = (nr * mu_r + nv*(1-mu_r) ) / (nr+ nv)
+			llk = a*log(mu) + (d-a)*log(1-mu) + log(1.0/count) + norm
+			ll.append(where(valid[:,k], llk, -inf))
+		maxes = maximum(ll[0], ll[1])
+		llh = log(exp(ll[0] - maxes) + exp(ll[1] - maxes)) + maxes
+	llh[count == 0] = log(1e-99) # to handle cases with zero likelihood
+	return llh
+
+def cnv_free_log_likelihood(phi, stats):
+	llh = 0.0
+	for (mu_r, mu_v), (A, B, C) in stats.items():
+		mu = (1 - phi) * mu_r + phi*mu_v
+		llh += sum(A*log(mu) + B*log(1 - mu) + C)
+	return llh
@@ -14,6 +14,8 @@ import numpy.random
 from util2 import *
 from params import *
 from printo import *
+from mh_native import NativeMH
+from mh_numpy import NumpyMH
 
 import argparse
 import signal
@@ -26,7 +28,7 @@ from datetime import datetime
 # num_samples: number of MCMC samples
 # mh_itr: number of metropolis-hasting iterations
 # rand_seed: random seed (initialization). Set to None to choose random seed automatically.
-def start_new_run(state_manager, backup_manager, safe_to_exit, run_succeeded, config, ssm_file, cnv_file, top_k_trees_file, clonal_freqs_file, burnin_samples, num_samples, mh_itr, mh_std, write_state_every, write_backups_every, rand_seed, tmp_dir):
+def start_new_run(state_manager, backup_manager, safe_to_exit, run_succeeded, config, ssm_file, cnv_file, top_k_trees_file, clonal_freqs_file, burnin_samples, num_samples, mh_itr, mh_std, mh_engine, mh_threads, mh_blocked, mh_adaptive, mh_min_itr, mh_target_acc, mh_target_ess, mh_pair_rate, mh_subtree_rate, mh_delayed, mh_tries, write_state_every, write_backups_every, rand_seed, tmp_dir, data_cache=True):
 	state = {}
 
 	with open('random_seed.txt', 'w') as seedf:
@@ -47,12 +49,13 @@ def start_new_run(state_manager, backup_manager, safe_to_exit, run_succeeded, co
 	state['ssm_file'] = ssm_file
 	state['cnv_file'] = cnv_file
 	state['tmp_dir'] = tmp_dir
+	state['data_cache'] = data_cache
 	state['top_k_trees_file'] = top_k_trees_file
 	state['clonal_freqs_file'] = clonal_freqs_file
 	state['write_state_every'] = write_state_every
 	state['write_backups_every'] = write_backups_every
 
-	codes, n_ssms, n_cnvs = load_data(state['ssm_file'], state['cnv_file'])
+	codes, n_ssms, n_cnvs = load_data(state['ssm_file'], state['cnv_file'], state['data_cache'])
 	if len(codes) == 0:
 		logmsg('No SSMs or CNVs provided. Exiting.', sys.stderr)
 		return
@@ -71,6 +74,25 @@ def start_new_run(state_manager, backup_manager, safe_to_exit, run_succeeded, co
 	state['mh_burnin'] = 0
 	state['mh_itr'] = mh_itr # No. of iterations in metropolis-hastings
 	state['mh_std'] = mh_std
+	state['mh_engine'] = mh_engine # Implementation of the MH sampler, see start_mh_engine()
+	state['mh_threads'] = mh_threads # No. of threads used to evaluate the MH likelihood
+	state['mh_blocked'] = mh_blocked # Accept/reject MH proposals per sample
+	# Adaptive MH: mh_std is tuned towards mh_target_acc within each call, which
+	# stops after between mh_min_itr and mh_itr iterations, once the chain's
+	# effective sample size reaches mh_target_ess.
+	state['mh_adaptive'] = mh_adaptive
+	state['mh_min_itr'] = mh_min_itr
+	state['mh_target_acc'] = mh_target_acc
+	state['mh_target_ess'] = mh_target_ess
+	# Probabilities of the local MH proposals, which move pi between a node and
+	# its parent or rescale a subtree. The rest are global Dirichlet proposals.
+	state['mh_pair_rate'] = mh_pair_rate
+	state['mh_subtree_rate'] = mh_subtree_rate
+	# Screen global MH proposals on the likelihood of the data without CNVs
+	# before scoring the SSMs with CNVs (delayed acceptance).
+	state['mh_delayed'] = mh_delayed
+	# No. of candidates of each global MH proposal (multiple-try Metropolis).
+	state['mh_tries'] = mh_tries
 
 	state['cd_llh_traces'] = zeros((state['num_samples'], 1))
 	state['burnin_cd_llh_traces'] = zeros((state['burnin'], 1))
@@ -103,7 +125,7 @@ def start_new_run(state_manager, backup_manager, safe_to_exit, run_succeeded, co
 	# This will overwrite file if it already exists, which is the desired
 	# behaviour for a fresh run.
 	with open('mcmc_samples.txt', 'w') as mcmcf:
-		mcmcf.write('Iteration\tLLH\tTime\n')
+		mcmcf.write('\t'.join(MCMC_SAMPLES_COLUMNS) + '\n')
 
 	do_mcmc(state_manager, backup_manager, safe_to_exit, run_succeeded, config, state, tree_writer, codes, n_ssms, n_cnvs, NTPS, tmp_dir)
 
@@ -125,7 +147,7 @@ def resume_existing_run(state_manager, backup_manager, safe_to_exit, run_succeed
 
 	set_state(state['rand_state']) # Restore NumPy's RNG state.
 	os.chdir(state['working_directory'])
-	codes, n_ssms, n_cnvs = load_data(state['ssm_file'], state['cnv_file'])
+	codes, n_ssms, n_cnvs = load_data(state['ssm_file'], state['cnv_file'], state.get('data_cache', True))
 	NTPS = len(codes[0].a) # number of samples / time point
 
 	do_mcmc(state_manager, backup_manager, safe_to_exit, run_succeeded, config, state, tree_writer, codes, n_ssms, n_cnvs, NTPS, state['tmp_dir'])
@@ -134,13 +156,21 @@ def do_mcmc(state_manager, backup_manager, safe_to_exit, run_succeeded, config,
 	start_iter = state['last_iteration'] + 1
 	unwritten_trees = []
 	mcmc_sample_times = []
+	mh_sample_stats = []
+	memo_sample_stats = []
+	mcmc_samples_columns = read_mcmc_samples_columns()
 	last_mcmc_sample_time = time.time()
 
 	# If --tmp-dir is not specified on the command line, it will by default be
-	# None, which will cause mkdtemp() to place this directory under the system's
-	# temporary directory. This is the desired behaviour.
+	# None. The directory is then placed in /dev/shm where available, so that the
+	# file exchanged with mh.o never touches the disk, and otherwise under the
+	# system's temporary directory.
+	if tmp_dir_parent is None and os.path.isdir('/dev/shm'):
+		tmp_dir_parent = '/dev/shm'
 	config['tmp_dir'] = tempfile.mkdtemp(prefix='pwgsdataexchange.', dir=tmp_dir_parent)
 
+	mh_engine = start_mh_engine(state.get('mh_engine', 'auto'), config, state, codes, n_ssms, n_cnvs, NTPS)
+
 	for iteration in range(start_iter, state['num_samples']):
 		safe_to_exit.set()
 		if iteration < 0:
@@ -149,6 +179,7 @@ def do_mcmc(state_manager, backup_manager, safe_to_exit, run_succeeded, config,
 		# Referring to tssb as local variable instead of dictionary element is much
 		# faster.
 		tssb = state['tssb']
+		memo_counts = (llh_memo.hits, llh_memo.misses)
 		tssb.resample_assignments()
 		tssb.cull_tree()
 		
@@ -161,12 +192,10 @@ def do_mcmc(state_manager, backup_manager, safe_to_exit, run_succeeded, config,
 		## some useful info about the tree,
 		## used by CNV related computations,
 		## to be called only after resampling assignments
-		set_node_height(tssb)
-		set_path_from_root_to_node(tssb)
-		map_datum_to_node(tssb)
+		update_tree_annotations(tssb)
 		##################################################
 
-		state['mh_acc'] = metropolis(
+		mh_stats = metropolis(
 			tssb,
 			state['mh_itr'],
 			state['mh_std'],
@@ -177,20 +206,38 @@ def do_mcmc(state_manager, backup_manager, safe_to_exit, run_succeeded, config,
 			state['cnv_file'],
 			state['rand_seed'],
 			NTPS,
-			config['tmp_dir']
+			config['tmp_dir'],
+			mh_engine,
+			state.get('mh_threads', 1),
+			state.get('mh_blocked', False),
+			state.get('mh_adaptive', False),
+			state.get('mh_min_itr', 0),
+			state.get('mh_target_acc', 0.25),
+			state.get('mh_target_ess', 100),
+			state.get('mh_pair_rate', 0.0),
+			state.get('mh_subtree_rate', 0.0),
+			delayed=state.get('mh_delayed', False),
+			tries=state.get('mh_tries', 1)
 		)
-		if float(state['mh_acc']) < 0.08 and state['mh_std'] < 10000:
-			state['mh_std'] = state['mh_std']*2.0
-			logmsg("Shrinking MH proposals. Now %f" % state['mh_std'])
-		if float(state['mh_acc']) > 0.5 and float(state['mh_acc']) < 0.99:
-			state['mh_std'] = state['mh_std']/2.0
-			logmsg("Growing MH proposals. Now %f" % state['mh_std'])
+		state['mh_acc'] = mh_stats['acc_rate']
+		mh_sample_stats.append(mh_stats)
+		if state.get('mh_adaptive', False):
+			# Start the next call from the proposal scale this one adapted to.
+			state['mh_std'] = mh_stats['std']
+		else:
+			if float(state['mh_acc']) < 0.08 and state['mh_std'] < 10000:
+				state['mh_std'] = state['mh_std']*2.0
+				logmsg("Shrinking MH proposals. Now %f" % state['mh_std'])
+			if float(state['mh_acc']) > 0.5 and float(state['mh_acc']) < 0.99:
+				state['mh_std'] = state['mh_std']/2.0
+				logmsg("Growing MH proposals. Now %f" % state['mh_std'])
 	
 		tssb.resample_sticks()
 		tssb.resample_stick_orders()
 		tssb.resample_hypers(dp_alpha=True, alpha_decay=True, dp_gamma=True)
  
 		last_llh = tssb.complete_data_log_likelihood()
+		memo_sample_stats.append((llh_memo.hits - memo_counts[0], llh_memo.misses - memo_counts[1]))
 		if iteration >= 0:
 			state['cd_llh_traces'][iteration] = last_llh
 			if True or mod(iteration, 10) == 0:
@@ -223,17 +270,22 @@ def do_mcmc(state_manager, backup_manager, safe_to_exit, run_succeeded, config,
 		# iteration.
 		if should_write_backup or should_write_state or is_last_iteration:
 			with open('mcmc_samples.txt', 'a') as mcmcf:
-				llhs_and_times = [(itr, llh, itr_time) for (tssb, itr, llh), itr_time in zip(unwritten_trees, mcmc_sample_times)]
-				llhs_and_times = '\n'.join(['%s\t%s\t%s' % (itr, llh, itr_time) for itr, llh, itr_time in llhs_and_times])
+				llhs_and_times = [(itr, llh, itr_time, mh_stats, memo_stats) for (tssb, itr, llh), itr_time, mh_stats, memo_stats in zip(unwritten_trees, mcmc_sample_times, mh_sample_stats, memo_sample_stats)]
+				llhs_and_times = '\n'.join([format_mcmc_sample(mcmc_samples_columns, *sample) for sample in llhs_and_times])
 				mcmcf.write(llhs_and_times + '\n')
 			tree_writer.write_trees(unwritten_trees)
 			state_manager.write_state(state)
 			unwritten_trees = []
 			mcmc_sample_times = []
+			mh_sample_stats = []
+			memo_sample_stats = []
 			if should_write_backup:
 				backup_manager.save_backup()
 
 	safe_to_exit.clear()
+	mh_engine.close()
+	config['mh_worker_pid'] = None
+
 	#save the best tree
 	print_top_trees(TreeWriter.default_archive_fn, state['top_k_trees_file'], state['top_k'])
 
@@ -247,6 +299,69 @@ def do_mcmc(state_manager, backup_manager, safe_to_exit, run_succeeded, config,
 	safe_to_exit.set()
 	run_succeeded.set()
 
+# 'auto' runs the MH sampler in-process if libmh.so has been built and
+# otherwise starts a persistent mh.o worker ('serve'). 'exec' runs mh.o anew on
+# every call, 'numpy' uses the pure NumPy sampler in mh_numpy.py.
+def start_mh_engine(name, config, state, codes, n_ssms, n_cnvs, NTPS):
+	if name in ('auto', 'native'):
+		try:
+			return NativeMH(*pack_data(codes, n_ssms, NTPS), n_ssms=n_ssms, n_cnvs=n_cnvs)
+		except OSError:
+			if name == 'native':
+				raise
+			logmsg('libmh.so not found. Running mh.o as a persistent worker instead.')
+	if name == 'numpy':
+		# Seeded from the global RNG, so that runs are reproducible with
+		# --random-seed.
+		return NumpyMH(*pack_data(codes, n_ssms, NTPS), n_ssms=n_ssms, n_cnvs=n_cnvs, seed=randint(2**31))
+	if name == 'exec':
+		return MHExec(n_ssms, n_cnvs, state['ssm_file'], state['cnv_file'], NTPS, config['tmp_dir'])
+	engine = MHWorker(n_ssms, n_cnvs, state['ssm_file'], state['cnv_file'], NTPS, config['tmp_dir'])
+	config['mh_worker_pid'] = engine.pid
+	return engine
+
+MCMC_SAMPLES_COLUMNS = ('Iteration', 'LLH', 'Time', 'MHIters', 'MHLLHEvals', 'MHAccRates', 'MHKernelAccRates', 'MHDelayedRej', 'LLHMemoHits')
+
+# The columns of mcmc_samples.txt, as listed in its header. A run resumed from
+# an earlier version keeps writing the columns its file was started with.
+def read_mcmc_samples_columns():
+	try:
+		with open('mcmc_samples.txt') as mcmcf:
+			columns = mcmcf.readline().rstrip('\n').split('\t')
+	except IOError:
+		return MCMC_SAMPLES_COLUMNS
+	if columns == ['']:
+		return MCMC_SAMPLES_COLUMNS
+	return columns
+
+# memo_stats: the no. of hits and misses of util.llh_memo during the iteration.
+# Hits follow iterations whose MH step rejected every proposal.
+def format_mcmc_sample(columns, itr, llh, itr_time, mh_stats, memo_stats):
+	values = {
+		'Iteration': itr,
+		'LLH': llh,
+		'Time': itr_time,
+		'MHIters': int(mh_stats['iters']),
+		'MHLLHEvals': int(mh_stats['llh_evals']),
+		'MHAccRates': ','.join([str(r) for r in mh_stats['acc_rates']]),
+		'MHKernelAccRates': format_kernel_stats(mh_stats),
+		'MHDelayedRej': format_delayed_stats(mh_stats),
+		'LLHMemoHits': '%d/%d' % (memo_stats[0], memo_stats[0] + memo_stats[1]),
+	}
+	return '\t'.join(['%s' % values.get(column, '') for column in columns])
+
+# e.g. global=0.1200/800,pair=0.4000/200: acceptance ratio and no. of proposals of
+# each MH kernel that was used
+def format_kernel_stats(mh_stats):
+	return ','.join(['%s=%.4f/%d' % (k, mh_stats[k + '_acc'], mh_stats[k + '_moves']) for k in MH_KERNELS if mh_stats[k + '_moves'] > 0])
+
+# e.g. 0.7000,0.1500: fraction of global MH proposals rejected by the delayed
+# acceptance screen and after it, empty without --mh-delayed
+def format_delayed_stats(mh_stats):
+	if mh_stats['stage1_rej'] + mh_stats['stage2_rej'] == 0:
+		return ''
+	return '%.4f,%.4f' % (mh_stats['stage1_rej'], mh_stats['stage2_rej'])
+
 def test():
 	tssb=cPickle.load(open('ptree'))
 	wts,nodes=tssb.get_mixture()	
@@ -272,10 +387,36 @@ def parse_args():
 		help='Number of MCMC samples')
 	parser.add_argument('-i', '--mh-iterations', dest='mh_iterations', default=5000, type=int,
 		help='Number of Metropolis-Hastings iterations')
+	parser.add_argument('--mh-engine', dest='mh_engine', default='auto', choices=('auto', 'native', 'serve', 'exec', 'numpy'),
+		help='Metropolis-Hastings implementation: libmh.so in-process (native), a persistent mh.o process (serve), mh.o run on every iteration (exec), or pure NumPy (numpy). auto uses native if libmh.so has been built and serve otherwise.')
+	parser.add_argument('--mh-threads', dest='mh_threads', default=1, type=int,
+		help='Number of threads used to evaluate likelihoods in Metropolis-Hastings. Requires mh.o/libmh.so to be built with -fopenmp. Results do not depend on this setting.')
+	parser.add_argument('--mh-blocked', dest='mh_blocked', action='store_true',
+		help='Accept or reject the Metropolis-Hastings proposal of each sample separately rather than jointly. Speeds up mixing when there are many samples.')
+	parser.add_argument('--mh-adaptive', dest='mh_adaptive', action='store_true',
+		help='Adapt the Metropolis-Hastings proposal scale towards --mh-target-acc during each call, and stop a call early once the effective sample size of its log-likelihood trace reaches --mh-target-ess. --mh-iterations is then the maximum number of iterations.')
+	parser.add_argument('--mh-min-iterations', dest='mh_min_iterations', default=500, type=int,
+		help='Minimum number of Metropolis-Hastings iterations with --mh-adaptive')
+	parser.add_argument('--mh-target-acc', dest='mh_target_acc', default=0.25, type=float,
+		help='Target Metropolis-Hastings acceptance ratio with --mh-adaptive')
+	parser.add_argument('--mh-target-ess', dest='mh_target_ess', default=100, type=float,
+		help='Effective sample size at which a Metropolis-Hastings call stops with --mh-adaptive')
+	parser.add_argument('--mh-pair-rate', dest='mh_pair_rate', default=0.0, type=float,
+		help='Fraction of Metropolis-Hastings proposals that move pi between a random node and its parent, rescoring only the data those affect')
+	parser.add_argument('--mh-subtree-rate', dest='mh_subtree_rate', default=0.0, type=float,
+		help='Fraction of Metropolis-Hastings proposals that rescale the mass of a random subtree against its parent. The remaining proposals redraw pi for all nodes.')
+	parser.add_argument('--mh-delayed', dest='mh_delayed', action='store_true',
+		help='Screen Metropolis-Hastings proposals for all nodes on the likelihood of the SSMs outside CNVs and of the CNVs, and score the SSMs within CNVs only for the proposals that pass. Samples from the same posterior; saves time when most proposals are rejected.')
+	parser.add_argument('--mh-tries', dest='mh_tries', default=1, type=int,
+		help='Number of candidates drawn and scored in parallel for each Metropolis-Hastings proposal for all nodes, of which one is picked by multiple-try Metropolis. Use with --mh-threads. Ignores --mh-delayed if above 1.')
 	parser.add_argument('-r', '--random-seed', dest='random_seed', type=int,
 		help='Random seed for initializing MCMC sampler')
 	parser.add_argument('-t', '--tmp-dir', dest='tmp_dir',
 		help='Path to directory for temporary files')
+	parser.add_argument('--data-cache', dest='data_cache',
+		help='File to cache the parsed input files in. If not set, the SSM file name followed by %s is used.' % DATA_CACHE_SUFFIX)
+	parser.add_argument('--no-data-cache', dest='data_cache', action='store_false',
+		help='Parse the input files without reading or writing a cache')
 	parser.add_argument('ssm_file',
 		help='File listing SSMs (simple somatic mutations, i.e., single nucleotide variants. For proper format, see README.md.')
 	parser.add_argument('cnv_file',
@@ -316,12 +457,32 @@ def run(safe_to_exit, run_succeeded, config):
 			num_samples=args.mcmc_samples,
 			mh_itr=args.mh_iterations,
 			mh_std=100,
+			mh_engine=args.mh_engine,
+			mh_threads=args.mh_threads,
+			mh_blocked=args.mh_blocked,
+			mh_adaptive=args.mh_adaptive,
+			mh_min_itr=args.mh_min_iterations,
+			mh_target_acc=args.mh_target_acc,
+			mh_target_ess=args.mh_target_ess,
+			mh_pair_rate=args.mh_pair_rate,
+			mh_subtree_rate=args.mh_subtree_rate,
+			mh_delayed=args.mh_delayed,
+			mh_tries=args.mh_tries,
 			write_state_every=args.write_state_every,
 			write_backups_every=args.write_backups_every,
 			rand_seed=args.random_seed,
-			tmp_dir=args.tmp_dir
+			tmp_dir=args.tmp_dir,
+			data_cache=True if args.data_cache is None else args.data_cache
 		)
 
+def stop_mh_worker(pid):
+	if pid is None:
+		return
+	try:
+		os.kill(pid, signal.SIGTERM)
+	except OSError:
+		pass
+
 def remove_tmp_files(tmp_dir):
 	if tmp_dir is None:
 		return
@@ -364,13 +525,18 @@ def main():
 	# objects, it's thread safe and doesn't require the use of a mutex. See
 	# http://effbot.org/pyfaq/what-kinds-of-global-value-mutation-are-thread-safe.htm.
 	# If more complex values are stored here, we must introduce a mutex.
+	#
+	# Likewise, the run thread records the PID of the mh.o worker process, if
+	# any, so that it can be stopped here.
 	config = {
-		'tmp_dir': None
+		'tmp_dir': None,
+		'mh_worker_pid': None,
 	}
 
 	def sigterm_handler(_signo, _stack_frame):
 		logmsg('Signal %s received.' % _signo, sys.stderr)
 		safe_to_exit.wait()
+		stop_mh_worker(config['mh_worker_pid'])
 		remove_tmp_files(config['tmp_dir'])
 		logmsg('Exiting now.')
 		# Exit with non-zero to indicate run didn't finish.
@@ -401,6 +567,7 @@ def main():
 		# has expired.
 		run_thread.join(10)
 
+	stop_mh_worker(config['mh_worker_pid'])
 	remove_tmp_files(config['tmp_dir'])
 	if run_succeeded.is_set():
 		logmsg('Run succeeded.')
@@ -7,6 +7,11 @@
 #include<cstring>
 #include <sstream>
 #include<map>
+#include<fcntl.h>
+#include<unistd.h>
+#include<sys/mman.h>
+#include<sys/stat.h>
+#include<algorithm>
 
 #include "mh.hpp"
 #include "util.hpp"
@@ -14,193 +19,1041 @@
 using namespace std;
 
 //  g++ -o mh.o  mh.cpp  util.cpp `gsl-config --cflags --libs`
-// ./mh.o 5000 100 11 1 8 4 ssm_data.txt cnv_data.txt c_tree_ssm_data_1.txt c_data_states_ssm_data_1.txt c_params.txt 5
+// add -fopenmp to evaluate the likelihood on multiple threads (MH_OPT_THREADS)
+// ./mh.o 11 1 5 ssm_data.txt cnv_data.txt c_state.bin
+// the sampler options (see mh_opt) are read from c_state.bin.
 //https://www.gnu.org/software/gsl/manual/html_node/Shared-Libraries.html
 
 
 // done for multi-sample
 int main(int argc, char* argv[]){
 
+	if (argc>1 && strcmp(argv[1],"--serve")==0)
+		return serve(argc,argv);
+
 	// parse command line args
 	struct config conf;
-	conf.MH_ITR=atoi(argv[1]);//5000
-	conf.MH_STD=atof(argv[2]);//100
-	conf.N_SSM_DATA=atoi(argv[3]);//12; // no. of ssm data points
-	conf.N_CNV_DATA=atoi(argv[4]);//1; // no. of cnv data points	
-	conf.NNODES=atoi(argv[5]); //17, no. of nodes in the tree
-	conf.TREE_HEIGHT=atoi(argv[6]);//6
+	conf.N_SSM_DATA=atoi(argv[1]);//12; // no. of ssm data points
+	conf.N_CNV_DATA=atoi(argv[2]);//1; // no. of cnv data points	
+	conf.NTPS = atoi(argv[3]); // no. of samples 
 	
 	// file names
-	char* FNAME_SSM_DATA = argv[7];
-	char* FNAME_CNV_DATA = argv[8];
-	char* FNAME_C_TREE = argv[9];
-	char* FNAME_C_DATA_STATES = argv[10];
-	char* FNAME_C_PARAMS = argv[11];
-	char* FNAME_C_MH_AR = argv[12];
-
-	conf.NTPS = atoi(argv[13]); // no. of samples 
+	char* FNAME_SSM_DATA = argv[4];
+	char* FNAME_CNV_DATA = argv[5];
+	char* FNAME_C_STATE = argv[6];
 	
 	struct datum *data = new datum[conf.N_SSM_DATA+conf.N_CNV_DATA];
 	load_ssm_data(FNAME_SSM_DATA, data,conf);
 	if (conf.N_CNV_DATA>0)
 		load_cnv_data(FNAME_CNV_DATA,data,conf);
 	
+	return run_exchange(FNAME_C_STATE,data,conf);
+}
+
+
+// persistent worker, used by params.MHWorker:
+// ./mh.o --serve 5 11 1 ssm_data.txt cnv_data.txt
+// the data files are loaded once. each line read from stdin then holds the
+// name of a c_state.bin file, and "done" is written to stdout once the sampled
+// params have been written to it. the worker exits when stdin is closed.
+int serve(int argc, char* argv[]){
+	struct config conf;
+	conf.NTPS=atoi(argv[2]);
+	conf.N_SSM_DATA=atoi(argv[3]);
+	conf.N_CNV_DATA=atoi(argv[4]);
+	char* FNAME_SSM_DATA = argv[5];
+	char* FNAME_CNV_DATA = argv[6];
 	
-	struct node *nodes = new node[conf.NNODES];
-	load_tree(FNAME_C_TREE,nodes,conf);		
+	struct datum *data = new datum[conf.N_SSM_DATA+conf.N_CNV_DATA];
+	load_ssm_data(FNAME_SSM_DATA, data,conf);
+	if (conf.N_CNV_DATA>0)
+		load_cnv_data(FNAME_CNV_DATA,data,conf);
 	
-	load_data_states(FNAME_C_DATA_STATES,data, nodes, conf);
+	string line;
+	while (getline(cin,line)){
+		if (run_exchange(line.c_str(),data,conf)!=0)
+			break;
+		cout<<"done"<<endl;
+	}
+	delete[] data;
+	return 0;
+}
+
+
+// binary exchange file written by params.write_exchange(). all arrays are
+// native-endian and laid out back to back after a header of EX_HEADER_LEN
+// ints (see exchange_header):
+//  double opts[MH_OPTS_LEN], stats[MH_STATS_LEN+ntps],
+//      params[nnodes*ntps], pi[nnodes*ntps]
+//  int ids[nnodes], hts[nnodes], child_ptr[nnodes+1], child_ids[nchild],
+//      data_ptr[nnodes+1], data_ids[ndata], state_ptr[nrows+1],
+//      state_dids[nrows], state_nids[nstates], state_copies[4*nstates]
+// nodes are in post-order. the file is mapped shared, so the sampled params,
+// pi and the sampler stats are written back in place.
+int map_exchange(const char* fname, struct exchange &ex){
+	int fd = open(fname,O_RDWR);
+	if (fd<0){
+		cerr<<"mh.o: cannot open "<<fname<<'\n';
+		return 1;
+	}
+	struct stat st;
+	fstat(fd,&st);
+	ex.size = st.st_size;
+	ex.addr = mmap(NULL,ex.size,PROT_READ|PROT_WRITE,MAP_SHARED,fd,0);
+	close(fd);
+	if (ex.addr==MAP_FAILED){
+		cerr<<"mh.o: cannot map "<<fname<<'\n';
+		return 1;
+	}
+	
+	ex.header = (int*) ex.addr;
+	if (ex.header[EX_MAGIC]!=EX_MAGIC_VALUE || ex.header[EX_VERSION]!=EX_VERSION_VALUE){
+		cerr<<"mh.o: "<<fname<<" is not a c_state file of this version\n";
+		munmap(ex.addr,ex.size);
+		return 1;
+	}
+	int nnodes=ex.header[EX_NNODES], ntps=ex.header[EX_NTPS];
+	
+	double *dp = (double*) (ex.header+EX_HEADER_LEN);
+	ex.opts = dp; dp += MH_OPTS_LEN;
+	ex.stats = dp; dp += MH_STATS_LEN+ntps;
+	ex.params = dp; dp += nnodes*ntps;
+	ex.pi = dp; dp += nnodes*ntps;
+	
+	int *ip = (int*) dp;
+	ex.ids = ip; ip += nnodes;
+	ex.hts = ip; ip += nnodes;
+	ex.child_ptr = ip; ip += nnodes+1;
+	ex.child_ids = ip; ip += ex.header[EX_NCHILD];
+	ex.data_ptr = ip; ip += nnodes+1;
+	ex.data_ids = ip; ip += ex.header[EX_NDATA];
+	ex.state_ptr = ip; ip += ex.header[EX_NROWS]+1;
+	ex.state_dids = ip; ip += ex.header[EX_NROWS];
+	ex.state_nids = ip; ip += ex.header[EX_NSTATES];
+	ex.state_copies = ip;
+	return 0;
+}
+
+void unmap_exchange(struct exchange &ex){
+	munmap(ex.addr,ex.size);
+}
+
+// samples new params for the tree state in the exchange file
+int run_exchange(const char* fname, struct datum data[], struct config conf){
+	struct exchange ex;
+	if (map_exchange(fname,ex)!=0)
+		return 1;
+	conf.NNODES=ex.header[EX_NNODES];
+	conf.TREE_HEIGHT=ex.header[EX_TREE_HEIGHT];
+	set_options(conf,ex.opts);
+	
+	struct tree_state ts;
+	struct node *nodes = build_tree(ts,conf,ex.ids,ex.params,ex.pi,ex.child_ptr,ex.child_ids,ex.data_ptr,ex.data_ids,ex.hts);
+	struct state_matrix sm;
+	build_data_states(sm,ts,conf,ex.header[EX_NROWS],ex.state_ptr,ex.state_dids,ex.state_nids,ex.state_copies);
+	build_suff_stats(nodes,data,conf);
 	
 	//start MH loop
-	mh_loop(nodes,data,FNAME_C_MH_AR,conf);
+	mh_loop(ts,nodes,data,sm,conf,ex.stats);
+	
+	// write updated params back to the exchange file
+	get_params(ts,conf,ex.params,ex.pi);
+	delete[] nodes;
+	unmap_exchange(ex);
+	return 0;
+}
+
+// builds the nodes from the post-ordered node table, and ts with the params
+// and the tree's topology. params and pi are nnodes x ntps (row-major);
+// children and data of node i are child_ids[child_ptr[i]:child_ptr[i+1]] and
+// data_ids[data_ptr[i]:data_ptr[i+1]].
+struct node* build_tree(struct tree_state &ts, struct config conf, const int* ids, const double* params, const double* pi, const int* child_ptr, const int* child_ids, const int* data_ptr, const int* data_ids, const int* hts){
+	int NTPS = conf.NTPS, NNODES = conf.NNODES;
+	struct node *nodes = new node[NNODES];
+	for(int i=0;i<NNODES;i++){
+		nodes[i].id = ids[i];
+		nodes[i].ndata = data_ptr[i+1]-data_ptr[i];
+		for(int j=data_ptr[i];j<data_ptr[i+1];j++)
+			nodes[i].dids.push_back(data_ids[j]);
+		nodes[i].ht = hts[i];
+		ts.index[ids[i]] = i;
+	}
 	
-	// write updated params to disk
-	write_params(FNAME_C_PARAMS,nodes,conf);		
+	ts.param.resize(NTPS*NNODES);
+	ts.pi.resize(NTPS*NNODES);
+	for(int i=0;i<NNODES;i++)
+		for(int tp=0;tp<NTPS;tp++){
+			ts.param[tp*NNODES+i] = params[i*NTPS+tp];
+			ts.pi[tp*NNODES+i] = pi[i*NTPS+tp];
+		}
+	ts.param1.assign(NTPS*NNODES,0.0);
+	ts.pi1.assign(NTPS*NNODES,0.0);
 	
-	return 0;	
+	ts.child_ptr.assign(child_ptr,child_ptr+NNODES+1);
+	ts.child_idx.resize(child_ptr[NNODES]);
+	ts.parent.assign(NNODES,-1);
+	ts.first.resize(NNODES);
+	for(int i=0;i<NNODES;i++){
+		ts.first[i]=i;
+		for(int c=child_ptr[i];c<child_ptr[i+1];c++){
+			int j=ts.index[child_ids[c]];
+			ts.child_idx[c]=j;
+			ts.parent[j]=i;
+			ts.first[i]=min(ts.first[i],ts.first[j]);
+		}
+	}
+	return nodes;
+}
+
+// data states in CSR form: row r holds the states of SSM state_dids[r], one
+// per node, in state_nids/state_copies[state_ptr[r]:state_ptr[r+1]]. copies
+// are (nr,nv) maternal followed by (nr,nv) paternal. these are kept as they
+// are in sm, with node ids mapped to indices into nodes.
+void build_data_states(struct state_matrix &sm, struct tree_state &ts, struct config conf, int nrows, const int* state_ptr, const int* state_dids, const int* state_nids, const int* state_copies){
+	int nstates = state_ptr[nrows];
+	sm.dids.assign(state_dids,state_dids+nrows);
+	sm.ptr.assign(state_ptr,state_ptr+nrows+1);
+	sm.cols.resize(nstates);
+	sm.nr1.resize(nstates);
+	sm.nv1.resize(nstates);
+	sm.nr2.resize(nstates);
+	sm.nv2.resize(nstates);
+	for(int s=0;s<nstates;s++){
+		sm.cols[s] = ts.index[state_nids[s]];
+		sm.nr1[s] = state_copies[4*s];
+		sm.nv1[s] = state_copies[4*s+1];
+		sm.nr2[s] = state_copies[4*s+2];
+		sm.nv2[s] = state_copies[4*s+3];
+	}
+	
+	sm.rows.resize(nstates);
+	for(int r=0;r<nrows;r++)
+		for(int s=sm.ptr[r];s<sm.ptr[r+1];s++)
+			sm.rows[s] = r;
+	sm.col_ptr.assign(conf.NNODES+1,0);
+	for(int s=0;s<nstates;s++)
+		sm.col_ptr[sm.cols[s]+1]++;
+	for(int i=0;i<conf.NNODES;i++)
+		sm.col_ptr[i+1] += sm.col_ptr[i];
+	sm.col_idx.resize(nstates);
+	vector<int> next(sm.col_ptr.begin(),sm.col_ptr.end()-1);
+	for(int s=0;s<nstates;s++)
+		sm.col_idx[next[sm.cols[s]]++] = s;
+}
+
+// data without a CNV depend on the node's param only through
+// mu = (1-phi)*mu_r + phi*mu_v, so their summed log-likelihood is
+// a*log(mu) + (d-a)*log(1-mu) + const. these are grouped by (mu_r,mu_v) so
+// that param_post() scores each group at once. data with a CNV are scored
+// from the state_matrix instead.
+void build_suff_stats(struct node nodes[], struct datum data[], struct config conf){
+	int NTPS = conf.NTPS;
+	for(int i=0;i<conf.NNODES;i++){
+		map <pair<double,double>, int> group;
+		for(int j=0;j<nodes[i].ndata;j++){
+			struct datum *dat = &data[nodes[i].dids[j]];
+			if(dat->cnv!=NULL)
+				continue; // scored through the state_matrix
+			pair<double,double> key(dat->mu_r,dat->mu_v);
+			if(group.count(key)==0){
+				group[key]=nodes[i].ss.size();
+				struct suff_stat ss;
+				ss.mu_r = dat->mu_r;
+				ss.mu_v = dat->mu_v;
+				ss.a.assign(NTPS,0.0);
+				ss.b.assign(NTPS,0.0);
+				ss.c.assign(NTPS,0.0);
+				nodes[i].ss.push_back(ss);
+			}
+			struct suff_stat *ss = &nodes[i].ss[group[key]];
+			for(int tp=0;tp<NTPS;tp++){
+				ss->a[tp] += dat->a[tp];
+				ss->b[tp] += dat->d[tp]-dat->a[tp];
+				ss->c[tp] += dat->log_bin_norm_const[tp];
+			}
+		}
+	}
+}
+
+void get_params(struct tree_state &ts, struct config conf, double* params, double* pi){
+	int NTPS = conf.NTPS, NNODES = conf.NNODES;
+	for(int i=0;i<NNODES;i++){
+		for(int tp=0;tp<NTPS;tp++){
+			params[i*NTPS+tp] = ts.param[tp*NNODES+i];
+			pi[i*NTPS+tp] = ts.pi[tp*NNODES+i];
+		}
+	}
+}
+
+
+// in-process interface, used by mh_native.py when this file is built as a
+// shared library:
+//  g++ -o libmh.so -shared -fPIC -O3 -fopenmp mh.cpp util.cpp `gsl-config --cflags --libs`
+// the data are loaded once per run with mh_load_data(); every MCMC iteration
+// then calls mh_run() with the current tree and data states.
+struct mh_data{
+	struct config conf;
+	struct datum *data;
+};
+
+// a,d are n_data x ntps (row-major), cnv_link holds the datum index of the CNV
+// each SSM overlaps (-1 if none)
+extern "C" void* mh_load_data(int n_ssm, int n_cnv, int ntps, const int* a, const int* d, const double* mu_r, const double* mu_v, const int* cnv_link){
+	struct mh_data *md = new mh_data;
+	md->conf.N_SSM_DATA = n_ssm;
+	md->conf.N_CNV_DATA = n_cnv;
+	md->conf.NTPS = ntps;
+	md->data = new datum[n_ssm+n_cnv];
+	
+	for(int i=0;i<n_ssm+n_cnv;i++){
+		struct datum *dat = &md->data[i];
+		dat->id = i;
+		for(int tp=0;tp<ntps;tp++){
+			dat->a.push_back(a[i*ntps+tp]);
+			dat->d.push_back(d[i*ntps+tp]);
+			dat->log_bin_norm_const.push_back(log_bin_coeff(dat->d[tp],dat->a[tp]));
+		}
+		dat->mu_r = mu_r[i];
+		dat->mu_v = mu_v[i];
+		dat->cnv = NULL;
+	}
+	for(int i=0;i<n_ssm;i++)
+		if(cnv_link[i]>=0)
+			md->data[i].cnv = &md->data[cnv_link[i]];
+	return md;
+}
+
+extern "C" void mh_free_data(void* handle){
+	struct mh_data *md = (struct mh_data*) handle;
+	delete[] md->data;
+	delete md;
+}
+
+// takes the same arrays as the exchange file (see map_exchange()). params and
+// pi are overwritten with the sampled values and stats (MH_STATS_LEN+ntps
+// doubles) is filled in. returns the acceptance ratio.
+extern "C" double mh_run(void* handle, const double* opts, int nnodes, const int* node_ids, double* params, double* pi, const int* child_ptr, const int* child_ids, const int* data_ptr, const int* data_ids, const int* hts, int nrows, const int* state_ptr, const int* state_dids, const int* state_nids, const int* state_copies, double* stats){
+	struct mh_data *md = (struct mh_data*) handle;
+	struct config conf = md->conf;
+	set_options(conf,opts);
+	conf.NNODES = nnodes;
+	
+	struct tree_state ts;
+	struct node *nodes = build_tree(ts,conf,node_ids,params,pi,child_ptr,child_ids,data_ptr,data_ids,hts);
+	struct state_matrix sm;
+	build_data_states(sm,ts,conf,nrows,state_ptr,state_dids,state_nids,state_copies);
+	build_suff_stats(nodes,md->data,conf);
+	
+	double ratio = mh_loop(ts,nodes,md->data,sm,conf,stats);
+	
+	get_params(ts,conf,params,pi);
+	delete[] nodes;
+	return ratio;
+}
+
+
+// sampler options, as packed by params.pack_mh_opts()
+void set_options(struct config &conf, const double opts[]){
+	conf.MH_ITR = (int) opts[MH_OPT_ITR];
+	conf.MH_STD = opts[MH_OPT_STD];
+	conf.NTHREADS = (int) opts[MH_OPT_THREADS];
+	conf.MH_BLOCKED = (int) opts[MH_OPT_BLOCKED];
+	conf.MH_ADAPTIVE = (int) opts[MH_OPT_ADAPTIVE];
+	conf.MH_MIN_ITR = (int) opts[MH_OPT_MIN_ITR];
+	conf.MH_TARGET_ACC = opts[MH_OPT_TARGET_ACC];
+	conf.MH_TARGET_ESS = opts[MH_OPT_TARGET_ESS];
+	conf.MH_PAIR_RATE = opts[MH_OPT_PAIR_RATE];
+	conf.MH_SUBTREE_RATE = opts[MH_OPT_SUBTREE_RATE];
+	conf.MH_SEED = (unsigned long) opts[MH_OPT_SEED];
+	conf.MH_DELAYED = (int) opts[MH_OPT_DELAYED];
+	conf.MH_TRIES = max(1,(int) opts[MH_OPT_TRIES]);
+	if (conf.MH_TRIES>1)
+		conf.MH_DELAYED=0; // not combined with multiple tries
 }
 
 
 // done for multi-sample
-void mh_loop(struct node nodes[],struct datum data[],char* fname, struct config conf){
+// the likelihood and the dirichlet correction factor across samples. with
+// conf.MH_BLOCKED, the proposal of each sample is accepted or rejected on its
+// own, otherwise all of them are accepted or rejected jointly.
+// each iteration proposes from one of the kernels in mh_kernel, the local ones
+// with probabilities MH_PAIR_RATE and MH_SUBTREE_RATE. these pick a non-root
+// node uniformly and are scored from cached per-node and per-row terms (see
+// local_state), which are refreshed after a global move is accepted.
+// with conf.MH_DELAYED, global proposals are first screened on the LLH_SUFF
+// part of the likelihood, and only those passing get the LLH_CNV part
+// evaluated (delayed acceptance, Christen & Fox 2005). the chain still
+// targets the full posterior.
+// with conf.MH_TRIES>1, each global move is a multiple-try metropolis step
+// instead (see mtm_propose()).
+// with conf.MH_ADAPTIVE, MH_STD is adapted towards MH_TARGET_ACC by
+// robbins-monro steps on log(MH_STD), and the loop stops early once
+// MH_MIN_ITR iterations are done and the effective sample size of the
+// log-likelihood trace reaches MH_TARGET_ESS. MH_ITR is then the maximum.
+// the per-sample log posterior and dirichlet correction terms of the current
+// params are cached and only refreshed when a proposal is accepted, so each
+// iteration evaluates the likelihood of the proposal alone. fills stats
+// (see mh_stat) and returns the acceptance ratio.
+double mh_loop(struct tree_state &ts, struct node nodes[],struct datum data[], struct state_matrix &sm, struct config conf, double stats[]){
 	gsl_rng *rand = gsl_rng_alloc(gsl_rng_mt19937);
+	if (conf.MH_SEED!=0)
+		gsl_rng_set(rand,conf.MH_SEED);
+	int NNODES=conf.NNODES, NTPS=conf.NTPS;
 	double ratio=0.0;
-	for (int itr=0;itr<conf.MH_ITR;itr++){
+	long llh_evals=0;
+	double acc[NTPS]; // accepted proposals per sample
+	for(int tp=0;tp<NTPS;tp++)
+		acc[tp]=0.0;
+	double kernel_moves[MH_NKERNELS], kernel_acc[MH_NKERNELS];
+	for(int k=0;k<MH_NKERNELS;k++)
+		kernel_moves[k]=kernel_acc[k]=0.0;
+	double stage_rej[2]={0.0,0.0}; // global proposals rejected in either stage of MH_DELAYED
+	int itrs=0; // iterations done
+	double log_std=log(conf.MH_STD);
+	vector<double> trace; // log-likelihood of the current params
+	trace.reserve(conf.MH_ITR);
 	
-		for(int tp=0;tp<conf.NTPS;tp++)
-			sample_cons_params(nodes,conf,rand,tp);		
-			
-		double a = multi_param_post(nodes,data,0,conf)-multi_param_post(nodes,data,1,conf);			
+	struct local_state ls;
+	int local = NNODES>1 && conf.MH_PAIR_RATE+conf.MH_SUBTREE_RATE>0;
+	if (local)
+		init_local_state(ls,sm,conf);
+	struct mtm_state mt;
+	if (conf.MH_TRIES>1)
+		init_mtm_state(mt,conf);
+	
+	// current (post, dir_norm, log_pi) and proposed (*_new) terms, per sample.
+	// local moves put the change in the log-likelihood in post_new.
+	double post[NTPS],post_new[NTPS];
+	double dir_norm[NTPS],dir_norm_new[NTPS];
+	double log_pi[NTPS*NNODES],log_pi_new[NTPS*NNODES];
+	double suff[NTPS],suff_new[NTPS]; // LLH_SUFF part of post, with MH_DELAYED
+	int all[NTPS];
+	multi_param_post(ts,nodes,data,sm,1,conf,post);
+	if (conf.MH_DELAYED)
+		multi_param_post(ts,nodes,data,sm,1,conf,suff,LLH_SUFF);
+	for(int tp=0;tp<NTPS;tp++)
+		all[tp]=1;
+	for(int tp=0;tp<NTPS;tp++)
+		dir_norm[tp]=dirichlet_terms(NNODES,conf.MH_STD,&ts.pi[tp*NNODES],&log_pi[tp*NNODES]);
+	llh_evals++;
+	
+	for (int itr=0;itr<conf.MH_ITR;itr++){
+		int kernel=MH_KERNEL_GLOBAL, c=0;
+		if (local){
+			double r = gsl_rng_uniform(rand);
+			if (r<conf.MH_PAIR_RATE)
+				kernel=MH_KERNEL_PAIR;
+			else if (r<conf.MH_PAIR_RATE+conf.MH_SUBTREE_RATE)
+				kernel=MH_KERNEL_SUBTREE;
+			if (kernel!=MH_KERNEL_GLOBAL)
+				c = gsl_rng_uniform_int(rand,NNODES-1); // the root comes last
+		}
 		
-		//cout<<multi_param_post(nodes,data,0,conf)-multi_param_post(nodes,data,1,conf)<<'\n';
+		double a[NTPS]; // log acceptance ratios
+		if (kernel==MH_KERNEL_GLOBAL && conf.MH_TRIES>1)
+			mtm_propose(mt,ts,nodes,data,sm,conf,rand,post,dir_norm,log_pi,post_new,dir_norm_new,log_pi_new,a);
+		else if (kernel==MH_KERNEL_GLOBAL){
+			for(int tp=0;tp<NTPS;tp++)
+				sample_cons_params(ts,conf,rand,tp);		
+			
+			// with MH_DELAYED, only the screening part for now
+			multi_param_post(ts,nodes,data,sm,0,conf,post_new,conf.MH_DELAYED ? LLH_SUFF : LLH_ALL);
+			
+			// loop over samples, apply dirichlet correction terms, update a
+			for(int tp=0; tp<NTPS;tp++){		
+				const double *pi=&ts.pi[tp*NNODES], *pi_new=&ts.pi1[tp*NNODES];
+				double *lp=&log_pi[tp*NNODES], *lp_new=&log_pi_new[tp*NNODES];
+				dir_norm_new[tp]=dirichlet_terms(NNODES,conf.MH_STD,pi_new,lp_new);
+				
+				// apply the dirichlet correction terms
+				// log Dir(pi | MH_STD*pi_new) - log Dir(pi_new | MH_STD*pi)
+				a[tp] = post_new[tp]-(conf.MH_DELAYED ? suff[tp] : post[tp]) + dir_norm_new[tp]-dir_norm[tp];
+				for(int i=0;i<NNODES;i++)
+					a[tp] += (conf.MH_STD*pi_new[i]-1)*lp[i] - (conf.MH_STD*pi[i]-1)*lp_new[i];
+			}
+		}else{
+			if (!ls.valid)
+				fill_local_llh(ls,ts,nodes,data,sm,conf);
+			for(int tp=0;tp<NTPS;tp++){
+				a[tp] = sample_local_params(ts,conf,rand,kernel,c,tp);
+				post_new[tp] = isinf(a[tp]) ? 0.0 : local_post_delta(ls,ts,nodes,data,sm,conf,kernel,c,tp);
+				a[tp] += post_new[tp];
+			}
+		}
 		
-		// loop over samples, apply dirichlet correction terms, update a
-		double theta[conf.NNODES];// dirichlet params
-		double pi[conf.NNODES],pi_new[conf.NNODES];
-		for(int tp=0; tp<conf.NTPS;tp++){		
+		int accepted[NTPS];
+		mh_decide(conf,rand,a,all,accepted);
+		if (kernel==MH_KERNEL_GLOBAL && conf.MH_DELAYED){
+			// delayed acceptance: the proposals that passed the LLH_SUFF screen
+			// are accepted with the ratio of the LLH_CNV parts, which makes up
+			// the full metropolis-hastings ratio
+			int screened[NTPS], any=0;
+			for(int tp=0;tp<NTPS;tp++){
+				screened[tp]=accepted[tp];
+				any|=accepted[tp];
+				stage_rej[0]+=!accepted[tp];
+				suff_new[tp]=post_new[tp];
+			}
+			llh_evals++; // the LLH_SUFF screen
+			if (any){
+				double cnv_new[NTPS], a2[NTPS];
+				multi_param_post(ts,nodes,data,sm,0,conf,cnv_new,LLH_CNV,screened);
+				llh_evals++;
+				for(int tp=0;tp<NTPS;tp++){
+					a2[tp] = cnv_new[tp]-(post[tp]-suff[tp]);
+					post_new[tp] = suff_new[tp]+cnv_new[tp];
+				}
+				mh_decide(conf,rand,a2,screened,accepted);
+				for(int tp=0;tp<NTPS;tp++)
+					stage_rej[1]+=screened[tp] && !accepted[tp];
+			}
+		}else
+			llh_evals += kernel==MH_KERNEL_GLOBAL ? 2*conf.MH_TRIES-1 : 1;
 		
-			get_pi(nodes,pi_new,conf,0,tp);
-			get_pi(nodes,pi,conf,1,tp);		
+		int naccepted=0;
+		for(int tp=0;tp<NTPS;tp++){
+			if (!accepted[tp])
+				continue;
+			acc[tp]+=1;
+			naccepted++;
+			if (kernel==MH_KERNEL_GLOBAL){
+				accept(ts,conf,tp,post,post_new,dir_norm,dir_norm_new,log_pi,log_pi_new);
+				if (conf.MH_DELAYED)
+					suff[tp]=suff_new[tp];
+				ls.valid=0;
+			}else{
+				double suff_delta=accept_local(ls,ts,conf,kernel,c,tp,post,post_new,dir_norm,log_pi);
+				if (conf.MH_DELAYED)
+					suff[tp]+=suff_delta;
+			}
+		}
+		kernel_moves[kernel]+=1;
+		kernel_acc[kernel]+=(double)naccepted/NTPS;
+		itrs++;
+		double llh=0.0;
+		for(int tp=0;tp<NTPS;tp++)
+			llh+=post[tp];
+		trace.push_back(llh);
 		
-			// apply the dirichlet correction terms			
-			for(int i=0;i<conf.NNODES;i++)
-				theta[i]=conf.MH_STD*pi_new[i];
-			a += gsl_ran_dirichlet_lnpdf(conf.NNODES,theta,pi);
-			
-			for(int i=0;i<conf.NNODES;i++)
-				theta[i]=conf.MH_STD*pi[i];
-			a -= gsl_ran_dirichlet_lnpdf(conf.NNODES,theta,pi_new);
+		if (conf.MH_ADAPTIVE){
+			// a larger concentration gives smaller moves, so rejections raise it
+			log_std += (conf.MH_TARGET_ACC - (double)naccepted/NTPS)/pow(itrs,MH_ADAPT_DECAY);
+			log_std = min(max(log_std,log(MH_STD_MIN)),log(MH_STD_MAX));
+			conf.MH_STD = exp(log_std);
+			// the cached dirichlet terms depend on MH_STD
+			for(int tp=0;tp<NTPS;tp++)
+				dir_norm[tp]=dirichlet_terms(NNODES,conf.MH_STD,&ts.pi[tp*NNODES],&log_pi[tp*NNODES]);
+			if (itrs>=conf.MH_MIN_ITR && itrs%MH_ESS_CHECK==0 && batch_means_ess(trace)>=conf.MH_TARGET_ESS)
+				break;
 		}
-			
+	}
+	gsl_rng_free(rand);
+	
+	for(int i=0;i<MH_STATS_LEN;i++)
+		stats[i]=0.0;
+	for(int tp=0;tp<NTPS;tp++){
+		stats[MH_STATS_LEN+tp]=acc[tp]/itrs;
+		ratio+=stats[MH_STATS_LEN+tp]/NTPS;
+	}
+	stats[MH_STAT_ACC]=ratio;
+	stats[MH_STAT_LLH_EVALS]=llh_evals;
+	stats[MH_STAT_ITERS]=itrs;
+	stats[MH_STAT_STD]=conf.MH_STD;
+	stats[MH_STAT_ESS]=batch_means_ess(trace);
+	for(int k=0;k<MH_NKERNELS;k++){
+		stats[MH_STAT_GLOBAL_MOVES+2*k]=kernel_moves[k];
+		if (kernel_moves[k]>0)
+			stats[MH_STAT_GLOBAL_ACC+2*k]=kernel_acc[k]/kernel_moves[k];
+	}
+	if (conf.MH_DELAYED && kernel_moves[MH_KERNEL_GLOBAL]>0){
+		stats[MH_STAT_STAGE1_REJ]=stage_rej[0]/(NTPS*kernel_moves[MH_KERNEL_GLOBAL]);
+		stats[MH_STAT_STAGE2_REJ]=stage_rej[1]/(NTPS*kernel_moves[MH_KERNEL_GLOBAL]);
+	}
+	return ratio;
+}
+
+// effective sample size of x, estimated from the variance of the means of
+// about sqrt(n) batches of sqrt(n) values. 0 if x is constant.
+double batch_means_ess(const vector<double> &x){
+	int n=x.size();
+	int b=(int)sqrt((double)n);
+	if (b<2)
+		return 0.0;
+	int nb=n/b;
+	// values are taken relative to x[0], so that a constant x (nothing
+	// accepted) gives exactly zero variance
+	double mean=0.0;
+	for(int i=0;i<nb*b;i++)
+		mean+=x[i]-x[0];
+	mean/=nb*b;
+	double var=0.0,var_bm=0.0;
+	for(int k=0;k<nb;k++){
+		double bm=0.0;
+		for(int i=k*b;i<(k+1)*b;i++){
+			bm+=x[i]-x[0];
+			var+=(x[i]-x[0]-mean)*(x[i]-x[0]-mean);
+		}
+		bm/=b;
+		var_bm+=(bm-mean)*(bm-mean);
+	}
+	if (!(var>0.0))
+		return 0.0;
+	var/=nb*b-1;
+	var_bm/=nb-1;
+	if (var_bm==0.0)
+		return n;
+	return min((double)n,n*var/(b*var_bm));
+}
+
+// accept/reject decisions for the samples with todo[tp] set, from their log
+// acceptance ratios a: one decision per sample with conf.MH_BLOCKED, otherwise
+// a single one on the sum of a
+void mh_decide(struct config conf, gsl_rng *rand, const double a[], const int todo[], int accepted[]){
+	if (conf.MH_BLOCKED){
+		for(int tp=0;tp<conf.NTPS;tp++){
+			accepted[tp]=0;
+			if (!todo[tp])
+				continue;
+			double r = gsl_rng_uniform_pos(rand);
+			accepted[tp] = log(r)<a[tp];
+		}
+	}else{
+		double a_joint=0.0;
+		for(int tp=0;tp<conf.NTPS;tp++)
+			if (todo[tp])
+				a_joint+=a[tp];
 		double r = gsl_rng_uniform_pos(rand);
-		//cout<<log(r)<<'\t'<<a<<'\n';
-		if (log(r)<a){
-			ratio+=1;
-			update_params(nodes,conf);			
+		//cout<<log(r)<<'\t'<<a_joint<<'\n';
+		for(int tp=0;tp<conf.NTPS;tp++)
+			accepted[tp] = todo[tp] && log(r)<a_joint;
+	}
+}
+
+// room for conf.MH_TRIES candidates of all samples
+void init_mtm_state(struct mtm_state &mt, struct config conf){
+	int n=conf.MH_TRIES*conf.NTPS;
+	mt.pi.resize(n*conf.NNODES);
+	mt.param.resize(n*conf.NNODES);
+	mt.log_pi.resize(n*conf.NNODES);
+	mt.post.resize(n);
+	mt.lw.resize(n);
+}
+
+// multiple-try metropolis (Liu, Liang & Wong 2000) proposal of the global
+// kernel, with weights w(y|x) = p(y) q(x|y) for the likelihood p and the
+// dirichlet proposal q. draws conf.MH_TRIES candidates around the current pi
+// and picks one with probability proportional to its weight, then draws
+// MH_TRIES-1 references around the pick, which with the current pi give the
+// weights of the reverse move. the candidates, then the references, are
+// scored in one batch_post() each, so that they are spread over all threads.
+// the pick goes into ts.pi1/param1 and post_new, dir_norm_new and
+// log_pi_new. a gets the log acceptance ratio of each sample with
+// conf.MH_BLOCKED, where each sample picks its own candidate, otherwise the
+// joint one in a[0] and 0 in the rest.
+void mtm_propose(struct mtm_state &mt, struct tree_state &ts, struct node nodes[], struct datum data[], struct state_matrix &sm, struct config conf, gsl_rng *rand, const double post[], const double dir_norm[], const double log_pi[], double post_new[], double dir_norm_new[], double log_pi_new[], double a[]){
+	int K=conf.MH_TRIES, NTPS=conf.NTPS, NNODES=conf.NNODES;
+	double std=conf.MH_STD;
+	const double *pi=&ts.pi[0], *pi_pick=&ts.pi1[0];
+	double lw_sum[2][NTPS], lw[K];
+	int pick[NTPS];
+	
+	for(int stage=0;stage<2;stage++){
+		// the candidates around pi, then the references around the pick
+		int n = stage==0 ? K : K-1;
+		for(int k=0;k<n;k++)
+			for(int tp=0;tp<NTPS;tp++){
+				int bt=k*NTPS+tp;
+				const double *center = stage==0 ? &pi[tp*NNODES] : &pi_pick[tp*NNODES];
+				sample_pi(ts,conf,rand,center,&mt.pi[bt*NNODES],&mt.param[bt*NNODES]);
+			}
+		batch_post(ts,nodes,data,sm,conf,n,&mt.param[0],&mt.pi[0],&mt.post[0]);
+		
+		// log w(x'|x) of each draw x' around x
+		for(int k=0;k<K;k++)
+			for(int tp=0;tp<NTPS;tp++){
+				int bt=k*NTPS+tp;
+				const double *x = stage==0 ? &log_pi[tp*NNODES] : &log_pi_new[tp*NNODES];
+				double *lx = &mt.log_pi[bt*NNODES];
+				const double *y = &mt.pi[bt*NNODES];
+				if (k==n){
+					// the current pi is the last reference
+					mt.lw[bt] = post[tp] + dir_norm[tp];
+					y = &pi[tp*NNODES];
+				}else
+					mt.lw[bt] = mt.post[bt] + dirichlet_terms(NNODES,std,y,lx);
+				for(int i=0;i<NNODES;i++)
+					mt.lw[bt] += (std*y[i]-1)*x[i];
+			}
+		
+		if (conf.MH_BLOCKED){
+			for(int tp=0;tp<NTPS;tp++){
+				for(int k=0;k<K;k++)
+					lw[k]=mt.lw[k*NTPS+tp];
+				lw_sum[stage][tp]=logsumexp(lw,K);
+				if (stage==0)
+					pick[tp]=mtm_pick(rand,lw,K,lw_sum[stage][tp]);
+			}
+		}else{
+			for(int k=0;k<K;k++){
+				lw[k]=0.0;
+				for(int tp=0;tp<NTPS;tp++)
+					lw[k]+=mt.lw[k*NTPS+tp];
+			}
+			lw_sum[stage][0]=logsumexp(lw,K);
+			if (stage==0){
+				pick[0]=mtm_pick(rand,lw,K,lw_sum[stage][0]);
+				for(int tp=1;tp<NTPS;tp++)
+					pick[tp]=pick[0];
+			}
 		}
+		
+		if (stage==0)
+			for(int tp=0;tp<NTPS;tp++){
+				int bt=pick[tp]*NTPS+tp;
+				memcpy(&ts.pi1[tp*NNODES],&mt.pi[bt*NNODES],NNODES*sizeof(double));
+				memcpy(&ts.param1[tp*NNODES],&mt.param[bt*NNODES],NNODES*sizeof(double));
+				post_new[tp]=mt.post[bt];
+				dir_norm_new[tp]=dirichlet_terms(NNODES,std,&mt.pi[bt*NNODES],&log_pi_new[tp*NNODES]);
+			}
 	}
-	gsl_rng_free(rand);
 	
-	ofstream dfile;
-	dfile.open(fname);	
-	dfile<<ratio/conf.MH_ITR;	
-	dfile.close();	
+	for(int tp=0;tp<NTPS;tp++)
+		a[tp] = conf.MH_BLOCKED ? lw_sum[0][tp]-lw_sum[1][tp] : 0.0;
+	if (!conf.MH_BLOCKED)
+		a[0] = lw_sum[0][0]-lw_sum[1][0];
+}
+
+// index drawn with probability exp(lw[k]-lw_sum)
+int mtm_pick(gsl_rng *rand, const double lw[], int n, double lw_sum){
+	double r = gsl_rng_uniform(rand), cum=0.0;
+	for(int k=0;k<n-1;k++){
+		cum+=exp(lw[k]-lw_sum);
+		if (r<cum)
+			return k;
+	}
+	return n-1;
+}
 
+// makes the proposed params of sample tp current, along with their cached terms
+void accept(struct tree_state &ts, struct config conf, int tp, double post[], const double post_new[], double dir_norm[], const double dir_norm_new[], double log_pi[], const double log_pi_new[]){
+	update_params(ts,conf,tp);
+	post[tp]=post_new[tp];
+	dir_norm[tp]=dir_norm_new[tp];
+	memcpy(&log_pi[tp*conf.NNODES],&log_pi_new[tp*conf.NNODES],conf.NNODES*sizeof(double));
 }
 
+// log normalizer of a dirichlet with parameters std*pi, also filling log_pi
+double dirichlet_terms(int size, double std, const double pi[], double log_pi[]){
+	double norm=0.0,sum=0.0;
+	for(int i=0;i<size;i++){
+		double alpha=std*pi[i];
+		norm-=lgamma(alpha);
+		sum+=alpha;
+		log_pi[i]=log(pi[i]);
+	}
+	return norm+lgamma(sum);
+}
 
-// done for multi-sample
-void sample_cons_params(struct node nodes[], struct config conf, gsl_rng *rand, int tp){
 
-	map <int, int> node_id_map;
-	for(int i=0;i<conf.NNODES;i++)
-		node_id_map[nodes[i].id]=i;
+// room for the cached terms, which fill_local_llh() fills in. the touched
+// rows of a proposal are at most all rows, so proposals allocate nothing.
+void init_local_state(struct local_state &ls, struct state_matrix &sm, struct config conf){
+	int NNODES=conf.NNODES, NTPS=conf.NTPS, nrows=sm.dids.size();
+	ls.valid=0;
+	ls.node_ll.resize(NTPS*NNODES);
+	ls.node_ll_new.resize(NTPS*NNODES);
+	ls.y.resize(4*NTPS*nrows);
+	ls.row_ll.resize(NTPS*nrows);
+	ls.touched.resize(NTPS);
+	ls.y_new.resize(NTPS);
+	ls.row_ll_new.resize(NTPS);
+	for(int tp=0;tp<NTPS;tp++){
+		ls.touched[tp].reserve(nrows);
+		ls.y_new[tp].reserve(4*nrows);
+		ls.row_ll_new[tp].reserve(nrows);
+	}
+	ls.dy.assign(4*nrows,0.0);
+	ls.mark.assign(nrows,0);
+}
+
+// scores every node and state_matrix row under the current params
+void fill_local_llh(struct local_state &ls, struct tree_state &ts, struct node nodes[], struct datum data[], struct state_matrix &sm, struct config conf){
+	int NNODES=conf.NNODES, nrows=sm.dids.size();
+	for(int tp=0;tp<conf.NTPS;tp++){
+		for(int i=0;i<NNODES;i++)
+			ls.node_ll[tp*NNODES+i]=node_post(&nodes[i],ts.param[tp*NNODES+i],tp);
+		double *y=&ls.y[4*tp*nrows];
+		state_spmv(sm,&ts.pi[tp*NNODES],0,nrows,y);
+		for(int r=0;r<nrows;r++)
+			ls.row_ll[tp*nrows+r]=data[sm.dids[r]].log_cnv_ll(y[4*r],y[4*r+1],y[4*r+2],y[4*r+3],tp);
+	}
+	ls.valid=1;
+}
+
+// proposes new pi for sample tp that move mass between node c and its parent.
+// MH_KERNEL_PAIR changes the pi of c alone, MH_KERNEL_SUBTREE scales the pi
+// of the whole subtree of c. the fraction u of their joint mass that lies
+// below the parent is drawn from a beta centred on its current value, the
+// two-node version of the global dirichlet. the proposal goes to pi1/param1 of
+// the nodes it changes. returns the log proposal ratio, including the
+// jacobian (k-1)*log(u'/u) of scaling k pi, or -inf if a new pi is not > 0.
+double sample_local_params(struct tree_state &ts, struct config conf, gsl_rng *rand, int kernel, int c, int tp){
+	int p=ts.parent[c];
+	int lo = kernel==MH_KERNEL_SUBTREE ? ts.first[c] : c; // scaled nodes are lo..c
+	double *pi=&ts.pi[tp*conf.NNODES], *param=&ts.param[tp*conf.NNODES];
+	double *pi1=&ts.pi1[tp*conf.NNODES], *param1=&ts.param1[tp*conf.NNODES];
+	double m = kernel==MH_KERNEL_SUBTREE ? param[c] : pi[c];
+	double s = m+pi[p];
+	double u = m/s;
+	double u_new = gsl_ran_beta(rand,conf.MH_STD*u+1,conf.MH_STD*(1-u)+1);
+	double m_new = s*u_new, scale = m_new/m;
+	if (!(m_new>0 && s-m_new>0))
+		return -INFINITY;
+	for(int i=lo;i<=c;i++){
+		pi1[i]=pi[i]*scale;
+		if (!(pi1[i]>0))
+			return -INFINITY;
+		if (kernel==MH_KERNEL_SUBTREE)
+			param1[i]=param[i]*scale;
+		else
+			param1[i]=param[i]+m_new-m;
+	}
+	pi1[p]=s-m_new;
+	param1[p]=param[p];
+	return (c-lo)*log(u_new/u)
+		+ log_beta_pdf(u,conf.MH_STD*u_new+1,conf.MH_STD*(1-u_new)+1)
+		- log_beta_pdf(u_new,conf.MH_STD*u+1,conf.MH_STD*(1-u)+1);
+}
+
+double log_beta_pdf(double x, double a, double b){
+	return lgamma(a+b)-lgamma(a)-lgamma(b) + (a-1)*log(x) + (b-1)*log(1-x);
+}
+
+// change in the log-likelihood of sample tp under the proposal of
+// sample_local_params(). the suff stats of the nodes whose param changed are
+// rescored, and so are the state_matrix rows with entries in the nodes whose
+// pi changed, starting from their cached y. the new terms are kept for
+// accept_local().
+double local_post_delta(struct local_state &ls, struct tree_state &ts, struct node nodes[], struct datum data[], struct state_matrix &sm, struct config conf, int kernel, int c, int tp){
+	int NNODES=conf.NNODES, nrows=sm.dids.size();
+	int p=ts.parent[c];
+	int lo = kernel==MH_KERNEL_SUBTREE ? ts.first[c] : c;
+	double delta=0.0;
+	for(int i=lo;i<=c;i++){
+		double ll=node_post(&nodes[i],ts.param1[tp*NNODES+i],tp);
+		ls.node_ll_new[tp*NNODES+i]=ll;
+		delta+=ll-ls.node_ll[tp*NNODES+i];
+	}
+	
+	// y changes by (pi1-pi) x copies over the changed columns: lo..c and p
+	vector<int> &touched=ls.touched[tp];
+	touched.clear();
+	for(int i=lo;i<=c+1;i++){
+		int col = i<=c ? i : p;
+		double dpi=ts.pi1[tp*NNODES+col]-ts.pi[tp*NNODES+col];
+		for(int e=sm.col_ptr[col];e<sm.col_ptr[col+1];e++){
+			int s=sm.col_idx[e], r=sm.rows[s];
+			if (!ls.mark[r]){
+				ls.mark[r]=1;
+				touched.push_back(r);
+			}
+			double *dy=&ls.dy[4*r];
+			dy[0]+=dpi*sm.nr1[s];
+			dy[1]+=dpi*sm.nv1[s];
+			dy[2]+=dpi*sm.nr2[s];
+			dy[3]+=dpi*sm.nv2[s];
+		}
+	}
+	ls.y_new[tp].resize(4*touched.size());
+	ls.row_ll_new[tp].resize(touched.size());
+	const double *y=&ls.y[4*tp*nrows];
+	for(int t=0;t<touched.size();t++){
+		int r=touched[t];
+		double *yn=&ls.y_new[tp][4*t], *dy=&ls.dy[4*r];
+		for(int k=0;k<4;k++){
+			yn[k]=y[4*r+k]+dy[k];
+			dy[k]=0.0;
+		}
+		ls.mark[r]=0;
+		double ll=data[sm.dids[r]].log_cnv_ll(yn[0],yn[1],yn[2],yn[3],tp);
+		ls.row_ll_new[tp][t]=ll;
+		delta+=ll-ls.row_ll[tp*nrows+r];
+	}
+	return delta;
+}
+
+// makes the proposal of sample_local_params() current for sample tp, along
+// with the cached terms of the nodes and rows it changed. the dirichlet
+// normalizer is updated for the changed pi only, as their sum stays 1.
+// returns the change in the LLH_SUFF part of post[tp].
+double accept_local(struct local_state &ls, struct tree_state &ts, struct config conf, int kernel, int c, int tp, double post[], const double post_delta[], double dir_norm[], double log_pi[]){
+	int NNODES=conf.NNODES, nrows=ls.mark.size();
+	int p=ts.parent[c];
+	int lo = kernel==MH_KERNEL_SUBTREE ? ts.first[c] : c;
+	for(int i=lo;i<=c+1;i++){
+		int j = tp*NNODES + (i<=c ? i : p);
+		dir_norm[tp]+=lgamma(conf.MH_STD*ts.pi[j])-lgamma(conf.MH_STD*ts.pi1[j]);
+		ts.pi[j]=ts.pi1[j];
+		ts.param[j]=ts.param1[j];
+		log_pi[j]=log(ts.pi[j]);
+	}
+	double suff_delta=0.0;
+	for(int i=lo;i<=c;i++){
+		suff_delta+=ls.node_ll_new[tp*NNODES+i]-ls.node_ll[tp*NNODES+i];
+		ls.node_ll[tp*NNODES+i]=ls.node_ll_new[tp*NNODES+i];
+	}
 	
+	vector<int> &touched=ls.touched[tp];
+	for(int t=0;t<touched.size();t++){
+		int r=touched[t];
+		memcpy(&ls.y[4*(tp*nrows+r)],&ls.y_new[tp][4*t],4*sizeof(double));
+		ls.row_ll[tp*nrows+r]=ls.row_ll_new[tp][t];
+	}
+	post[tp]+=post_delta[tp];
+	return suff_delta;
+}
+
+// done for multi-sample
+void sample_cons_params(struct tree_state &ts, struct config conf, gsl_rng *rand, int tp){
+	int NNODES=conf.NNODES;
+	sample_pi(ts,conf,rand,&ts.pi[tp*NNODES],&ts.pi1[tp*NNODES],&ts.param1[tp*NNODES]);
+}
+
+// draws pi_new from a dirichlet centred on pi, and fills param_new with the
+// params it gives
+void sample_pi(struct tree_state &ts, struct config conf, gsl_rng *rand, const double pi[], double pi_new[], double param_new[]){
 	int NNODES=conf.NNODES;
-	double pi[NNODES];
-	for(int i=0;i<NNODES;i++)
-		pi[i]=nodes[i].pi[tp];
 
 	// randomly sample from a dirichlet
-	double pi_new[NNODES],alpha[NNODES];
+	double alpha[NNODES];
 	for(int i=0;i<NNODES;i++)
 		alpha[i]=conf.MH_STD*pi[i]+1;
 	dirichlet_sample(NNODES,alpha,pi_new,rand);
 
-	// update the nodes pi1 (new pi)
-	for(int i=0;i<NNODES;i++)
-		nodes[i].pi1[tp]=pi_new[i];				
-
-	// update the nodes param1 (new param)
+	// children come before their parents
 	for(int i=0;i<NNODES;i++){		
-		double param = nodes[i].pi1[tp];			
-		for(int c=0;c<nodes[i].nchild;c++){
-			param+=nodes[node_id_map[nodes[i].cids.at(c)]].param1[tp];
-		}
-		nodes[i].param1[tp]=param;
+		double param = pi_new[i];			
+		for(int c=ts.child_ptr[i];c<ts.child_ptr[i+1];c++)
+			param+=param_new[ts.child_idx[c]];
+		param_new[i]=param;
 	}
 }
 
 
 // done for multi-sample
 // todo: double check log_ll
-double multi_param_post(struct node nodes[], struct datum data[], int old,struct config conf){
-	double post=0.0;
+// fills post[tp] with the log-likelihood of each sample and returns their sum.
+// parts (see llh_part) selects the terms, and only the samples with todo[tp]
+// set are evaluated if todo is given; the others get 0.
+double multi_param_post(struct tree_state &ts, struct node nodes[], struct datum data[], struct state_matrix &sm, int old,struct config conf, double post[], int parts, const int todo[]){
+	if (old==0)
+		batch_post(ts,nodes,data,sm,conf,1,&ts.param1[0],&ts.pi1[0],post,parts,todo);
+	else
+		batch_post(ts,nodes,data,sm,conf,1,&ts.param[0],&ts.pi[0],post,parts,todo);
+	double total=0.0;
 	for(int tp=0;tp<conf.NTPS;tp++)
-		post+=param_post(nodes,data,old,conf,tp);
-	return post;
-}		
-double param_post(struct node nodes[], struct datum data[], int old,struct config conf,int tp){	
+		total+=post[tp];
+	return total;
+}
+
+// log-likelihood of nbatch sets of params and pi given for all samples, at
+// param[(b*NTPS+tp)*NNODES+i] and likewise pi, into post[b*NTPS+tp]. each
+// sample of each set is split into jobs, the nodes' sufficient statistics
+// and chunks of LLH_CHUNK state_matrix rows, which are shared among
+// conf.NTHREADS threads. the partial sums are added up in job order, so the
+// result does not depend on the no. of threads. parts and todo (indexed like
+// post) are as for multi_param_post().
+void batch_post(struct tree_state &ts, struct node nodes[], struct datum data[], struct state_matrix &sm, struct config conf, int nbatch, const double param[], const double pi[], double post[], int parts, const int todo[]){
+	int NTPS=conf.NTPS, NNODES=conf.NNODES;
+	int nrows=sm.dids.size();
+	int njobs=(nrows+LLH_CHUNK-1)/LLH_CHUNK+1; // per sample
+	
+	vector<double> &partial=ts.partial;
+	if (partial.size()<nbatch*NTPS*njobs)
+		partial.resize(nbatch*NTPS*njobs);
+	#pragma omp parallel for schedule(dynamic) num_threads(conf.NTHREADS) if(conf.NTHREADS>1)
+	for(int job=0;job<nbatch*NTPS*njobs;job++){
+		int bt=job/njobs, c=job%njobs, tp=bt%NTPS;
+		if((todo!=NULL && !todo[bt]) || !(parts & (c==0 ? LLH_SUFF : LLH_CNV)))
+			partial[job]=0.0;
+		else if(c==0)
+			partial[job]=param_post(nodes,&param[bt*NNODES],conf,tp);
+		else{
+			int r0=(c-1)*LLH_CHUNK;
+			partial[job]=cnv_post(data,sm,&pi[bt*NNODES],tp,r0,min(r0+LLH_CHUNK,nrows));
+		}
+	}
+	
+	for(int bt=0;bt<nbatch*NTPS;bt++){
+		post[bt]=0.0;
+		for(int c=0;c<njobs;c++)
+			post[bt]+=partial[bt*njobs+c];
+	}
+}
+
+// log-likelihood of the data without a cnv, from the nodes' suff stats given
+// the params of sample tp
+double param_post(struct node nodes[], const double param[], struct config conf, int tp){	
 	double llh = 0.0;
 	for(int i=0;i<conf.NNODES;i++){
-		double p=0;
-		if(old==0)
-			p=nodes[i].param1[tp];
-		else
-			p=nodes[i].param[tp];
-		for(int j=0;j<nodes[i].ndata;j++){
-			llh+=data[nodes[i].dids.at(j)].log_ll(p,old,tp);
+		double p=param[i];
+		for(int g=0;g<nodes[i].ss.size();g++){
+			struct suff_stat *ss = &nodes[i].ss[g];
+			double mu = (1 - p) * ss->mu_r + p * ss->mu_v;
+			llh+=ss->a[tp]*log(mu) + ss->b[tp]*log(1-mu) + ss->c[tp];
 		}
 	}
 	return llh;	
 }
 
+// log-likelihood of the data without a cnv on node nd, given its param p
+double node_post(struct node *nd, double p, int tp){
+	double llh = 0.0;
+	for(int g=0;g<nd->ss.size();g++){
+		struct suff_stat *ss = &nd->ss[g];
+		double mu = (1 - p) * ss->mu_r + p * ss->mu_v;
+		llh+=ss->a[tp]*log(mu) + ss->b[tp]*log(1-mu) + ss->c[tp];
+	}
+	return llh;
+}
 
-// done for multi-sample
-void update_params(struct node nodes[],struct config conf){	
-	for(int i=0;i<conf.NNODES;i++){
-		for(int tp=0;tp<conf.NTPS;tp++){
-			nodes[i].param[tp]=nodes[i].param1[tp];
-			nodes[i].pi[tp]=nodes[i].pi1[tp];
-		}
+// log-likelihood of the ssms with a cnv in rows r0..r1-1 of sm, whose binomial
+// parameter depends on the pi of all nodes
+double cnv_post(struct datum data[], struct state_matrix &sm, const double pi[], int tp, int r0, int r1){
+	double y[4*LLH_CHUNK];
+	state_spmv(sm,pi,r0,r1,y);
+	double llh = 0.0;
+	for(int r=r0;r<r1;r++){
+		double *yr = &y[4*(r-r0)];
+		llh+=data[sm.dids[r]].log_cnv_ll(yr[0],yr[1],yr[2],yr[3],tp);
 	}
+	return llh;
 }
 
-// done for multi-sample
-void get_pi(struct node nodes[], double pi[], struct config conf, int old, int tp){
-	for(int i=0;i<conf.NNODES;i++){
-		if (old==0)
-			pi[i]=nodes[i].pi1[tp];
-		else
-			pi[i]=nodes[i].pi[tp];
+// y = (nr1,nv1,nr2,nv2) x pi for rows r0..r1-1 of sm
+void state_spmv(struct state_matrix &sm, const double pi[], int r0, int r1, double y[]){
+	for(int r=r0;r<r1;r++){
+		double nr1=0,nv1=0,nr2=0,nv2=0;
+		for(int s=sm.ptr[r];s<sm.ptr[r+1];s++){
+			double w = pi[sm.cols[s]];
+			nr1 += w*sm.nr1[s];
+			nv1 += w*sm.nv1[s];
+			nr2 += w*sm.nr2[s];
+			nv2 += w*sm.nv2[s];
+		}
+		y[4*(r-r0)] = nr1;
+		y[4*(r-r0)+1] = nv1;
+		y[4*(r-r0)+2] = nr2;
+		y[4*(r-r0)+3] = nv2;
 	}
 }
 
 
 // done for multi-sample
-void write_params(char fname[], struct node *nodes, struct config conf){	
-	ofstream dfile;
-	dfile.open(fname);	
-	for(int i=0;i<conf.NNODES;i++){		
-		dfile<<nodes[i].id<<'\t';	
-		for(int tp=0;tp<conf.NTPS;tp++)
-			dfile<<nodes[i].param[tp]<<',';
-		dfile<<'\t';
-		for(int tp=0;tp<conf.NTPS;tp++)
-			dfile<<nodes[i].pi[tp]<<',';
-		dfile<<'\n';
-	}	
-	dfile.close();	
+void update_params(struct tree_state &ts,struct config conf,int tp){	
+	int NNODES=conf.NNODES;
+	memcpy(&ts.param[tp*NNODES],&ts.param1[tp*NNODES],NNODES*sizeof(double));
+	memcpy(&ts.pi[tp*NNODES],&ts.pi1[tp*NNODES],NNODES*sizeof(double));
 }
 
 
@@ -303,127 +1156,3 @@ void load_cnv_data(char fname[],struct datum *data, struct config conf){
 	}	
 	dfile.close();
 }
-
-// done for multi-sample
-// load the current tree state from the disk
-void load_tree(char fname[], struct node *nodes, struct config conf){
-	string line,token,token1;
-	ifstream dfile (fname);
-	int ctr=0;
-	while (getline (dfile,line,'\n')){
-		istringstream iss(line);
-		ctr=0;
-		while(getline(iss,token,'\t')){
-			if(ctr==0){
-				nodes->id=atoi(token.c_str());
-			}
-			else if(ctr==1){
-				istringstream iss(token);
-				for(int tp=0;tp<conf.NTPS;tp++){
-					getline(iss,token1,',');
-					nodes->param.push_back(atof(token1.c_str()));
-					nodes->param1.push_back(0.0);
-				}				
-			}
-			else if(ctr==2){
-				istringstream iss(token);
-				for(int tp=0;tp<conf.NTPS;tp++){
-					getline(iss,token1,',');
-					nodes->pi.push_back(atof(token1.c_str()));
-					nodes->pi1.push_back(0.0);
-				}				
-			}
-			else if(ctr==5){
-				nodes->ndata=atoi(token.c_str());
-			}
-			else if(ctr==6){
-				istringstream iss(token);
-				for(int i=0;i<nodes->ndata;i++){
-					getline(iss,token1,',');
-					nodes->dids.push_back(atoi(token1.c_str()));
-				}
-			}
-			else if(ctr==3){
-				nodes->nchild=atoi(token.c_str());		
-			}			
-			else if(ctr==4){
-				istringstream iss(token);
-				for(int i=0;i<nodes->nchild;i++){
-					getline(iss,token1,',');
-					nodes->cids.push_back(atoi(token1.c_str()));
-				}
-			}
-			else if(ctr==7){
-				nodes->ht=atoi(token.c_str());		
-			}			
-			ctr+=1;
-		}
-		nodes++;
-	}	
-	dfile.close();	
-}
-
-// no changes for multi-sample
-void load_data_states(char fname[], struct datum* data, struct node* nodes, struct config conf){
-
-	map <int, struct datum*> id_datum_map;
-	for(int i=0;i<conf.N_SSM_DATA;i++){
-		id_datum_map[data[i].id]=&data[i];
-	}
-		
-	map <int, int> node_id_map;
-	for(int i=0;i<conf.NNODES;i++)
-		node_id_map[nodes[i].id]=i;
-	
-	string line,token,token1,token2;
-	ifstream dfile (fname);
-	int ctr=0;
-	while (getline (dfile,line,'\n')){
-		
-			
-		struct datum *dat;
-		istringstream iss(line);
-		ctr=0;
-		while(getline(iss,token,'\t')){
-			if(ctr==0){
-				dat = id_datum_map[atoi(token.c_str())];
-			}
-			else if(ctr==1){			
-				istringstream iss1(token);
-				while(getline(iss1,token1,';')){					
-					struct state st8;
-					istringstream iss2(token1);
-					for(int i=0;i<3;i++){
-						getline (iss2,token2,',');
-						if(i==0)
-							st8.nd = &nodes[node_id_map[atoi(token2.c_str())]];
-						else if(i==1)
-							st8.nr = atoi(token2.c_str());
-						else if(i==2)
-							st8.nv = atoi(token2.c_str());
-					}
-					dat->states1.push_back(st8);
-				}
-			}
-			else if(ctr==2){			
-				istringstream iss1(token);
-				while(getline(iss1,token1,';')){					
-					struct state st8;
-					istringstream iss2(token1);
-					for(int i=0;i<3;i++){
-						getline (iss2,token2,',');
-						if(i==0)
-							st8.nd = &nodes[node_id_map[atoi(token2.c_str())]];
-						else if(i==1)
-							st8.nr = atoi(token2.c_str());
-						else if(i==2)
-							st8.nv = atoi(token2.c_str());
-					}
-					dat->states2.push_back(st8);
-				}
-			}
-			ctr+=1;
-		}		
-	}	
-	dfile.close();
-}
@@ -1,5 +1,6 @@
 
 #include<vector>
+#include<map>
 #include<cstring>
 #include<math.h>
 
@@ -8,20 +9,121 @@
 
 #include "util.hpp"
 
-void sample_cons_params(struct node nodes[],struct config conf,gsl_rng *rand,int tp);
-double multi_param_post(struct node nodes[], struct datum data[], int old,struct config conf);
-double param_post(struct node nodes[], struct datum data[], int old,struct config conf, int tp);
-void update_params(struct node nodes[], struct config conf);
-void get_pi(struct node nodes[], double pi[], struct config conf, int old, int tp);
+void sample_cons_params(struct tree_state &ts, struct config conf, gsl_rng *rand, int tp);
+void sample_pi(struct tree_state &ts, struct config conf, gsl_rng *rand, const double pi[], double pi_new[], double param_new[]);
+// parts of the log-likelihood evaluated by multi_param_post()
+enum llh_part{
+	LLH_SUFF=1, // data without a cnv, from the nodes' suff stats
+	LLH_CNV=2, // ssms with a cnv, from the state_matrix
+	LLH_ALL=3
+};
+double multi_param_post(struct tree_state &ts, struct node nodes[], struct datum data[], struct state_matrix &sm, int old,struct config conf, double post[], int parts=LLH_ALL, const int todo[]=NULL);
+void batch_post(struct tree_state &ts, struct node nodes[], struct datum data[], struct state_matrix &sm, struct config conf, int nbatch, const double param[], const double pi[], double post[], int parts=LLH_ALL, const int todo[]=NULL);
+double param_post(struct node nodes[], const double param[], struct config conf, int tp);
+double cnv_post(struct datum data[], struct state_matrix &sm, const double pi[], int tp, int r0, int r1);
+void state_spmv(struct state_matrix &sm, const double pi[], int r0, int r1, double y[]);
+
+const int LLH_CHUNK=256; // state_matrix rows per likelihood job
+void update_params(struct tree_state &ts, struct config conf, int tp);
+void accept(struct tree_state &ts, struct config conf, int tp, double post[], const double post_new[], double dir_norm[], const double dir_norm_new[], double log_pi[], const double log_pi_new[]);
 
 void load_ssm_data(char fname[], struct datum data[], struct config conf);
 void load_cnv_data(char fname[], struct datum data[], struct config conf);
-void load_data_states(char fname[], struct datum data[], struct node nodes[], struct config conf);
 
-void load_tree(char fname[], struct node nodes[], struct config conf);
-void write_params(char fname[], struct node nodes[], struct config conf);
+struct node* build_tree(struct tree_state &ts, struct config conf, const int* ids, const double* params, const double* pi, const int* child_ptr, const int* child_ids, const int* data_ptr, const int* data_ids, const int* hts);
+void build_data_states(struct state_matrix &sm, struct tree_state &ts, struct config conf, int nrows, const int* state_ptr, const int* state_dids, const int* state_nids, const int* state_copies);
+void build_suff_stats(struct node nodes[], struct datum data[], struct config conf);
+void get_params(struct tree_state &ts, struct config conf, double* params, double* pi);
+
+int map_exchange(const char* fname, struct exchange &ex);
+void unmap_exchange(struct exchange &ex);
+int run_exchange(const char* fname, struct datum data[], struct config conf);
 
-void mh_loop(struct node nodes[], struct datum data[], char* fname, struct config conf);
+double mh_loop(struct tree_state &ts, struct node nodes[], struct datum data[], struct state_matrix &sm, struct config conf, double stats[]);
+void set_options(struct config &conf, const double opts[]);
+double batch_means_ess(const vector<double> &x);
+void mh_decide(struct config conf, gsl_rng *rand, const double a[], const int todo[], int accepted[]);
+
+// adaptive mode (see mh_loop())
+const double MH_STD_MIN=1, MH_STD_MAX=1e5; // bounds of the adapted MH_STD. acceptance
+// drops again at very large MH_STD, where the 1e-4 floor dirichlet_sample() adds
+// to pi outweighs the proposal spread
+const double MH_ADAPT_DECAY=0.6; // step size at iteration t is 1/t^MH_ADAPT_DECAY
+const int MH_ESS_CHECK=100; // iterations between effective sample size checks
+double dirichlet_terms(int size, double std, const double pi[], double log_pi[]);
+
+// proposal kernels, picked at random each iteration (see mh_loop())
+enum mh_kernel{
+	MH_KERNEL_GLOBAL, // dirichlet over the pi of all nodes
+	MH_KERNEL_PAIR, // moves pi between a node and its parent
+	MH_KERNEL_SUBTREE, // moves the mass of a subtree to or from its root's parent
+	MH_NKERNELS
+};
+void init_local_state(struct local_state &ls, struct state_matrix &sm, struct config conf);
+void fill_local_llh(struct local_state &ls, struct tree_state &ts, struct node nodes[], struct datum data[], struct state_matrix &sm, struct config conf);
+double sample_local_params(struct tree_state &ts, struct config conf, gsl_rng *rand, int kernel, int c, int tp);
+double local_post_delta(struct local_state &ls, struct tree_state &ts, struct node nodes[], struct datum data[], struct state_matrix &sm, struct config conf, int kernel, int c, int tp);
+double accept_local(struct local_state &ls, struct tree_state &ts, struct config conf, int kernel, int c, int tp, double post[], const double post_delta[], double dir_norm[], double log_pi[]);
+double node_post(struct node *nd, double p, int tp);
+void init_mtm_state(struct mtm_state &mt, struct config conf);
+void mtm_propose(struct mtm_state &mt, struct tree_state &ts, struct node nodes[], struct datum data[], struct state_matrix &sm, struct config conf, gsl_rng *rand, const double post[], const double dir_norm[], const double log_pi[], double post_new[], double dir_norm_new[], double log_pi_new[], double a[]);
+int mtm_pick(gsl_rng *rand, const double lw[], int n, double lw_sum);
+double log_beta_pdf(double x, double a, double b);
+int serve(int argc, char* argv[]);
+
+// c_state.bin header fields, must match params.write_exchange()
+enum exchange_header{
+	EX_MAGIC, EX_VERSION, EX_NNODES, EX_NTPS, EX_NCHILD, EX_NDATA, EX_NROWS, EX_NSTATES, EX_TREE_HEIGHT,
+	EX_HEADER_LEN=16
+};
+const int EX_MAGIC_VALUE=0x53475750; // "PWGS"
+const int EX_VERSION_VALUE=3;
+
+// sampler options, must match params.MH_OPTS
+enum mh_opt{
+	MH_OPT_ITR, // no. of iterations
+	MH_OPT_STD, // dirichlet proposal concentration
+	MH_OPT_THREADS, // no. of threads used to evaluate the likelihood
+	MH_OPT_BLOCKED, // accept or reject each sample's proposal separately
+	MH_OPT_ADAPTIVE, // adapt MH_STD and stop early, see mh_loop()
+	MH_OPT_MIN_ITR, // no. of iterations before stopping early
+	MH_OPT_TARGET_ACC, // acceptance ratio MH_STD is adapted towards
+	MH_OPT_TARGET_ESS, // effective sample size to stop at
+	MH_OPT_PAIR_RATE, // probability of a MH_KERNEL_PAIR proposal
+	MH_OPT_SUBTREE_RATE, // probability of a MH_KERNEL_SUBTREE proposal
+	MH_OPT_SEED, // random seed, 0 for gsl's default
+	MH_OPT_DELAYED, // screen global proposals with LLH_SUFF first
+	MH_OPT_TRIES, // no. of candidates of each global proposal
+	MH_OPTS_LEN=16
+};
+
+// sampler stats filled in by mh_loop(), must match params.MH_STATS. these are
+// followed by the acceptance ratio of each sample.
+enum mh_stat{
+	MH_STAT_ACC, // acceptance ratio, averaged over samples
+	MH_STAT_LLH_EVALS, // no. of likelihood evaluations, MH_DELAYED screens included
+	MH_STAT_ITERS, // no. of iterations done
+	MH_STAT_STD, // MH_STD at the end, as adapted
+	MH_STAT_ESS, // effective sample size of the log-likelihood trace
+	MH_STAT_GLOBAL_MOVES, // no. of proposals of each kernel, followed by
+	MH_STAT_GLOBAL_ACC, // their acceptance ratio, averaged over samples
+	MH_STAT_PAIR_MOVES,
+	MH_STAT_PAIR_ACC,
+	MH_STAT_SUBTREE_MOVES,
+	MH_STAT_SUBTREE_ACC,
+	MH_STAT_STAGE1_REJ, // fraction of global proposals rejected by the
+	MH_STAT_STAGE2_REJ, // LLH_SUFF screen and after it, averaged over samples
+	MH_STATS_LEN=16
+};
+
+struct exchange{
+	void *addr;
+	size_t size;
+	int *header;
+	double *opts, *stats, *params, *pi;
+	int *ids, *hts, *child_ptr, *child_ids, *data_ptr, *data_ids;
+	int *state_ptr, *state_dids, *state_nids, *state_copies;
+};
 
 struct config{
 	int MH_ITR;
@@ -33,21 +135,79 @@ struct config{
 	int NNODES; // no. of nodes in the tree
 	int TREE_HEIGHT; 
 	int NTPS; // no. of samples / time points	
+	int NTHREADS; // no. of threads used to evaluate the likelihood
+	int MH_BLOCKED; // accept or reject each sample separately
+	int MH_ADAPTIVE; // adapt MH_STD and stop early
+	int MH_MIN_ITR;
+	double MH_TARGET_ACC, MH_TARGET_ESS;
+	double MH_PAIR_RATE, MH_SUBTREE_RATE; // the global kernel takes the rest
+	unsigned long MH_SEED;
+	int MH_DELAYED; // delayed acceptance of global proposals
+	int MH_TRIES; // multiple-try global proposals, if > 1
+};
+
+// copy numbers of the SSMs with a CNV, as sparse datums x nodes matrices in
+// CSR form. row r belongs to datum dids[r] and its entries are
+// cols/nr1/nv1/nr2/nv2[ptr[r]:ptr[r+1]], with cols indexing the nodes array.
+// 1 is maternal, 2 paternal.
+// col_ptr/col_idx are the same entries by column: those of node i are
+// col_idx[col_ptr[i]:col_ptr[i+1]], and rows holds the row of each entry.
+struct state_matrix{
+	vector<int> dids,ptr,cols;
+	vector<double> nr1,nv1,nr2,nv2;
+	vector<int> col_ptr,col_idx,rows;
 };
 
-struct state{
-	struct node* nd;
-	int nr,nv;
+// the tree sampled by mh_loop(), set up once per call by build_tree(). nodes
+// are indexed in post-order, so children come before their parents and the
+// subtree of node i is first[i]..i. the params and pi of sample tp are at
+// [tp*NNODES+i], and param1/pi1 hold the proposed ones.
+struct tree_state{
+	map<int,int> index; // node id -> index
+	vector<int> parent; // -1 for the root
+	vector<int> first;
+	vector<int> child_ptr, child_idx; // children of node i are child_idx[child_ptr[i]:child_ptr[i+1]]
+	vector<double> param, pi, param1, pi1;
+	vector<double> partial; // batch_post() scratch
 };
 
+// cached likelihood terms of the current params used by the local kernels,
+// which rescore only the nodes and state_matrix rows a proposal changes. all
+// per-sample arrays are NTPS x (NNODES or nrows).
+struct local_state{
+	int valid; // whether the terms below belong to the current params
+	vector<double> node_ll; // node_post() of each node
+	vector<double> y, row_ll; // state_spmv() output (4 per row) and log_cnv_ll() of each row
+	// proposal scratch: node_post() of the nodes whose params change, and the
+	// touched rows with their new y and log_cnv_ll(), per sample
+	vector<double> node_ll_new;
+	vector< vector<int> > touched;
+	vector< vector<double> > y_new, row_ll_new;
+	vector<double> dy;
+	vector<int> mark;
+};
+
+// the candidates or references of a multiple-try proposal (see mtm_propose()),
+// MH_TRIES x NTPS x NNODES or MH_TRIES x NTPS: their pi, params, log pi,
+// log-likelihood and log weight
+struct mtm_state{
+	vector<double> pi, param, log_pi;
+	vector<double> post, lw;
+};
+
+// summed counts of the data without CNVs on a node that share (mu_r,mu_v),
+// per sample: a, d-a and the binomial normalizing constants
+struct suff_stat{
+	double mu_r,mu_v;
+	vector<double> a,b,c;
+};
+
+// params and children are kept in tree_state
 struct node{
 	int id;
-	vector<double> param,pi;
-	vector<double> param1,pi1; // dummy	
 	int ndata;
 	vector<int> dids;	
-	int nchild;
-	vector<int> cids; // children ids	
+	vector<struct suff_stat> ss; // see build_suff_stats()
 	int ht;	
 };
 
@@ -63,68 +223,19 @@ struct datum{
 	struct datum* cnv; // for SSM datum, this is a pointer to its CNV datum
 	//int cnv;// just an indicator for cnv or ssm datum
 	
-	// this is used to compute the binomial parameter
-	vector <struct state> states1, states2; // maternal and paternal state
-	
-	double log_ll1111(vector<double> phi, int old){
-		double llh = 0.0;
-		for(int tp=0; tp<phi.size();tp++)
-			llh+=log_complete_ll(phi[tp],mu_r,mu_v,old,tp);
-		return llh;
-	}
-
-	double log_ll(double phi, int old, int tp){
-		return log_complete_ll(phi,mu_r,mu_v,old,tp);
-	}
-	
-	double log_complete_ll(double phi, double mu_r, double mu_v, int old, int tp){
-		double nr=0;
-		double nv=0;
-		double mu = 0;
-		double llh = 0;
-				
-		if(cnv==NULL){	// cnv data
-			mu = (1 - phi) * mu_r + phi * mu_v;
-			llh = log_binomial_likelihood(a[tp], d[tp], mu) + log_bin_norm_const[tp];			
-		}	
-		else{ // ssm data
-			double ll[2]; // maternal and paternal	
-			nr=0;
-			nv=0;
-			for(int i=0;i<states1.size();i++){
-				if(old==0){
-					nr += (states1[i].nd->pi1[tp])*states1[i].nr;
-					nv += (states1[i].nd->pi1[tp])*states1[i].nv;
-				}else{
-					nr += (states1[i].nd->pi[tp])*states1[i].nr;
-					nv += (states1[i].nd->pi[tp])*states1[i].nv;
-				}	
-			}
-			if(nr+nv>0){
-				mu = (nv*(1-mu_r) + nr*mu_r)/(nr+nv);
-				ll[0] = log_binomial_likelihood(a[tp], d[tp], mu) + log(0.5) + log_bin_norm_const[tp];
+	// log-likelihood of an SSM with a CNV, given the maternal (nr1,nv1) and
+	// paternal (nr2,nv2) copies weighted by the node pi (see state_spmv())
+	double log_cnv_ll(double nr1, double nv1, double nr2, double nv2, int tp){
+		double ll[2]; // maternal and paternal
+		double nr[2]={nr1,nr2}, nv[2]={nv1,nv2};
+		for(int k=0;k<2;k++){
+			if(nr[k]+nv[k]>0){
+				double mu = (nv[k]*(1-mu_r) + nr[k]*mu_r)/(nr[k]+nv[k]);
+				ll[k] = log_binomial_likelihood(a[tp], d[tp], mu) + log(0.5) + log_bin_norm_const[tp];
 			}else{
-				ll[0]=log(pow(10,-99));
+				ll[k]=log(pow(10,-99));
 			}
-			// repetitive...
-			nr=nv=0;
-			for(int i=0;i<states2.size();i++){
-				if(old==0){
-					nr += (states2[i].nd->pi1[tp])*states2[i].nr;
-					nv += (states2[i].nd->pi1[tp])*states2[i].nv;
-				}else{
-					nr += (states2[i].nd->pi[tp])*states2[i].nr;
-					nv += (states2[i].nd->pi[tp])*states2[i].nv;
-				}				
-			}
-			if(nr+nv>0){
-				mu = (nv*(1-mu_r) + nr*mu_r)/(nr+nv);
-				ll[1] = log_binomial_likelihood(a[tp], d[tp], mu) + log(0.5) + log_bin_norm_const[tp];
-			}else{
-				ll[1]=log(pow(10,-99));
-			}
-			llh = logsumexp(ll,2);
 		}
-		return llh;
-	}	
+		return logsumexp(ll,2);
+	}
 };
@@ -0,0 +1,56 @@
+###### in-process interface to the Metropolis-Hastings sampler in mh.cpp ########
+
+# Build the shared library alongside mh.o:
+#  g++ -o libmh.so -shared -fPIC -O3 -fopenmp mh.cpp util.cpp `gsl-config --cflags --libs`
+
+import os
+import ctypes
+
+import numpy
+from numpy.ctypeslib import ndpointer, load_library
+
+from params import MH_STATS_LEN, unpack_mh_stats
+
+_int_array = ndpointer(dtype=numpy.int32, flags='C_CONTIGUOUS')
+_double_array = ndpointer(dtype=numpy.float64, flags='C_CONTIGUOUS')
+
+def _load_lib():
+	# Raises OSError if libmh.so has not been built.
+	script_dir = os.path.dirname(os.path.realpath(__file__))
+	lib = load_library('libmh', script_dir)
+
+	lib.mh_load_data.restype = ctypes.c_void_p
+	lib.mh_load_data.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int,
+		_int_array, _int_array, _double_array, _double_array, _int_array]
+	lib.mh_free_data.restype = None
+	lib.mh_free_data.argtypes = [ctypes.c_void_p]
+	lib.mh_run.restype = ctypes.c_double
+	lib.mh_run.argtypes = [ctypes.c_void_p, _double_array, ctypes.c_int,
+		_int_array, _double_array, _double_array, _int_array, _int_array, _int_array, _int_array, _int_array,
+		ctypes.c_int, _int_array, _int_array, _int_array, _int_array, _double_array]
+	return lib
+
+class NativeMH(object):
+	# SSM/CNV data stay resident in the library for the lifetime of this
+	# object, so each MCMC iteration only passes the tree and data states.
+	def __init__(self, a, d, mu_r, mu_v, cnv_link, n_ssms, n_cnvs):
+		self._lib = _load_lib()
+		ntps = a.shape[1]
+		self._handle = self._lib.mh_load_data(n_ssms, n_cnvs, ntps, a, d, mu_r, mu_v, cnv_link)
+
+	# tree and states are as returned by params.pack_tree() and
+	# params.pack_data_states(), opts as returned by params.pack_mh_opts().
+	# tree['params'] and tree['pi'] are updated in place. Returns the sampler
+	# stats, as params.read_exchange() does.
+	def run(self, tree, states, opts):
+		stats = numpy.zeros(MH_STATS_LEN + tree['params'].shape[1])
+		self._lib.mh_run(self._handle, opts, len(tree['ids']),
+			tree['ids'], tree['params'], tree['pi'],
+			tree['child_ptr'], tree['child_ids'], tree['data_ptr'], tree['data_ids'], tree['hts'],
+			len(states['dids']), states['ptr'], states['dids'], states['nids'], states['copies'], stats)
+		return unpack_mh_stats(stats)
+
+	def close(self):
+		if self._handle is not None:
+			self._lib.mh_free_data(self._handle)
+			self._handle = None
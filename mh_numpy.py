@@ -0,0 +1,335 @@
+###### NumPy implementation of the Metropolis-Hastings sampler in mh.cpp ########
+
+# Needs neither GSL nor a compiler; select it with evolve.py --mh-engine numpy.
+# It samples from the same proposals and target as mh_loop(), joint or blocked,
+# adaptive and delayed alike, vectorized over nodes, data and samples. Unlike
+# mh.cpp, the local kernels rescore all data, which costs little once
+# vectorized.
+
+import numpy
+from numpy import *
+from scipy.special import gammaln
+from scipy.sparse import csr_matrix
+
+from params import MH_STATS, MH_STATS_LEN, MH_KERNELS, unpack_mh_opts, unpack_mh_stats
+
+# adaptive mode, as in mh.hpp
+MH_STD_MIN = 1
+MH_STD_MAX = 1e5
+MH_ADAPT_DECAY = 0.6
+MH_ESS_CHECK = 100
+
+class NumpyMH(object):
+	# Takes the columnar data of params.pack_data(). seed initializes the
+	# engine's own random state, so the global NumPy one is left alone; the
+	# seed option of run() is not used.
+	def __init__(self, a, d, mu_r, mu_v, cnv_link, n_ssms, n_cnvs, seed=None):
+		self._a = a.astype(float64)
+		self._b = (d - a).astype(float64)
+		self._c = gammaln(d + 1) - gammaln(a + 1) - gammaln(d - a + 1)
+		self._mu_r = mu_r
+		self._mu_v = mu_v
+		self._has_cnv = cnv_link >= 0
+		self._rand = numpy.random.RandomState(seed)
+
+	# Same interface as mh_native.NativeMH.run().
+	def run(self, tree, states, opts):
+		opts = unpack_mh_opts(opts)
+		llh = self._likelihood(tree, states)
+		subtree = _subtree_matrix(tree)
+		nnodes = len(subtree)
+		parent = _parents(tree)
+		# the subtree of node i spans nodes first[i]..i
+		first = subtree.argmax(1)
+		local = nnodes > 1 and opts['pair_rate'] + opts['subtree_rate'] > 0
+		kernel_moves = zeros(len(MH_KERNELS))
+		kernel_acc = zeros(len(MH_KERNELS))
+		iters = int(opts['iters'])
+		tries = int(opts['tries'])
+		std = opts['std']
+		ntps = tree['pi'].shape[1]
+
+		pi = tree['pi'].copy()
+		# the likelihood without and with CNVs; delayed acceptance screens
+		# global proposals on the former
+		suff, cnv = llh(subtree.dot(pi), pi)
+		post = suff + cnv
+		stage_rej = zeros(2)
+		dir_norm = _dirichlet_norm(pi, std)
+		log_pi = log(pi)
+		llh_evals = 1
+		acc = zeros(ntps)
+		trace = []
+
+		itrs = 0
+		log_std = log(std)
+		while itrs < iters:
+			kernel = 0
+			if local:
+				r = self._rand.uniform()
+				if r < opts['pair_rate']:
+					kernel = MH_KERNELS.index('pair')
+				elif r < opts['pair_rate'] + opts['subtree_rate']:
+					kernel = MH_KERNELS.index('subtree')
+				if kernel:
+					c = self._rand.randint(nnodes - 1) # the root comes last
+
+			mtm = kernel == 0 and tries > 1
+			if mtm:
+				pi_new, suff_new, cnv_new, a = self._mtm_propose(llh, subtree, pi, post, dir_norm, log_pi, std, tries, opts['blocked'])
+				log_q = None
+			elif kernel == 0:
+				pi_new = self._sample_cons_params(pi, std)
+				log_q = None
+			else:
+				lo = c
+				if kernel == MH_KERNELS.index('subtree'):
+					lo = first[c]
+				pi_new, log_q = self._sample_local_params(pi, std, lo, c, parent[c])
+			delayed = opts['delayed'] and log_q is None and not mtm
+			with errstate(divide='ignore', invalid='ignore'):
+				if not mtm:
+					suff_new, cnv_new = llh(subtree.dot(pi_new), pi_new, not delayed)
+				post_new = suff_new + cnv_new
+				dir_norm_new = _dirichlet_norm(pi_new, std)
+				log_pi_new = log(pi_new)
+
+			if kernel == 0 and not mtm:
+				# log Dir(pi | std*pi_new) - log Dir(pi_new | std*pi), per sample
+				a = post_new - post + dir_norm_new - dir_norm
+				a += ((std*pi_new - 1)*log_pi - (std*pi - 1)*log_pi_new).sum(0)
+			elif kernel:
+				a = where(isinf(log_q), -inf, post_new - post + log_q)
+			if delayed:
+				# cnv_new is 0 here, so a only compares the likelihood without CNVs
+				a += cnv
+
+			accepted = self._decide(a, ones(ntps, dtype=bool), opts['blocked'])
+			if delayed:
+				# the proposals that pass the screen are accepted with the ratio
+				# of the likelihood of the SSMs with CNVs
+				stage_rej[0] += (~accepted).sum()
+				llh_evals += 1
+				if accepted.any():
+					screened = accepted
+					with errstate(divide='ignore', invalid='ignore'):
+						cnv_new = llh(subtree.dot(pi_new), pi_new, True)[1]
+					post_new = suff_new + cnv_new
+					accepted = self._decide(cnv_new - cnv, screened, opts['blocked'])
+					stage_rej[1] += (screened & ~accepted).sum()
+					llh_evals += 1
+			elif mtm:
+				llh_evals += 2*tries - 1
+			else:
+				llh_evals += 1
+			acc += accepted
+			kernel_moves[kernel] += 1
+			kernel_acc[kernel] += accepted.mean()
+			pi[:, accepted] = pi_new[:, accepted]
+			post[accepted] = post_new[accepted]
+			suff[accepted] = suff_new[accepted]
+			cnv[accepted] = cnv_new[accepted]
+			dir_norm[accepted] = dir_norm_new[accepted]
+			log_pi[:, accepted] = log_pi_new[:, accepted]
+			itrs += 1
+			trace.append(post.sum())
+
+			if opts['adaptive']:
+				# a larger concentration gives smaller moves, so rejections raise it
+				log_std += (opts['target_acc'] - accepted.mean())/itrs**MH_ADAPT_DECAY
+				log_std = min(max(log_std, log(MH_STD_MIN)), log(MH_STD_MAX))
+				std = exp(log_std)
+				dir_norm = _dirichlet_norm(pi, std)
+				if itrs >= opts['min_iters'] and itrs % MH_ESS_CHECK == 0 and batch_means_ess(trace) >= opts['target_ess']:
+					break
+
+		tree['pi'][...] = pi
+		tree['params'][...] = subtree.dot(pi)
+
+		stats = zeros(MH_STATS_LEN + ntps)
+		stats[MH_STATS_LEN:] = acc/itrs
+		stats[MH_STATS.index('acc_rate')] = stats[MH_STATS_LEN:].mean()
+		stats[MH_STATS.index('llh_evals')] = llh_evals
+		stats[MH_STATS.index('iters')] = itrs
+		stats[MH_STATS.index('std')] = std
+		stats[MH_STATS.index('ess')] = batch_means_ess(trace)
+		for k, name in enumerate(MH_KERNELS):
+			stats[MH_STATS.index(name + '_moves')] = kernel_moves[k]
+			if kernel_moves[k]:
+				stats[MH_STATS.index(name + '_acc')] = kernel_acc[k]/kernel_moves[k]
+		if opts['delayed'] and kernel_moves[0]:
+			stats[MH_STATS.index('stage1_rej')] = stage_rej[0]/(ntps*kernel_moves[0])
+			stats[MH_STATS.index('stage2_rej')] = stage_rej[1]/(ntps*kernel_moves[0])
+		return unpack_mh_stats(stats)
+
+	def close(self):
+		pass
+
+	# Multiple-try proposal of mh.cpp's mtm_propose(): draws tries candidates
+	# around pi and picks one by its weight w(y|x) = p(y) q(x|y), then draws
+	# tries-1 references around the pick, which with pi give the weights of the
+	# reverse move. Returns the pick, its two likelihood parts, and the log
+	# acceptance ratio per sample if blocked, otherwise the joint one in the
+	# first sample and 0 in the rest.
+	def _mtm_propose(self, llh, subtree, pi, post, dir_norm, log_pi, std, tries, blocked):
+		ntps = pi.shape[1]
+		lw_sum = []
+		for stage in range(2):
+			if stage == 0:
+				draws = [self._sample_cons_params(pi, std) for k in range(tries)]
+				log_x = log_pi
+			else:
+				draws = [self._sample_cons_params(pi_new, std) for k in range(tries - 1)]
+				log_x = log(pi_new)
+			with errstate(divide='ignore', invalid='ignore'):
+				parts = [llh(subtree.dot(y), y) for y in draws]
+				lw = array([s + c + _dirichlet_norm(y, std) + ((std*y - 1)*log_x).sum(0) for y, (s, c) in zip(draws, parts)])
+			if stage == 1:
+				# the current pi is the last reference
+				lw = vstack([lw, post + dir_norm + ((std*pi - 1)*log_x).sum(0)])
+			if not blocked:
+				lw = repeat(lw.sum(1)[:,newaxis], ntps, axis=1)
+			top = lw.max(0)
+			lw_sum.append(top + log(exp(lw - top).sum(0)))
+			if stage == 0:
+				# the pick of each sample, the same for all unless blocked
+				r = self._rand.uniform(size=ntps if blocked else 1)
+				cum = exp(lw - lw_sum[0]).cumsum(0)
+				pick = minimum((cum < r).sum(0), tries - 1)
+				cols = arange(ntps)
+				pi_new = array(draws)[pick, :, cols].T
+				suff_new = array([s for s, c in parts])[pick, cols]
+				cnv_new = array([c for s, c in parts])[pick, cols]
+		a = lw_sum[0] - lw_sum[1]
+		if not blocked:
+			a = where(arange(ntps) == 0, a, 0)
+		return pi_new, suff_new, cnv_new, a
+
+	# Accept/reject decisions for the samples in todo, from their log
+	# acceptance ratios a: one per sample if blocked, otherwise a single one on
+	# the sum of a, as mh.cpp's mh_decide().
+	def _decide(self, a, todo, blocked):
+		if blocked:
+			return todo & (log(1 - self._rand.uniform(size=len(a))) < where(todo, a, 0))
+		return todo & (log(1 - self._rand.uniform()) < a[todo].sum())
+
+	# Dirichlet proposal centred on pi, for all samples at once. Like
+	# dirichlet_sample() in util.cpp, 1e-4 is added to each pi before
+	# renormalizing.
+	def _sample_cons_params(self, pi, std):
+		x = self._rand.gamma(std*pi + 1)
+		x /= x.sum(0)
+		x += 0.0001
+		return x / x.sum(0)
+
+	# Local proposal of mh.cpp's sample_local_params(): moves mass between the
+	# nodes lo..c, which are scaled together, and the parent p of c. Returns
+	# the new pi and the log proposal ratio per sample, -inf where a new pi is
+	# not positive.
+	def _sample_local_params(self, pi, std, lo, c, p):
+		m = pi[lo:c+1].sum(0)
+		s = m + pi[p]
+		u = m/s
+		u_new = self._rand.beta(std*u + 1, std*(1 - u) + 1)
+		m_new = s*u_new
+		pi_new = pi.copy()
+		pi_new[lo:c+1] *= m_new/m
+		pi_new[p] = s - m_new
+		with errstate(divide='ignore', invalid='ignore'):
+			log_q = (c - lo)*log(u_new/u) + _log_beta_pdf(u, std*u_new + 1, std*(1 - u_new) + 1) - _log_beta_pdf(u_new, std*u + 1, std*(1 - u) + 1)
+		log_q[~((m_new > 0) & (s - m_new > 0))] = -inf
+		return pi_new, log_q
+
+	# Returns a function scoring the params and pi (nnodes x ntps) of the
+	# packed tree, giving the log-likelihood of each sample in two parts: that
+	# of the data without a CNV and, unless with_cnv is False (zeros then),
+	# that of the SSMs with one. Data without a CNV
+	# are summed per node and (mu_r, mu_v), as build_suff_stats() does; the
+	# SSMs with a CNV are scored through sparse datums x nodes copy-number
+	# matrices, as in state_spmv().
+	def _likelihood(self, tree, states):
+		nnodes = len(tree['ids'])
+		node_of = repeat(arange(nnodes), diff(tree['data_ptr']))
+		dids = tree['data_ids']
+		free = ~self._has_cnv[dids]
+		node_of, dids = node_of[free], dids[free]
+		mus, group = unique(self._mu_r[dids] + 1j*self._mu_v[dids], return_inverse=True)
+		pairs, pair = unique(node_of*len(mus) + group, return_inverse=True)
+		ntps = self._a.shape[1]
+		A, B, C = [zeros((len(pairs), ntps)) for i in range(3)]
+		add.at(A, pair, self._a[dids])
+		add.at(B, pair, self._b[dids])
+		add.at(C, pair, self._c[dids])
+		pair_node = pairs // len(mus)
+		pair_mu_r = mus.real[pairs % len(mus)][:,newaxis] if len(mus) else zeros((0,1))
+		pair_mu_v = mus.imag[pairs % len(mus)][:,newaxis] if len(mus) else zeros((0,1))
+
+		# row 4*r+k holds copies k = (nr1, nv1, nr2, nv2) of row r of states
+		index_of = dict([(nid, i) for i, nid in enumerate(tree['ids'])])
+		nrows = len(states['dids'])
+		rows = repeat(4*arange(nrows), diff(states['ptr']))
+		cols = array([index_of[nid] for nid in states['nids']], dtype=int32)
+		copies = csr_matrix((states['copies'].astype(float64).ravel(), (add.outer(rows, arange(4)).ravel(), repeat(cols, 4))), shape=(4*nrows, nnodes))
+		sa = self._a[states['dids']][:,newaxis]
+		sb = self._b[states['dids']][:,newaxis]
+		sc = self._c[states['dids']][:,newaxis]
+		mu_r = self._mu_r[states['dids']][:,newaxis,newaxis]
+
+		def llh(params, pi, with_cnv=True):
+			phi = params[pair_node]
+			mu = (1 - phi)*pair_mu_r + phi*pair_mu_v
+			out = (A*log(mu) + B*log(1 - mu) + C).sum(0)
+			if nrows == 0 or not with_cnv:
+				return out, zeros_like(out)
+			# maternal and paternal copy numbers, nrows x 2 x ntps
+			y = copies.dot(pi).reshape(nrows, 2, 2, -1)
+			nr, nv = y[:,:,0], y[:,:,1]
+			tot = nr + nv
+			with errstate(divide='ignore', invalid='ignore'):
+				mu = (nv*(1 - mu_r) + nr*mu_r)/tot
+				ll = where(tot > 0, sa*log(mu) + sb*log(1 - mu) + log(0.5) + sc, log(1e-99))
+			return out, logaddexp(ll[:,0], ll[:,1]).sum(0)
+		return llh
+
+# subtree[i,j] is 1 if node j is in the subtree rooted at node i, so that
+# params = subtree.dot(pi). Nodes are in post-order, children before parents.
+def _subtree_matrix(tree):
+	nnodes = len(tree['ids'])
+	index_of = dict([(nid, i) for i, nid in enumerate(tree['ids'])])
+	subtree = identity(nnodes)
+	for i in range(nnodes):
+		for nid in tree['child_ids'][tree['child_ptr'][i]:tree['child_ptr'][i+1]]:
+			subtree[i] += subtree[index_of[nid]]
+	return subtree
+
+# index of each node's parent, -1 for the root
+def _parents(tree):
+	index_of = dict([(nid, i) for i, nid in enumerate(tree['ids'])])
+	parent = -ones(len(tree['ids']), dtype=int)
+	for i in range(len(tree['ids'])):
+		for nid in tree['child_ids'][tree['child_ptr'][i]:tree['child_ptr'][i+1]]:
+			parent[index_of[nid]] = i
+	return parent
+
+def _log_beta_pdf(x, a, b):
+	return gammaln(a + b) - gammaln(a) - gammaln(b) + (a - 1)*log(x) + (b - 1)*log(1 - x)
+
+# log normalizer of a Dirichlet with parameters std*pi, per sample
+def _dirichlet_norm(pi, std):
+	return gammaln(std*pi.sum(0)) - gammaln(std*pi).sum(0)
+
+# effective sample size of x by batch means, as in mh.cpp
+def batch_means_ess(x):
+	n = len(x)
+	b = int(sqrt(n))
+	if b < 2:
+		return 0.0
+	nb = n // b
+	x = array(x[:nb*b]) - x[0]
+	var = x.var(ddof=1)
+	if not var > 0:
+		return 0.0
+	var_bm = x.reshape(nb, b).mean(1).var(ddof=1)
+	if var_bm == 0:
+		return float(n)
+	return min(float(n), n*var/(b*var_bm))
@@ -28,18 +28,23 @@ def post_assignments(ssms, tree_file):
           data_ob.cnv.append((c,copies[i][0],copies[i][1]))
       nodes = tree.get_nodes()
       tree.data[-1] = data_ob
+      tree.data_version += 1
 
       new_node = get_new_node(tree,other_ssms[name])
 
       tree.assignments[-1] = new_node
       n = len(tree.data)-1
       new_node.add_datum(n)
-      llhmap = {}
+      # the likelihood of the SSM at every node at once, except when it has
+      # CNVs (nan), see TSSB.data_log_likelihood_matrix()
+      llhs, nodes = tree.data_log_likelihood_matrix(nodes, [data_ob])
+      llhmap = dict([(node, llh) for node, llh in zip(nodes, llhs[0]) if not np.isnan(llh)])
 
       max_u = 1.0
       min_u = 0.0
-      old_llh = tree.assignments[n].logprob(tree.data[n:n+1])
-      llhmap[tree.assignments[n]] = old_llh
+      if tree.assignments[n] not in llhmap:
+        llhmap[tree.assignments[n]] = tree.assignments[n].logprob(tree.data[n:n+1])
+      old_llh = llhmap[tree.assignments[n]]
       llh_s = np.log(np.random.rand()) + old_llh
 
       while True:
@@ -5,10 +5,20 @@ from numpy import *
 
 class Node(object):
 
+    # Slotted, as trees hold many nodes and are pickled every sample.
+    # data_version is bumped whenever data are added or removed, so that terms
+    # computed from the node's data can be cached.
+    __slots__ = ('data', '_children', 'tssb', '_parent', 'data_version')
+
+    # Caches and scratch values that __getstate__() leaves out of pickles, and
+    # __setstate__() resets with _reset_transient().
+    _transient = ()
+
     def __init__(self, parent=None, tssb=None):
         self.data      = set([])
         self._children = []#set([])#shankar
         self.tssb      = tssb
+        self.data_version = 0
 
         if parent is not None:
             parent.add_child(self)
@@ -16,12 +26,43 @@ class Node(object):
         else:
             self._parent = None
 
+    def _slot_names(self):
+        names = []
+        for cls in type(self).__mro__:
+            names.extend(cls.__dict__.get('__slots__', ()))
+        return names
+
+    # The data ids are pickled as a sorted int32 array rather than a set.
+    def __getstate__(self):
+        state = {}
+        for name in self._slot_names():
+            if name not in self._transient and hasattr(self, name):
+                state[name] = getattr(self, name)
+        state['data'] = array(sorted(self.data), dtype=int32)
+        return state
+
+    # state is a dict of slots, or the __dict__ of a node pickled before
+    # slots, whose other entries are dropped.
+    def __setstate__(self, state):
+        self.data_version = 0
+        self._reset_transient()
+        slots = set(self._slot_names())
+        for name, value in state.items():
+            if name in slots and name not in self._transient:
+                setattr(self, name, value)
+        if isinstance(self.data, ndarray):
+            self.data = set(self.data.tolist())
+
+    def _reset_transient(self):
+        pass
+
     def kill(self):
         if self._parent is not None:
             self._parent._children.remove(self)
 
         self._parent   = None
         self._children = None
+        self._structure_changed()
 
     def spawn(self):
         return self.__class__(parent=self, tssb=self.tssb)
@@ -43,18 +84,27 @@ class Node(object):
 
     def add_datum(self, id):
         self.data.add(id)
+        self.data_version += 1
 
     def remove_datum(self, id):
         self.data.remove(id)
+        self.data_version += 1
 
     def resample_params(self):
         pass
     
     def add_child(self, child):
         self._children.append(child)#shankar
+        self._structure_changed()
 
     def remove_child(self, child):
         self._children.remove(child)
+        self._structure_changed()
+
+    # Invalidates the tree annotations cached against TSSB.version.
+    def _structure_changed(self):
+        if self.tssb is not None:
+            self.tssb.version += 1
 
     def children(self):
         return self._children
@@ -68,6 +118,22 @@ class Node(object):
         0/0
         return 0 
 
+    # A key that changes whenever the node's params do, and differs between
+    # nodes, so that likelihoods can be memoized while the params are
+    # unchanged (see util.llh_memo), or None if they cannot.
+    def params_key(self):
+        return None
+
+    # logprob() of each of data (rows) at each of nodes (columns). Node
+    # classes that score data in bulk override this, and may leave nan where
+    # a datum cannot be scored until it is assigned to the node.
+    def logprob_matrix(self, data, nodes):
+        llh = empty((len(data), len(nodes)))
+        for i, x in enumerate(data):
+            for j, node in enumerate(nodes):
+                llh[i,j] = node.logprob([x])
+        return llh
+
     def data_log_likelihood(self):
         return self.complete_logprob()
     
@@ -79,7 +145,7 @@ class Node(object):
 
     def global_param(self, key):
         if self.parent() is None:
-            return self.__dict__[key]
+            return getattr(self, key)
         else:
             return self.parent().global_param(key)
 
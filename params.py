@@ -2,7 +2,7 @@
 
 import numpy
 from numpy import *
-from data import Datum
+from data import Datum, data_columns
 
 from tssb import *
 
@@ -15,27 +15,36 @@ import util2 as u2
 import os
 
 def get_c_fnames(tmp_dir):
-	def _make_c_fname(name):
-		fname = 'c_%s.txt' % (name)
-		return os.path.join(tmp_dir, fname)
-
-	FNAME_C_TREE = _make_c_fname('tree')
-	FNAME_C_DATA_STATES = _make_c_fname('data_states')
-	FNAME_C_PARAMS = _make_c_fname('params')
-	FNAME_C_MH_ARATIO = _make_c_fname('mh_ar')
-
-	return (FNAME_C_TREE, FNAME_C_DATA_STATES, FNAME_C_PARAMS, FNAME_C_MH_ARATIO)
+	FNAME_C_STATE = os.path.join(tmp_dir, 'c_state.bin')
+	return (FNAME_C_STATE,)
 
 # done for multi-sample
-def metropolis(tssb,iters=1000,std=0.01,burnin=0,n_ssms=0,n_cnvs=0,fin1='',fin2='',rseed=1, ntps=5, tmp_dir='.'):
-	wts, nodes = tssb.get_mixture()
-
-	# file names
-	FNAME_SSM_DATA = fin1
-	FNAME_CNV_DATA = fin2
-	NTPS = str(ntps)
-	FNAME_C_TREE, FNAME_C_DATA_STATES, FNAME_C_PARAMS, FNAME_C_MH_ARATIO = get_c_fnames(tmp_dir)
-
+# engine: an object with a run(tree, states, opts) method that samples new
+# params for the packed tree state, i.e., a mh_native.NativeMH, an MHWorker,
+# an MHExec or a mh_numpy.NumpyMH.
+# If None, mh.o is run once as a subprocess.
+# threads: no. of threads the likelihood is evaluated on (needs mh.o/libmh.so
+# built with OpenMP, otherwise 1 is used). The result does not depend on it.
+# blocked: accept or reject the proposal of each sample separately instead of
+# jointly.
+# adaptive: adapt std towards target_acc during the call, and stop once at
+# least min_iters iterations are done and the effective sample size of the
+# log-likelihood trace reaches target_ess. iters is then the maximum.
+# pair_rate, subtree_rate: probability of proposing, instead of a new pi for
+# all nodes, to move pi between a random node and its parent (pair) or to
+# rescale the node's subtree against its parent (subtree). These only rescore
+# the data of the nodes they change.
+# seed: seeds mh.o's random number generator. With 0, GSL's default seed is
+# used, so that every call draws the same random numbers.
+# delayed: screen each all-node proposal on the likelihood of the data without
+# CNVs first, and score the SSMs with CNVs only for the proposals that pass
+# (delayed acceptance). The chain targets the same posterior.
+# tries: with more than 1, each all-node proposal draws this many candidates,
+# scored in parallel on the threads, and picks one as in multiple-try
+# Metropolis. delayed is then ignored.
+# Returns the sampler stats as a dict keyed by MH_STATS, with the acceptance
+# ratio of each sample under 'acc_rates'.
+def metropolis(tssb,iters=1000,std=0.01,burnin=0,n_ssms=0,n_cnvs=0,fin1='',fin2='',rseed=1, ntps=5, tmp_dir='.', engine=None, threads=1, blocked=False, adaptive=False, min_iters=0, target_acc=0.25, target_ess=100, pair_rate=0.0, subtree_rate=0.0, seed=0, delayed=False, tries=1):
 	## initialize the MH sampler###########
 	#for tp in arange(ntps): 
 	#	sample_cons_params(tssb,tp)
@@ -43,77 +52,252 @@ def metropolis(tssb,iters=1000,std=0.01,burnin=0,n_ssms=0,n_cnvs=0,fin1='',fin2=
 	######################################
 	
 	## prepare to call the c++ code ###########
-	u2.set_node_height(tssb)
-	write_tree(tssb,n_ssms,FNAME_C_TREE) #write the current tree to the disk
-	u2.map_datum_to_node(tssb)
-	
-	write_data_state(tssb,FNAME_C_DATA_STATES) # this is need for binomial parameter computations
+	u2.update_tree_annotations(tssb)
+	nodes, tree = pack_tree(tssb, n_ssms)
+	states = pack_data_states(tssb) # this is need for binomial parameter computations
+	opts = pack_mh_opts(iters=iters, std=std, threads=threads, blocked=blocked, adaptive=adaptive, min_iters=min_iters, target_acc=target_acc, target_ess=target_ess, pair_rate=pair_rate, subtree_rate=subtree_rate, seed=seed, delayed=delayed, tries=tries)
 	###########################################
 	
-	MH_ITR = str(iters)
-	MH_STD = str(std)
-	N_SSM_DATA = str(n_ssms)
-	N_CNV_DATA = str(n_cnvs)
-	NNODES = str(len(nodes))
-	TREE_HEIGHT = str(max([node.ht for node in nodes])+1)
+	if engine is None:
+		stats = run_mh(tree, states, opts, n_ssms, n_cnvs, fin1, fin2, ntps, tmp_dir)
+	else:
+		stats = engine.run(tree, states, opts)
 	
-	script_dir = os.path.dirname(os.path.realpath(__file__))
-	sp.check_call(['%s/mh.o' % script_dir, MH_ITR, MH_STD, N_SSM_DATA, N_CNV_DATA, NNODES, TREE_HEIGHT, FNAME_SSM_DATA, FNAME_CNV_DATA, FNAME_C_TREE, FNAME_C_DATA_STATES, FNAME_C_PARAMS,FNAME_C_MH_ARATIO, NTPS])
-	ar = str(loadtxt(FNAME_C_MH_ARATIO,dtype='string'))
-	update_tree_params(tssb,FNAME_C_PARAMS) # update the tree with the new parameters sampled using the c++ code
+	# update the tree with the new parameters sampled using the c++ code. the
+	# params of nodes left unchanged keep their version, so that likelihoods
+	# memoized for them are still used
+	for i, node in enumerate(nodes):
+		if not array_equal(node.params, tree['params'][i]):
+			node.params = tree['params'][i].copy()
+			node.params_changed()
+		node.pi = tree['pi'][i].copy()
 	
-	return ar
+	return stats
 
-# done for multi-sample
-def write_tree(tssb,n_ssms,fname):
-	fh=open(fname,'w')
-	wts,nodes=tssb.get_mixture()
-	did_int_dict=dict()
-	for dat in tssb.data:
-		if dat.id[0]=='s':
-			did_int_dict[dat.id]=int(dat.id[1:])
-		else:
-			did_int_dict[dat.id]=n_ssms+int(dat.id[1:])
+def _mh_exe():
+	script_dir = os.path.dirname(os.path.realpath(__file__))
+	return '%s/mh.o' % script_dir
+
+# runs mh.o once, exchanging the tree state through a file in tmp_dir
+def run_mh(tree, states, opts, n_ssms, n_cnvs, fin1, fin2, ntps, tmp_dir):
+	FNAME_C_STATE = get_c_fnames(tmp_dir)[0]
+	exchange = write_exchange(tree,states,opts,FNAME_C_STATE) #write the current tree to the disk
 	
-	def descend(root):		
-		for child in root.children():			
-			descend(child)
-		
-		# write data#
-		cids=''
-		for child in root.children():cids+=str(child.id)+','
-		cids=cids.strip(',')
-		if cids=='': cids=str(-1)
+	N_SSM_DATA = str(n_ssms)
+	N_CNV_DATA = str(n_cnvs)
+	NTPS = str(ntps)
+	
+	sp.check_call([_mh_exe(), N_SSM_DATA, N_CNV_DATA, NTPS, fin1, fin2, FNAME_C_STATE])
+	return read_exchange(tree,exchange)
+
+# run_mh() behind the same interface as MHWorker and mh_native.NativeMH
+class MHExec(object):
+	def __init__(self, n_ssms, n_cnvs, fin1, fin2, ntps, tmp_dir):
+		self._args = (n_ssms, n_cnvs, fin1, fin2, ntps, tmp_dir)
+
+	def run(self, tree, states, opts):
+		return run_mh(tree, states, opts, *self._args)
+
+	def close(self):
+		pass
+
+# Long-lived `mh.o --serve` process that keeps the SSM/CNV data loaded, so that
+# each MCMC iteration only sends the tree state.
+class MHWorker(object):
+	def __init__(self, n_ssms, n_cnvs, fin1, fin2, ntps, tmp_dir):
+		self._tmp_dir = tmp_dir
+		self._proc = sp.Popen([_mh_exe(), '--serve', str(ntps), str(n_ssms), str(n_cnvs), fin1, fin2], stdin=sp.PIPE, stdout=sp.PIPE)
+		self.pid = self._proc.pid
+
+	def run(self, tree, states, opts):
+		FNAME_C_STATE = get_c_fnames(self._tmp_dir)[0]
+		exchange = write_exchange(tree,states,opts,FNAME_C_STATE)
 		
-		dids=''
-		for dat in root.get_data():dids+=str(did_int_dict[dat.id])+','
-		dids=dids.strip(',')
-		if dids=='': dids=str(-1)
+		self._proc.stdin.write(FNAME_C_STATE + '\n')
+		self._proc.stdin.flush()
+		if self._proc.stdout.readline().strip() != 'done':
+			raise Exception('mh.o worker exited with code %s' % self._proc.wait())
 		
-		line = str(root.id) + '\t' + list_to_string(root.params) + '\t' + list_to_string(root.pi) + '\t' + str(len(root.children())) + '\t'  + cids + '\t' + str(len(root.get_data())) + '\t' + dids + '\t' +  str(root.ht)
-		fh.write(line)
-		fh.write('\n')
-		fh.flush()
-		###############
-	
+		return read_exchange(tree,exchange)
+
+	def close(self):
+		self._proc.stdin.close()
+		self._proc.wait()
+
+# SSMs are numbered 0..n_ssms-1 and CNVs n_ssms.. on the C++ side
+def datum_index(dat, n_ssms):
+	if dat.id[0]=='s':
+		return int(dat.id[1:])
+	else:
+		return n_ssms+int(dat.id[1:])
+
+# columnar copy of the data for mh_native.NativeMH, ordered by datum_index.
+# the columns are taken from the data's Dataset where they share one (see
+# data.data_columns())
+def pack_data(codes, n_ssms, ntps):
+	n = len(codes)
+	a = zeros((n, ntps), dtype=int32)
+	d = zeros((n, ntps), dtype=int32)
+	mu_r = zeros(n)
+	mu_v = zeros(n)
+	cnv_link = -ones(n, dtype=int32)
+	if n == 0:
+		return a, d, mu_r, mu_v, cnv_link
+	idx = array([datum_index(dat, n_ssms) for dat in codes], dtype=int)
+	a[idx], d[idx], mu_r[idx], mu_v[idx], norm = data_columns(codes)
+	for i, dat in zip(idx, codes):
+		if dat.cnv:
+			# mh.o links each SSM to the last CNV listing it
+			cnv_link[i] = datum_index(dat.cnv[-1][0], n_ssms)
+	return a, d, mu_r, mu_v, cnv_link
+
+# array form of the tree for the C++ code: nodes in post-order, with children
+# and data in CSR layout. Returns the node list along with the arrays.
+def pack_tree(tssb, n_ssms):
+	nodes = []
+	def descend(root):
+		for child in root.children():
+			descend(child)
+		nodes.append(root)
 	descend(tssb.root['node'])
-	fh.flush()
 
-	fh.close()
+	child_ptr = [0]
+	child_ids = []
+	data_ptr = [0]
+	data_ids = []
+	for node in nodes:
+		child_ids.extend([child.id for child in node.children()])
+		child_ptr.append(len(child_ids))
+		data_ids.extend([datum_index(dat, n_ssms) for dat in node.get_data()])
+		data_ptr.append(len(data_ids))
+
+	tree = {
+		'ids': array([node.id for node in nodes], dtype=int32),
+		'params': array([node.params for node in nodes], dtype=float64),
+		'pi': array([node.pi for node in nodes], dtype=float64),
+		'child_ptr': array(child_ptr, dtype=int32),
+		'child_ids': array(child_ids, dtype=int32),
+		'data_ptr': array(data_ptr, dtype=int32),
+		'data_ids': array(data_ids, dtype=int32),
+		'hts': array([node.ht for node in nodes], dtype=int32),
+	}
+	return nodes, tree
+
+# data states in CSR form: one row per SSM with a CNV, holding the node ids
+# and copies (nr,nv maternal, nr,nv paternal) of each node. Nodes without any
+# copies contribute nothing to the binomial parameter and are left out.
+def pack_data_states(tssb):
+	dids = []
+	ptr = [0]
+	nids = []
+	copies = []
+	for did, nid, state1, state2 in data_state_rows(tssb):
+		if not dids or dids[-1] != did:
+			dids.append(did)
+			ptr.append(ptr[-1])
+		if max(state1 + state2) == 0:
+			continue
+		nids.append(nid)
+		copies.append(state1 + state2)
+		ptr[-1] += 1
+	return {
+		'dids': array(dids, dtype=int32),
+		'ptr': array(ptr, dtype=int32),
+		'nids': array(nids, dtype=int32),
+		'copies': array(copies, dtype=int32).reshape(len(copies), 4),
+	}
 
+# c_state.bin layout, see map_exchange() in mh.cpp
+EXCHANGE_HEADER_LEN = 16
+EXCHANGE_MAGIC = 0x53475750 # "PWGS"
+EXCHANGE_VERSION = 3
 
-def list_to_string(p):
-	o=''
-	for pp in p:o+=str(pp)+','
-	return o.strip(',')
+# sampler options passed to mh.o with their defaults, in the order of mh_opt in
+# mh.hpp
+MH_OPTS = [('iters', 1000), ('std', 0.01), ('threads', 1), ('blocked', False),
+	('adaptive', False), ('min_iters', 0), ('target_acc', 0.25), ('target_ess', 100),
+	('pair_rate', 0.0), ('subtree_rate', 0.0), ('seed', 0), ('delayed', False),
+	('tries', 1)]
+MH_OPTS_LEN = 16
+
+# sampler stats returned by mh.o, in the order of mh_stat in mh.hpp. These are
+# followed by the acceptance ratio of each sample.
+MH_STATS = ['acc_rate', 'llh_evals', 'iters', 'std', 'ess',
+	'global_moves', 'global_acc', 'pair_moves', 'pair_acc', 'subtree_moves', 'subtree_acc', 'stage1_rej', 'stage2_rej']
+# stage1_rej, stage2_rej: with delayed, the fraction of all-node proposals
+# rejected by the screen and after it
+# proposal kernels, in the order of mh_kernel in mh.hpp. The stats hold the
+# no. of proposals and the acceptance ratio of each.
+MH_KERNELS = ['global', 'pair', 'subtree']
+MH_STATS_LEN = 16
+
+def pack_mh_opts(**kwargs):
+	opts = zeros(MH_OPTS_LEN)
+	for i, (name, default) in enumerate(MH_OPTS):
+		opts[i] = kwargs.pop(name, default)
+	if kwargs:
+		raise Exception('Unknown MH options: %s' % ', '.join(kwargs.keys()))
+	return opts
+
+def unpack_mh_opts(opts):
+	return dict([(name, opts[i]) for i, (name, default) in enumerate(MH_OPTS)])
+
+def unpack_mh_stats(stats):
+	out = dict([(name, float(stats[i])) for i, name in enumerate(MH_STATS)])
+	out['acc_rates'] = [float(r) for r in stats[MH_STATS_LEN:]]
+	return out
+
+# done for multi-sample
+# writes the packed tree and data states to the binary exchange file read by
+# mh.o. The file is memory-mapped; returns views of the arrays it holds.
+def write_exchange(tree,states,opts,fname):
+	nnodes, ntps = tree['params'].shape
+	arrays = [
+		('opts', opts),
+		('stats', zeros(MH_STATS_LEN + ntps)),
+		('params', tree['params']),
+		('pi', tree['pi']),
+		('ids', tree['ids']),
+		('hts', tree['hts']),
+		('child_ptr', tree['child_ptr']),
+		('child_ids', tree['child_ids']),
+		('data_ptr', tree['data_ptr']),
+		('data_ids', tree['data_ids']),
+		('state_ptr', states['ptr']),
+		('state_dids', states['dids']),
+		('state_nids', states['nids']),
+		('state_copies', states['copies']),
+	]
+	header = zeros(EXCHANGE_HEADER_LEN, dtype=int32)
+	header[:9] = [EXCHANGE_MAGIC, EXCHANGE_VERSION, nnodes, ntps, len(tree['child_ids']), len(tree['data_ids']), len(states['dids']), len(states['nids']), tree['hts'].max()+1]
 	
+	size = header.nbytes + sum([arr.nbytes for name, arr in arrays])
+	mm = memmap(fname, dtype=uint8, mode='w+', shape=(size,))
+	mm[:header.nbytes] = header.view(uint8)
+	offset = header.nbytes
+	exchange = {}
+	for name, arr in arrays:
+		view = ndarray(arr.shape, dtype=arr.dtype, buffer=mm, offset=offset)
+		view[...] = arr
+		exchange[name] = view
+		offset += arr.nbytes
+	mm.flush()
+	return exchange
+
+# copies the params sampled by mh.o back into the packed tree and returns the
+# sampler stats
+def read_exchange(tree,exchange):
+	tree['params'][...] = exchange['params']
+	tree['pi'][...] = exchange['pi']
+	return unpack_mh_stats(exchange['stats'])
+
 # no changes for multi-sample
-# data/node state format (parameter independent dot-product weights)
-# datum_id	node_id_1,pi,nr,nv;node_id_2,pi,nr,nv;....	
-# these weights are used to compute data log-likelihood			
-def write_data_state(tssb,fname):
-	fh = open(fname,'w')
+# data/node states are parameter independent dot-product weights, used to
+# compute data log-likelihood. Yields (datum id, node id, (nr,nv) maternal,
+# (nr,nv) paternal) for every SSM with a CNV and every node.
+def data_state_rows(tssb):
 	wts,nodes=tssb.get_mixture()
+	u2.update_most_recent_cnvs(tssb)
 	
 	for dat in tssb.data:
 		if not dat.cnv: continue # nothing to do for CNVs
@@ -128,75 +312,37 @@ def write_data_state(tssb,fname):
 		for node in nodes:
 		
 			ssm_node = node.path[-1]
-			mr_cnv = find_most_recent_cnv(dat,node)
-			ancestors = node.get_ancestors()
+			mr_cnv = dat.mr_cnv[node.tour_in]
+			ssm_above = tssb.is_ancestor(ssm_node, node)
             
-			dat.state1 = '' # maternal
-			dat.state2 = '' # paternal
-			if (not ssm_node in ancestors) and (not mr_cnv):
-				dat.state1 += str(node.id) + ',' + str(2) + ',' + str(0) + ';'
-				dat.state2=dat.state1
-			elif ssm_node in ancestors and (not mr_cnv):
-				dat.state1 += str(node.id) + ',' + str(1) + ',' + str(1) + ';'
-				dat.state2=dat.state1
-			elif (not ssm_node in ancestors) and mr_cnv:
-				dat.state1 += str(node.id) + ',' + str(mr_cnv[1]+mr_cnv[2]) + ',' + str(0) + ';'
-				dat.state2=dat.state1
-			elif ssm_node in ancestors and mr_cnv:
-				if ssm_node in mr_cnv[0].node.get_ancestors():
+			# state1 is maternal, state2 paternal
+			if (not ssm_above) and (not mr_cnv):
+				state1 = state2 = (2, 0)
+			elif ssm_above and (not mr_cnv):
+				state1 = state2 = (1, 1)
+			elif (not ssm_above) and mr_cnv:
+				state1 = state2 = (mr_cnv[1]+mr_cnv[2], 0)
+			elif ssm_above and mr_cnv:
+				if tssb.is_ancestor(ssm_node, mr_cnv[0].node):
 					if nv == (False,True):
-						dat.state2 += str(node.id) + ',' + str(mr_cnv[2]) + ',' + str(mr_cnv[1]) + ';' # paternal
-						dat.state1=dat.state2
+						state1 = state2 = (mr_cnv[2], mr_cnv[1]) # paternal
 					elif nv == (True, False):
-						dat.state1 += str(node.id) + ',' + str(mr_cnv[1]) + ',' + str(mr_cnv[2]) + ';' # maternal
-						dat.state2 = dat.state1
+						state1 = state2 = (mr_cnv[1], mr_cnv[2]) # maternal
 					else:
-						dat.state1 += str(node.id) + ',' + str(mr_cnv[1]) + ',' + str(mr_cnv[2]) + ';' # maternal
-						dat.state2 += str(node.id) + ',' + str(mr_cnv[2]) + ',' + str(mr_cnv[1]) + ';' # paternal
-					
+						state1 = (mr_cnv[1], mr_cnv[2]) # maternal
+						state2 = (mr_cnv[2], mr_cnv[1]) # paternal
 				else:
-					dat.state1 += str(node.id) + ',' + str(max(0,mr_cnv[1]+mr_cnv[2]-1)) + ',' + str(min(1,mr_cnv[1]+mr_cnv[2])) + ';'
-					dat.state2 = dat.state1 
+					state1 = state2 = (max(0,mr_cnv[1]+mr_cnv[2]-1), min(1,mr_cnv[1]+mr_cnv[2]))
 			else:
 				print "PANIC"
+				continue
 			
-			fh.write(str(dat.id[1:]) + '\t' + dat.state1.strip(';') + '\t' + dat.state2.strip(';'))
-			fh.write('\n')
-		
-	fh.flush()
-	fh.close()
+			yield int(dat.id[1:]), node.id, state1, state2
 
 # done for multi-sample	
+# same as Datum.find_most_recent_cnv()
 def find_most_recent_cnv(dat,nd):
-	out = None
-	for n in nd.get_ancestors()[::-1]:
-		if n in [x[0].node for x in dat.cnv]:
-			out = [x for x in dat.cnv if x[0].node == n][0]
-			break
-	return out
-
-# done for multi sample
-def update_tree_params(tssb,fname):
-	wts, nodes = tssb.get_mixture()
-	ndict = dict()
-	for node in nodes: ndict[node.id]=node
-	
-	fh=open(fname)
-	params=[line.split() for line in fh.readlines()]
-	fh.close()
-	
-	for p in params:
-		ndict[int(p[0])].params = string_to_list(p[1])
-		ndict[int(p[0])].pi = string_to_list(p[2])
-	#params=loadtxt('c_params.txt')
-	#for p in params:
-	#	ndict[p[0]].params = p[1]
-	#	ndict[p[0]].pi = p[2]
-	
-
-def string_to_list(p):
-	p=p.strip(',')
-	return array([float(pp) for pp in p.split(',')])
+	return dat.find_most_recent_cnv(nd)
 
 # done for multi-sample
 # tree-structured finite-dimensional stick breaking
@@ -225,6 +371,7 @@ def update_params(tssb,tp):
 			descend(child,tp)	
 		root.params[tp] = root.params1[tp]
 		root.pi[tp] = root.pi1[tp]
+		root.params_changed()
 	descend(tssb.root['node'],tp)
 	
 	
@@ -249,8 +396,7 @@ def write_data_state1111(tssb):
 	
 		mr_cnv = dat.cnv[0] # CNV corresponding to the SSM
 		
-		dat.state1 = '' # maternal
-		dat.state2 = '' # paternal
+		state = ['', ''] # maternal, paternal
 		
 		# do this until we encounter the SSM node,
 		# i.e., along the path from root to the SSM node
@@ -258,28 +404,28 @@ def write_data_state1111(tssb):
 		for node in ancestors:
 		
 			if node != mr_cnv[0].node and visited_cnv==False: # until CNV is encountered
-				dat.state1 += str(node.id) + ',' + str(2) + ',' + str(0) + ';'
+				state[0] += str(node.id) + ',' + str(2) + ',' + str(0) + ';'
 			else:
 				visited_cnv = True
-				dat.state1 += str(node.id) + ',' + str(mr_cnv[1]+mr_cnv[2]) + ',' + str(0) + ';'
-			dat.state2=dat.state1	
+				state[0] += str(node.id) + ',' + str(mr_cnv[1]+mr_cnv[2]) + ',' + str(0) + ';'
+			state[1]=state[0]	
 		
 		# do this after the SSM node, i.e, for all nodes in the subtree below the SSM node
 		# [node_id, nr, nv] format
 		def descend(n,d):
 			if n == mr_cnv[0].node:
-				d.state1 += str(n.id) + ',' + str(mr_cnv[1]) + ',' + str(mr_cnv[2]) + ';' # maternal
-				d.state2 += str(n.id) + ',' + str(mr_cnv[2]) + ',' + str(mr_cnv[1]) + ';' # paternal
+				d[0] += str(n.id) + ',' + str(mr_cnv[1]) + ',' + str(mr_cnv[2]) + ';' # maternal
+				d[1] += str(n.id) + ',' + str(mr_cnv[2]) + ',' + str(mr_cnv[1]) + ';' # paternal
 			else:
-				d.state1 += str(n.id) + ',' + str(mr_cnv[1]+mr_cnv[2]-1) + ',' + str(1) + ';'
-				d.state2 = d.state1
+				d[0] += str(n.id) + ',' + str(mr_cnv[1]+mr_cnv[2]-1) + ',' + str(1) + ';'
+				d[1] = d[0]
 			for child in n.children():
 				descend(child,d)
 		
 		# traverse the tree below the ssm node
-		for child in node.children(): descend(child,dat)
+		for child in node.children(): descend(child,state)
 		
-		fh.write(str(dat.id[1:]) + '\t' + dat.state1.strip(';') + '\t' + dat.state2.strip(';'))
+		fh.write(str(dat.id[1:]) + '\t' + state[0].strip(';') + '\t' + state[1].strip(';'))
 		fh.write('\n')
 		
 	fh.flush()
@@ -87,8 +87,8 @@ class ResultGenerator(object):
       for mut in node['node'].get_data():
         if mut.id.startswith('s'):
           ssms[mut.id] = {
-            'ref_reads': mut.a,
-            'total_reads': mut.d,
+            'ref_reads': [int(n) for n in mut.a],
+            'total_reads': [int(n) for n in mut.d],
             'expected_ref_in_ref': mut.mu_r,
             'expected_ref_in_variant': mut.mu_v
           }
@@ -103,8 +103,8 @@ class ResultGenerator(object):
             })
         elif mut.id.startswith('c'):
           cnvs[mut.id] = {
-            'ref_reads': mut.a,
-            'total_reads': mut.d
+            'ref_reads': [int(n) for n in mut.a],
+            'total_reads': [int(n) for n in mut.d]
           }
         else:
           raise Exception('Unknown mutation type: %s' % mut.id)
@@ -0,0 +1,129 @@
+# Measures the memory held by the datums and nodes of a tree, and the size of
+# the tree pickled as in trees.zip, on a synthetic data set of N_SSMS SSMs. The
+# tree is sampled as in evolve.py, with the caches of a sweep filled in. Run
+# from this directory, optionally with the no. of SSMs as an argument. To
+# compare, copy this script into test/ at an earlier commit and run it there.
+# Before the tree annotations were cached and the parsed inputs with them
+# (a6c5271 and a45fee0), it falls back on their uncached versions; before
+# that, scoring every datum walks the whole tree, so use a few hundred SSMs.
+# The slots were added in f340f22, so its parent a45fee0 is the commit to
+# compare with for those.
+import os
+import sys
+import time
+import zlib
+import shutil
+import tempfile
+import cPickle as pickle
+
+sys.path.insert(0, '..')
+
+from numpy import *
+from numpy.random import seed, randint, rand, binomial
+
+from util import boundbeta
+from util2 import load_data
+from tssb import TSSB
+from alleles import alleles
+
+try:
+  from util2 import update_tree_annotations
+except ImportError:
+  from util2 import set_node_height, set_path_from_root_to_node, map_datum_to_node
+  def update_tree_annotations(tssb):
+    set_node_height(tssb)
+    set_path_from_root_to_node(tssb)
+    map_datum_to_node(tssb)
+
+N_SSMS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+N_CNVS = N_SSMS // 100
+SSMS_PER_CNV = 10
+NTPS = 5
+SWEEPS = 2
+
+def write_data(dirname):
+  ssm_fn = os.path.join(dirname, 'ssm_data.txt')
+  cnv_fn = os.path.join(dirname, 'cnv_data.txt')
+  d = randint(50, 500, size=(N_SSMS, NTPS))
+  a = binomial(d, 0.5 + 0.5*rand(N_SSMS, 1))
+  with open(ssm_fn, 'w') as f:
+    f.write('id\tgene\ta\td\tmu_r\tmu_v\n')
+    for i in range(N_SSMS):
+      f.write('s%d\tg_%d\t%s\t%s\t0.999\t0.499\n' % (i, i, ','.join(map(str, a[i])), ','.join(map(str, d[i]))))
+  with open(cnv_fn, 'w') as f:
+    f.write('cnv\ta\td\tssms\n')
+    for j in range(N_CNVS):
+      ssms = ['s%d,1,2' % (j*SSMS_PER_CNV + k) for k in range(SSMS_PER_CNV)]
+      cd = randint(1000, 5000, size=NTPS)
+      f.write('c%d\t%s\t%s\t%s\n' % (j, ','.join(map(str, binomial(cd, 0.6))), ','.join(map(str, cd)), ';'.join(ssms)))
+  return ssm_fn, cnv_fn
+
+# the root and a single child holding all data, as in evolve.py
+def build_tree(codes):
+  tssb = TSSB(dp_alpha=25.0, dp_gamma=1.0, alpha_decay=0.25, root_node=alleles(conc=0.1, ntps=NTPS), data=codes)
+  tssb.root['sticks'] = vstack([tssb.root['sticks'], .999])
+  tssb.root['children'].append({'node': tssb.root['node'].spawn(),
+    'main': boundbeta(1.0, tssb.alpha_decay*tssb.dp_alpha), 'sticks': empty((0,1)), 'children': []})
+  new_node = tssb.root['children'][0]['node']
+  for n in range(tssb.num_data):
+    tssb.assignments[n].remove_datum(n)
+    new_node.add_datum(n)
+    tssb.assignments[n] = new_node
+  for dat in codes:
+    dat.tssb = tssb
+  for i in range(SWEEPS):
+    tssb.resample_assignments()
+    tssb.cull_tree()
+  wts, nodes = tssb.get_mixture()
+  for i, node in enumerate(nodes):
+    node.id = i
+  update_tree_annotations(tssb)
+  tssb.complete_data_log_likelihood()
+  return tssb
+
+# the object and its __dict__, if any, and those of the values stored on it
+# that it owns rather than shares
+def object_size(obj, owned):
+  size = sys.getsizeof(obj)
+  if hasattr(obj, '__dict__'):
+    size += sys.getsizeof(obj.__dict__)
+  for name in owned:
+    value = getattr(obj, name, None)
+    if value is not None:
+      size += sys.getsizeof(value)
+  return size
+
+def main():
+  seed(1)
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    ssm_fn, cnv_fn = write_data(tmp_dir)
+    try:
+      codes, n_ssms, n_cnvs = load_data(ssm_fn, cnv_fn, cache=False)
+    except TypeError: # before the data cache
+      codes, n_ssms, n_cnvs = load_data(ssm_fn, cnv_fn)
+  finally:
+    shutil.rmtree(tmp_dir)
+  t = time.time()
+  tssb = build_tree(codes)
+  print('sampled %d SSMs, %d CNVs into %d nodes in %.1f s' % (n_ssms, n_cnvs, len(tssb.get_nodes()), time.time() - t))
+
+  nodes = tssb.get_nodes()
+  dat_bytes = sum([object_size(dat, ('cnv',)) for dat in codes])
+  node_bytes = sum([object_size(node, ('data', 'pi', 'params', 'pi1', 'params1', '_children')) for node in nodes])
+  cache_bytes = sum([object_size(dat, ('mr_cnv', 'cnv_coef')) - object_size(dat, ()) for dat in codes] +
+    [object_size(node, ('path',)) - object_size(node, ()) for node in nodes])
+  print('datums: %.1f MB (%d bytes per datum)' % (dat_bytes / 1e6, dat_bytes // len(codes)))
+  print('nodes: %.1f MB' % (node_bytes / 1e6))
+  print('caches: %.1f MB' % (cache_bytes / 1e6))
+
+  t = time.time()
+  pickled = pickle.dumps(tssb, protocol=pickle.HIGHEST_PROTOCOL)
+  dump_time = time.time() - t
+  t = time.time()
+  pickle.loads(pickled)
+  load_time = time.time() - t
+  print('pickled tree: %.1f MB, %.1f MB deflated (%d bytes per datum), dumped in %.2f s, loaded in %.2f s' % (
+    len(pickled) / 1e6, len(zlib.compress(pickled)) / 1e6, len(pickled) // len(codes), dump_time, load_time))
+
+main()
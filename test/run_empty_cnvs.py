@@ -0,0 +1,42 @@
+# Checks that util2.load_data() reads an empty CNV file, as used for runs
+# without CNVs, and one with only a header, both when parsing the inputs and
+# when loading them from the data cache. Run from this directory.
+import os
+import sys
+import tempfile
+import shutil
+
+sys.path.insert(0, '..')
+
+from util2 import load_data, read_data_cache
+
+SSM_FILE = '../ssm_data.txt'
+
+def check(loaded, label):
+  codes, n_ssms, n_cnvs = loaded
+  if n_cnvs != 0 or len(codes) != n_ssms:
+    raise Exception('%s: read %d data, %d SSMs and %d CNVs' % (label, len(codes), n_ssms, n_cnvs))
+  if [dat for dat in codes if dat.cnv]:
+    raise Exception('%s: SSMs linked to CNVs' % label)
+
+def main():
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    ssm_fn = os.path.join(tmp_dir, 'ssm_data.txt')
+    shutil.copy(SSM_FILE, ssm_fn)
+    for label, contents in (('empty', ''), ('header only', 'cnv\ta\td\tssms\n')):
+      cnv_fn = os.path.join(tmp_dir, 'cnv_data.txt')
+      with open(cnv_fn, 'w') as f:
+        f.write(contents)
+      cache_fn = os.path.join(tmp_dir, '%s.cache.npz' % label.replace(' ', '_'))
+
+      check(load_data(ssm_fn, cnv_fn, cache=False), '%s, parsed' % label)
+      check(load_data(ssm_fn, cnv_fn, cache=cache_fn), '%s, cache written' % label)
+      if read_data_cache(cache_fn, ssm_fn, cnv_fn) is None:
+        raise Exception('%s: cache not used' % label)
+      check(load_data(ssm_fn, cnv_fn, cache=cache_fn), '%s, cache read' % label)
+  finally:
+    shutil.rmtree(tmp_dir)
+  print('Empty CNV files passed')
+
+main()
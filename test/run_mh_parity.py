@@ -0,0 +1,126 @@
+# Checks that the NumPy Metropolis-Hastings sampler (mh_numpy.py) samples from
+# the same posterior as mh.o. Both start from the same tree and run the same
+# number of calls; the posterior mean of each node's params must agree, as must
+# the acceptance ratios. The local proposal kernels, delayed acceptance and
+# multiple tries must also leave the posterior of mh.o's global kernel
+# unchanged. Run from this
+# directory after building mh.o (or libmh.so, which is used instead if
+# present).
+import os
+import sys
+import tempfile
+import shutil
+
+sys.path.insert(0, '..')
+
+from numpy import *
+from numpy.random import seed
+
+from util2 import load_data, set_node_height, set_path_from_root_to_node, map_datum_to_node
+from tssb import TSSB
+from alleles import alleles
+from params import metropolis, pack_data, MHWorker
+from mh_native import NativeMH
+from mh_numpy import NumpyMH
+
+SSM_FILE = '../ssm_data.txt'
+CNV_FILE = '../cnv_data.txt'
+NCALLS = 40
+ITERS = 1000
+STD = 1e5
+WARMUP_CALLS = 10
+# sampler options of each mode tested
+MODES = [
+  ('joint', {}),
+  ('blocked', {'blocked': True}),
+  ('local', {'pair_rate': 0.4, 'subtree_rate': 0.4}),
+  ('delayed', {'delayed': True}),
+  ('mtm', {'tries': 4}),
+  ('blocked_mtm', {'blocked': True, 'tries': 4}),
+]
+# Separate chains of either engine differ by up to ~0.04 in the posterior means
+# over this many calls, so only a larger difference indicates a bug.
+PARAMS_TOL = 0.06
+ACC_TOL = 0.1
+
+# Samples a tree and, with ref_engine, brings its params close to the posterior
+# mode, where the sampler with a fixed std mixes.
+def build_tree(codes, n_ssms, n_cnvs, ntps, ref_engine, tmp_dir):
+  seed(1)
+  tssb = TSSB(dp_alpha=25.0, dp_gamma=1.0, alpha_decay=0.25, root_node=alleles(conc=0.1, ntps=ntps), data=codes)
+  for dat in codes:
+    dat.tssb = tssb
+  for i in range(5):
+    tssb.resample_assignments()
+    tssb.cull_tree()
+  wts, nodes = tssb.get_mixture()
+  for i, node in enumerate(nodes):
+    node.id = i
+  set_node_height(tssb)
+  set_path_from_root_to_node(tssb)
+  map_datum_to_node(tssb)
+  for i in range(WARMUP_CALLS):
+    metropolis(tssb, 5*ITERS, STD, 0, n_ssms, n_cnvs, SSM_FILE, CNV_FILE, 1, ntps, tmp_dir, ref_engine, adaptive=True)
+  return tssb
+
+# Runs NCALLS calls of the sampler, starting from the tree's current params.
+# Each call of mh.o is seeded differently, so that they form a single chain.
+# Returns the params of each node after every call in the second half, and the
+# mean acceptance ratio. The tree's params are restored afterwards.
+def sample(tssb, engine, n_ssms, n_cnvs, ntps, tmp_dir, mh_opts):
+  wts, nodes = tssb.get_mixture()
+  start = [(node.params.copy(), node.pi.copy()) for node in nodes]
+  params, acc = [], []
+  for i in range(NCALLS):
+    stats = metropolis(tssb, ITERS, STD, 0, n_ssms, n_cnvs, SSM_FILE, CNV_FILE, 1, ntps, tmp_dir, engine, seed=i+1, **mh_opts)
+    if i >= NCALLS // 2:
+      params.append([node.params.copy() for node in nodes])
+      acc.append(stats['acc_rate'])
+  for node, (node_params, node_pi) in zip(nodes, start):
+    node.params, node.pi = node_params, node_pi
+    node.params_changed()
+  return array(params), mean(acc)
+
+# Returns the reference engine's posterior mean params.
+def compare(tssb, ref_engine, engine, n_ssms, n_cnvs, ntps, tmp_dir, mode, mh_opts):
+  ref_params, ref_acc = sample(tssb, ref_engine, n_ssms, n_cnvs, ntps, tmp_dir, mh_opts)
+  params, acc = sample(tssb, engine, n_ssms, n_cnvs, ntps, tmp_dir, mh_opts)
+  params_diff = abs(ref_params.mean(0) - params.mean(0)).max()
+  print('%s: max. difference in posterior mean params %.4f, acceptance ratios %.3f and %.3f' % (mode, params_diff, ref_acc, acc))
+  if params_diff > PARAMS_TOL or abs(ref_acc - acc) > ACC_TOL:
+    raise Exception('Posteriors do not match in %s mode' % mode)
+  print('%s passed' % mode)
+  return ref_params.mean(0)
+
+def main():
+  codes, n_ssms, n_cnvs = load_data(SSM_FILE, CNV_FILE)
+  ntps = len(codes[0].a)
+  tmp_dir = tempfile.mkdtemp()
+
+  try:
+    ref_engine = NativeMH(*pack_data(codes, n_ssms, ntps), n_ssms=n_ssms, n_cnvs=n_cnvs)
+  except OSError:
+    ref_engine = MHWorker(n_ssms, n_cnvs, SSM_FILE, CNV_FILE, ntps, tmp_dir)
+  engine = NumpyMH(*pack_data(codes, n_ssms, ntps), n_ssms=n_ssms, n_cnvs=n_cnvs, seed=1)
+  tssb = build_tree(codes, n_ssms, n_cnvs, ntps, ref_engine, tmp_dir)
+
+  try:
+    means = {}
+    for mode, mh_opts in MODES:
+      means[mode] = compare(tssb, ref_engine, engine, n_ssms, n_cnvs, ntps, tmp_dir, mode, mh_opts)
+    if abs(means['local'] - means['joint']).max() > PARAMS_TOL:
+      raise Exception('Local kernels change the posterior')
+    print('local kernels passed')
+    if abs(means['delayed'] - means['joint']).max() > PARAMS_TOL:
+      raise Exception('Delayed acceptance changes the posterior')
+    print('delayed acceptance passed')
+    for mode, ref_mode in (('mtm', 'joint'), ('blocked_mtm', 'blocked')):
+      if abs(means[mode] - means[ref_mode]).max() > PARAMS_TOL:
+        raise Exception('Multiple tries change the posterior')
+    print('multiple tries passed')
+  finally:
+    ref_engine.close()
+    engine.close()
+    shutil.rmtree(tmp_dir)
+
+main()
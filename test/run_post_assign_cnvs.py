@@ -0,0 +1,73 @@
+# Checks that misc/post_assign_ssm.py reassigns several SSMs with CNVs to the
+# same trees. Each SSM replaces the last datum of the tree, so the most recent
+# CNV table of util2.update_most_recent_cnvs() must be rebuilt for every one
+# of them. Run from this directory.
+import os
+import sys
+import tempfile
+import shutil
+
+sys.path.insert(0, '..')
+sys.path.insert(0, '../misc')
+
+from numpy.random import seed
+
+from util2 import load_data, TreeWriter
+from tssb import TSSB
+from alleles import alleles
+import post_assign_ssm
+
+SSM_FILE = '../ssm_data.txt'
+CNV_FILE = '../cnv_data.txt'
+SSM_IDS = ['s2', 's4'] # both in c0
+NTREES = 5
+
+def write_trees(trees_fn):
+  codes, n_ssms, n_cnvs = load_data(SSM_FILE, CNV_FILE, cache=False)
+  ntps = len(codes[0].a)
+  tssb = TSSB(dp_alpha=25.0, dp_gamma=1.0, alpha_decay=0.25, root_node=alleles(conc=0.1, ntps=ntps), data=codes)
+  for dat in codes:
+    dat.tssb = tssb
+
+  trees = []
+  for i in range(NTREES):
+    tssb.resample_assignments()
+    tssb.cull_tree()
+    tssb.resample_sticks()
+    trees.append((tssb, i, tssb.complete_data_log_likelihood()))
+  cwd = os.getcwd()
+  os.chdir(os.path.dirname(trees_fn))
+  try:
+    TreeWriter().write_trees(trees)
+  finally:
+    os.chdir(cwd)
+
+def read_ssms():
+  cnvs = post_assign_ssm.parse_cnvs(CNV_FILE)
+  ssms = []
+  for ssm_id, name, a, d, mu_r, mu_v in post_assign_ssm.read_ssms(SSM_FILE):
+    if ssm_id not in SSM_IDS:
+      continue
+    overlapping = post_assign_ssm.find_overlapping_cnvs(ssm_id, cnvs)
+    if not overlapping:
+      raise Exception('%s has no CNVs' % ssm_id)
+    ssms.append((name, ssm_id, [int(x) for x in a.split(',')], [int(x) for x in d.split(',')],
+      float(mu_r), float(mu_v), [c[0] for c in overlapping], [c[1:3] for c in overlapping]))
+  return ssms
+
+def main():
+  seed(1)
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    trees_fn = os.path.join(tmp_dir, TreeWriter.default_archive_fn)
+    write_trees(trees_fn)
+    assignments = post_assign_ssm.post_assignments(read_ssms(), trees_fn)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+  for ssm_id in SSM_IDS:
+    if len(assignments[ssm_id]) != NTREES:
+      raise Exception('%s was assigned in %d of %d trees' % (ssm_id, len(assignments[ssm_id]), NTREES))
+  print('Reassigned %s with CNVs in %d trees' % (', '.join(SSM_IDS), NTREES))
+
+main()
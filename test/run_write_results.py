@@ -0,0 +1,64 @@
+# Checks that write_results.py writes the results of sampled trees, whose data
+# hold their read counts as NumPy arrays (see data.Dataset), and that the
+# mutation list gives the same counts as the input files. Run from this
+# directory.
+import os
+import sys
+import json
+import gzip
+import tempfile
+import shutil
+import subprocess
+
+sys.path.insert(0, '..')
+
+from numpy.random import seed
+
+from util2 import load_data, TreeWriter
+from tssb import TSSB
+from alleles import alleles
+
+SSM_FILE = '../ssm_data.txt'
+CNV_FILE = '../cnv_data.txt'
+NTREES = 3
+
+def write_trees(tmp_dir):
+  codes, n_ssms, n_cnvs = load_data(SSM_FILE, CNV_FILE, cache=False)
+  ntps = len(codes[0].a)
+  tssb = TSSB(dp_alpha=25.0, dp_gamma=1.0, alpha_decay=0.25, root_node=alleles(conc=0.1, ntps=ntps), data=codes)
+  for dat in codes:
+    dat.tssb = tssb
+
+  trees = []
+  for i in range(NTREES):
+    tssb.resample_assignments()
+    tssb.cull_tree()
+    tssb.resample_sticks()
+    trees.append((tssb, i, tssb.complete_data_log_likelihood()))
+  cwd = os.getcwd()
+  os.chdir(tmp_dir)
+  try:
+    TreeWriter().write_trees(trees)
+  finally:
+    os.chdir(cwd)
+  return codes
+
+def main():
+  seed(1)
+  script = os.path.realpath('../write_results.py')
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    codes = write_trees(tmp_dir)
+    subprocess.check_call([sys.executable, script, '--include-ssm-names', 'test', TreeWriter.default_archive_fn,
+      'test.summ.json.gz', 'test.muts.json.gz', 'test.mutass.zip'], cwd=tmp_dir)
+    muts = json.load(gzip.open(os.path.join(tmp_dir, 'test.muts.json.gz')))
+  finally:
+    shutil.rmtree(tmp_dir)
+
+  for dat in codes:
+    mut = muts['ssms' if dat.id.startswith('s') else 'cnvs'][dat.id]
+    if mut['ref_reads'] != list(dat.a) or mut['total_reads'] != list(dat.d):
+      raise Exception('%s: read counts differ' % dat.id)
+  print('Wrote the results of %d trees' % NTREES)
+
+main()
@@ -14,6 +14,23 @@ class TSSB(object):
     max_dp_gamma    = 10.0
     min_alpha_decay = 0.05
     max_alpha_decay = 0.80
+
+    # Structural version, bumped whenever nodes are added, removed or moved
+    # (see Node._structure_changed()), or siblings reordered (see
+    # resample_stick_orders()). util2.update_tree_annotations() only
+    # recomputes the annotations when this differs from annotated_version,
+    # and is_ancestor() the tour when it differs from tour_version.
+    # data_version is bumped whenever data are added to self.data or replaced
+    # in it. cnv_links, cnv_links_key and cnv_table_key belong to
+    # util2.update_most_recent_cnvs(). These are class attributes, so that
+    # pickled trees without them load as unannotated.
+    version           = 0
+    data_version      = 0
+    annotated_version = None
+    tour_version      = None
+    cnv_links         = None
+    cnv_links_key     = None
+    cnv_table_key     = None
     
     def __init__(self, dp_alpha=1.0, dp_gamma=1.0, root_node=None, data=None,
                  min_depth=0, max_depth=15, alpha_decay=1.0):
@@ -46,6 +63,22 @@ class TSSB(object):
                 self.root['node'].add_datum(n)
                 self.assignments.append(self.root['node'])
 
+    # The nodes and data leave their annotations out of pickles (see
+    # Node._transient), so the tree is pickled, and loaded if pickled
+    # before that, as unannotated.
+    _annotations = ('annotated_version', 'tour_version', 'cnv_links', 'cnv_links_key', 'cnv_table_key')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in self._annotations:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for key in self._annotations:
+            self.__dict__.pop(key, None)
+
     def add_data(self, data):
         (weights, nodes) = self.get_mixture()
         num_new_data = len(data)#data.shape[0] #shankar
@@ -60,6 +93,7 @@ class TSSB(object):
             self.assignments.append(nodes[best_k])
         self.data = vstack([self.data, data])
         self.num_data += num_new_data
+        self.data_version += 1
 
 #shankar
 #    def clear_data(self):
@@ -91,6 +125,31 @@ class TSSB(object):
 
             return cmp(s2, s1)
 
+        # phi is fixed during the sweep, so the likelihood of every datum at a
+        # node is computed in one call the first time the node is visited.
+        # The ones the slice sampler looks at are memoized in llh_memo against
+        # the node's params version, so that later sweeps reuse them while the
+        # params are unchanged, e.g. after Metropolis-Hastings rejected every
+        # proposal. These likelihoods do not depend on the tree's structure,
+        # which changes in almost every sweep. SSMs with CNVs depend on the
+        # whole tree, so they are neither memoized nor looked up. Entries left
+        # nan (see data_log_likelihood_matrix()) are scored per datum once it
+        # is assigned to the node.
+        columns = {}
+        def datum_llh(n, node):
+            key = (self.data[n].id, node.params_key())
+            memoized = key[1] is not None and not self.data[n].cnv
+            llh = llh_memo.get(key) if memoized else None
+            if llh is None:
+                if node not in columns:
+                    columns[node] = self.data_log_likelihood_matrix([node])[0][:,0]
+                llh = columns[node][n]
+                if isnan(llh):
+                    return node.logprob(self.data[n:n+1])
+                if memoized:
+                    llh_memo.put(key, llh)
+            return llh
+
         epsilon = finfo(float64).eps
         lengths = []        
         for n in range(self.num_data):
@@ -106,7 +165,7 @@ class TSSB(object):
             
             max_u = 1.0
             min_u = 0.0
-            old_llh = self.assignments[n].logprob(self.data[n:n+1])
+            old_llh = datum_llh(n, self.assignments[n])
             llhmap[self.assignments[n]] = old_llh
             llh_s = log(rand()) + old_llh
 
@@ -123,7 +182,7 @@ class TSSB(object):
                 if new_node in llhmap:
                     new_llh = llhmap[new_node]
                 else:
-                    new_llh = new_node.logprob(self.data[n:n+1])
+                    new_llh = datum_llh(n, new_node)
                     llhmap[new_node] = new_llh
                 if new_llh > llh_s:
                     break
@@ -231,6 +290,9 @@ class TSSB(object):
                 root['children'][k]['node'].kill()
                 del root['children'][k]['node']
 
+            # a new order of the children moves their subtrees in the tour
+            if new_order != sorted(new_order):
+                self.version += 1
             root['children'] = new_children
             root['sticks']   = zeros((len(root['children']),1))
         descend(self.root)
@@ -368,7 +430,39 @@ class TSSB(object):
           child_nodes = descend(child)
           node.extend(child_nodes)
         return node
-      return descend(self.root)  
+      return descend(self.root)
+
+    # Numbers the nodes in a depth-first walk, so that the subtree of a node
+    # is exactly the nodes with tour_in in [node.tour_in, node.tour_out).
+    def set_euler_tour(self):
+        def descend(root, index):
+            root['node'].tour_in = index
+            index += 1
+            for child in root['children']:
+                index = descend(child, index)
+            root['node'].tour_out = index
+            return index
+        descend(self.root, 0)
+        self.tour_version = self.version
+
+    # Whether node a is node b or one of its ancestors.
+    def is_ancestor(self, a, b):
+        if self.tour_version != self.version:
+            self.set_euler_tour()
+        return a.tour_in <= b.tour_in < a.tour_out
+
+    # Log-likelihood of each of data (all of the TSSB's by default) at each of
+    # nodes (the current ones by default) under the node's params, as a
+    # len(data) x len(nodes) array, returned along with the nodes. Entries the
+    # node class cannot score from the params alone, such as SSMs with CNVs,
+    # whose likelihood depends on where they and their CNVs are assigned, are
+    # nan and are left to node.logprob() once the datum is assigned.
+    def data_log_likelihood_matrix(self, nodes=None, data=None):
+        if nodes is None:
+            nodes = self.get_nodes()
+        if data is None:
+            data = self.data
+        return (self.root['node'].logprob_matrix(data, nodes), nodes)
 
     def get_mixture(self):
 	def descend(root, mass):
@@ -384,6 +478,11 @@ class TSSB(object):
             return (weight, node)
         return descend(self.root, 1.0)
 
+    # Sums the per-node terms of Node.data_log_likelihood(), which are cached
+    # and computed from the nodes' data in bulk. These add up the data in
+    # another order than one datum and sample at a time did, so the result
+    # (the LLH of mcmc_samples.txt and the trees.zip entry names) matches
+    # that only to rounding, about 1e-15 relative.
     def complete_data_log_likelihood(self):
         weights, nodes = self.get_mixture();
         llhs = []
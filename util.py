@@ -1,6 +1,8 @@
 import os
 import sys
 import cPickle
+import collections
+import itertools
 import numpy
 import scipy.special
 import scipy.stats
@@ -133,3 +135,43 @@ def slice_sample(init_x, logprob, sigma=1.0, step_out=True, max_steps_out=1000,
         return direction_slice(direction, init_x)
 		
 
+# Bounded memo of likelihood terms, evicting the least recently used entry
+# beyond size entries. Keys must cover everything a value depends on; node
+# params are keyed by Node.params_key(). hits and misses count get() calls.
+class LikelihoodMemo(object):
+    def __init__(self, size):
+        self.size   = size
+        self.hits   = 0
+        self.misses = 0
+        self._table = collections.OrderedDict()
+
+    # the value of key, or None
+    def get(self, key):
+        value = self._table.pop(key, None)
+        if value is None:
+            self.misses += 1
+        else:
+            self._table[key] = value # now the most recently used
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._table.pop(key, None)
+        self._table[key] = value
+        if len(self._table) > self.size:
+            self._table.popitem(last=False)
+
+    def __len__(self):
+        return len(self._table)
+
+# Shared by the sweeps of TSSB.resample_assignments(), so that a node whose
+# params Metropolis-Hastings left unchanged is not scored again. Data are keyed
+# by their ids, so this assumes one data set per process, as in evolve.py.
+llh_memo = LikelihoodMemo(1 << 18)
+
+# Stamps for Node.params_key(), never reused within the process, so that they
+# also tell nodes apart.
+_params_versions = itertools.count(1)
+
+def new_params_version():
+    return next(_params_versions)
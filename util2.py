@@ -1,8 +1,10 @@
+import os
 import numpy
 from numpy import *
 import cPickle as pickle
 import zipfile
 import shutil
+import hashlib
 
 import scipy.stats as stat
 from scipy.stats import beta, binom
@@ -16,7 +18,7 @@ import csv
 # value, which is a signed 32-bit int.
 csv.field_size_limit(2147483647)
 
-from data import Datum
+from data import Datum, Dataset
 
 from tssb import *
 
@@ -36,47 +38,140 @@ def logsumexp(X, axis=None):
     maxes = numpy.max(X, axis=axis)
     return numpy.log(numpy.sum(numpy.exp(X - maxes), axis=axis)) + maxes
 
-def load_data(fname1,fname2):
+# Reads the SSMs (fname1) and CNVs (fname2) into a data.Dataset and returns its
+# Datum views along with the no. of SSMs and CNVs. The parsed columns are
+# cached in the file cache, by default next to fname1 (see
+# DATA_CACHE_SUFFIX), or not at all if cache is False.
+def load_data(fname1,fname2,cache=True):
+	if cache is True:
+		cache = fname1 + DATA_CACHE_SUFFIX
+	cols = None
+	if cache:
+		cols = read_data_cache(cache, fname1, fname2)
+	if cols is None:
+		cols = parse_data(fname1, fname2)
+		if cache:
+			write_data_cache(cache, fname1, fname2, cols)
+	dataset = Dataset(cols['names'], cols['ids'], cols['a'], cols['d'], cols['mu_r'], cols['mu_v'], cols['is_cnv'], cols['links'])
+	return dataset.data, cols['n_ssms'], cols['n_cnvs']
+
+# Parses the input files into the columns of a data.Dataset: a and d are split
+# with one split() over the whole column, as are the cp,cm copies of the CNVs'
+# ssms lists. Data are ordered as the keys of a dict of their ids, as they
+# always have been.
+def parse_data(fname1,fname2):
 	# load ssm data
-	reader = csv.DictReader(open(fname1,'rU'), delimiter='\t')
-	data = dict()  
+	reader = csv.reader(open(fname1,'rU'), delimiter='\t')
+	header = reader.next()
+	col = dict([(name, i) for i, name in enumerate(header)])
+	data = dict() # id -> (name, a, d, mu_r, mu_v, is_cnv)
 	for row in reader:
-		name = row['gene']
-		id = row['id']
-		a = [int(x) for x in row['a'].split(',')]
-		d = [int(x) for x in row['d'].split(',')]
-
 		mu_r=mu_v=0
-		if 'mu_r' in row.keys():
-			mu_r = float(row['mu_r'])
-			mu_v = float(row['mu_v'])
-
-		data[id] = Datum(name, id, a, d, mu_r, mu_v)
+		if 'mu_r' in col:
+			mu_r = float(row[col['mu_r']])
+			mu_v = float(row[col['mu_v']])
+		data[row[col['id']]] = (row[col['gene']], row[col['a']], row[col['d']], mu_r, mu_v, False)
 	
 	n_ssms = len(data.keys())
-	n_cnvs = 0
 	
 	# load cnv data
-	reader = csv.DictReader(open(fname2,'rU'), delimiter='\t')
-
-	for row in reader:
-		name=row['cnv']
-		id = row['cnv']
-		a = [int(x) for x in row['a'].split(',')]
-		d = [int(x) for x in row['d'].split(',')]
-
-		data[id] = Datum(name, id, a, d,0.999,0.5)
-
-		ssms = row['ssms']
-		if ssms is None: continue
-		if len(ssms)>0:
-			for ssm in ssms.split(';'):
-				tok = ssm.split(',')
-				data[tok[0]].cnv.append((data[id],int(tok[1]),int(tok[2])))
+	# an empty file, without even a header, means there are no CNVs
+	reader = csv.reader(open(fname2,'rU'), delimiter='\t')
+	header = next(reader, None)
+	col = dict([(name, i) for i, name in enumerate(header or [])])
+	link_ssms, link_cnvs = [], [] # ssm,cp,cm and the cnv id of each link
+	for row in (reader if header else []):
+		id = row[col['cnv']]
+		data[id] = (id, row[col['a']], row[col['d']], 0.999, 0.5, True)
+		ssms = row[col['ssms']] if col['ssms'] < len(row) else None
+		if ssms:
+			ssms = ssms.split(';')
+			link_ssms.extend(ssms)
+			link_cnvs.extend([id]*len(ssms))
 
 	n_cnvs = len(data.keys())-n_ssms
-		
-	return [data[key] for key in data.keys()], n_ssms, n_cnvs
+
+	ids = data.keys()
+	rows = dict([(id, i) for i, id in enumerate(ids)])
+	def int_matrix(strings, ncols=-1):
+		return array(','.join(strings).split(','), dtype=int64).reshape(len(strings), ncols)
+	names, a, d, mu_r, mu_v, is_cnv = zip(*[data[id] for id in ids]) or [()]*6
+	# each row of a and d must have a count for every sample
+	nsamples = [s.count(',') + 1 for s in a + d]
+	ragged = [i for i, n in enumerate(nsamples) if n != nsamples[0]]
+	if ragged:
+		raise Exception('Rows of a and d must have one count per sample, but %s has %d and %s has %d' % ((ids + ids)[ragged[0]], nsamples[ragged[0]], ids[0], nsamples[0]))
+	links = zeros((len(link_ssms), 4), dtype=int64)
+	if link_ssms:
+		tok = array(','.join(link_ssms).split(','), dtype=object).reshape(-1, 3)
+		links[:,0] = [rows[ssm] for ssm in tok[:,0]]
+		links[:,1] = [rows[cnv] for cnv in link_cnvs]
+		links[:,2:] = tok[:,1:].astype(int64)
+	return {
+		'names': list(names), 'ids': ids,
+		'a': int_matrix(a) if ids else zeros((0, 0), dtype=int64),
+		'd': int_matrix(d) if ids else zeros((0, 0), dtype=int64),
+		'mu_r': array(mu_r, dtype=float), 'mu_v': array(mu_v, dtype=float),
+		'is_cnv': array(is_cnv, dtype=bool), 'links': links,
+		'n_ssms': n_ssms, 'n_cnvs': n_cnvs,
+	}
+
+# The columns of parse_data() are cached in <fname1>DATA_CACHE_SUFFIX by
+# default, along with the paths, sizes, mtimes and sha1 of both input files.
+# The cache is used for the same paths when the sizes and mtimes match, or
+# failing that when the contents hash the same. In that case it is rewritten
+# with the new sizes and mtimes, so that later runs need not hash the files.
+DATA_CACHE_SUFFIX = '.cache.npz'
+DATA_CACHE_VERSION = 2
+
+def data_file_stamps(fname1, fname2):
+	return array([[os.path.getsize(fn), os.path.getmtime(fn)] for fn in (fname1, fname2)])
+
+def data_file_hash(fname1, fname2):
+	h = hashlib.sha1()
+	for fn in (fname1, fname2):
+		with open(fn, 'rb') as f:
+			h.update(f.read())
+		h.update(b'\0')
+	return h.hexdigest()
+
+def read_data_cache(cache_fn, fname1, fname2):
+	try:
+		cache = numpy.load(cache_fn)
+		if int(cache['version']) != DATA_CACHE_VERSION:
+			return None
+		if str(cache['ssm_file']) != os.path.realpath(fname1) or str(cache['cnv_file']) != os.path.realpath(fname2):
+			return None
+		restamp = not array_equal(cache['stamps'], data_file_stamps(fname1, fname2))
+		if restamp and str(cache['sha1']) != data_file_hash(fname1, fname2):
+			return None
+		cols = dict([(key, cache[key]) for key in ('a', 'd', 'mu_r', 'mu_v', 'is_cnv', 'links')])
+		cols['names'] = cache['names'].tolist()
+		cols['ids'] = cache['ids'].tolist()
+		cols['n_ssms'] = int(cache['n_ssms'])
+		cols['n_cnvs'] = int(cache['n_cnvs'])
+		if restamp:
+			write_data_cache(cache_fn, fname1, fname2, cols, str(cache['sha1']))
+		return cols
+	except (IOError, OSError, KeyError, ValueError, EOFError, zipfile.BadZipfile):
+		return None
+
+# best effort: the cache is skipped where cache_fn's directory is not writable.
+# sha1 is the hash of the input files, if already known.
+def write_data_cache(cache_fn, fname1, fname2, cols, sha1=None):
+	if sha1 is None:
+		sha1 = data_file_hash(fname1, fname2)
+	tmp_fn = '%s.%d.tmp' % (cache_fn, os.getpid())
+	try:
+		with open(tmp_fn, 'wb') as f:
+			numpy.savez(f, version=DATA_CACHE_VERSION, ssm_file=os.path.realpath(fname1), cnv_file=os.path.realpath(fname2),
+				stamps=data_file_stamps(fname1, fname2), sha1=sha1,
+				names=array(cols['names'], dtype=str), ids=array(cols['ids'], dtype=str),
+				n_ssms=cols['n_ssms'], n_cnvs=cols['n_cnvs'],
+				**dict([(key, cols[key]) for key in ('a', 'd', 'mu_r', 'mu_v', 'is_cnv', 'links')]))
+		os.rename(tmp_fn, cache_fn)
+	except (IOError, OSError):
+		rm_safely(tmp_fn)
 	
 #################################################
 ## some useful functions to get some info about,
@@ -98,6 +193,62 @@ def map_datum_to_node(tssb):
 	for node in nodes:
 		for datum in node.get_data():
 			datum.node=node
+
+# Sets all of the above, unless the tree's structure is unchanged since the
+# last call (see TSSB.version). Data moved between nodes in the meantime have
+# been remapped by alleles.add_datum().
+def update_tree_annotations(tssb):
+	if tssb.annotated_version == tssb.version:
+		return
+	set_node_height(tssb)
+	set_path_from_root_to_node(tssb)
+	map_datum_to_node(tssb)
+	tssb.annotated_version = tssb.version
+
+# Sets dat.mr_cnv of every SSM with CNVs to the most recent CNV (see
+# Datum.find_most_recent_cnv()) of each node, indexed by node.tour_in, in one
+# walk down the tree. The table depends on the data (see TSSB.data_version),
+# the tree's structure and the nodes the CNVs are on, and is only rebuilt when
+# any of them has changed.
+def update_most_recent_cnvs(tssb):
+	links_key = (tssb.data_version, len(tssb.data))
+	if tssb.cnv_links_key != links_key:
+		# [(cnv, [(ssm, index of the cnv in ssm.cnv)])]
+		links = {}
+		for dat in tssb.data:
+			for k, x in enumerate(dat.cnv):
+				links.setdefault(x[0], []).append((dat, k))
+		tssb.cnv_links = links.items()
+		tssb.cnv_links_key = links_key
+	key = (links_key, tssb.version, tuple([cnv.node for cnv, ssms in tssb.cnv_links]))
+	if tssb.cnv_table_key == key:
+		return
+	if tssb.tour_version != tssb.version:
+		tssb.set_euler_tour()
+
+	here = {} # node -> [(ssm, k)] of the CNVs on it
+	nnodes = tssb.root['node'].tour_out
+	for cnv, ssms in tssb.cnv_links:
+		here.setdefault(cnv.node, []).extend(ssms)
+		for dat, k in ssms:
+			dat.mr_cnv = [None]*nnodes
+
+	def descend(root, recent):
+		node = root['node']
+		if node in here:
+			recent = dict(recent)
+			first = {} # the first CNV listed wins when several are on the node
+			for dat, k in here[node]:
+				if dat not in first or k < first[dat]:
+					first[dat] = k
+			for dat, k in first.iteritems():
+				recent[dat] = dat.cnv[k]
+		for dat, x in recent.iteritems():
+			dat.mr_cnv[node.tour_in] = x
+		for child in root['children']:
+			descend(child, recent)
+	descend(tssb.root, {})
+	tssb.cnv_table_key = key
 #################################################
 
 def check_bounds(p,l=0.0001,u=.9999):